@@ -0,0 +1,152 @@
+import ast
+import json
+import os
+import sys
+import timeit
+
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+os.environ.setdefault("SESSION_JOURNAL_DIR", "")
+
+import main  # noqa: E402
+
+
+def legacy_parse(text: str) -> dict:
+    data = {}
+    roles_dict = {}
+    sessions_json = {}
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.lower().startswith("roles="):
+            try:
+                roles_dict = ast.literal_eval(line.split("=", 1)[1])
+            except Exception:
+                roles_dict = {}
+        elif line.lower().startswith("sessions_json="):
+            raw = line.split("=", 1)[1].strip()
+            try:
+                sessions_json = json.loads(raw)
+            except Exception:
+                sessions_json = {}
+        elif "=" in line:
+            k, v = line.split("=", 1)
+            data[k.strip()] = v.strip()
+
+    data["roles"] = roles_dict
+    data["sessions_json"] = sessions_json
+    return data
+
+
+def legacy_serialize(d: dict) -> str:
+    roles = d.get("roles", {})
+    sessions_json = d.get("sessions_json", {})
+
+    lines = []
+    for k, v in d.items():
+        if k in ("roles", "sessions_json"):
+            continue
+        lines.append(f"{k}={v}")
+
+    lines.append(f"roles={roles}")
+    lines.append("sessions_json=" + json.dumps(sessions_json, separators=(",", ":")))
+    return "\n".join(lines)
+
+
+def sample_record(games: int) -> dict:
+    d = {
+        "pass": "secret",
+        "expires": "2099-01-01T00:00:00",
+        "global": "false",
+        "cpu_id": "BFEBFBFF000906EA",
+        "ram": "34359738368",
+        "mac": "00:1A:2B:3C:4D:5E",
+        "disk": "WD-WCC4N0123456",
+        "ip": "203.0.113.7",
+        "created_at": "2024-01-01T00:00:00",
+    }
+    d["roles"] = {f"role_{i}": {"level": i, "granted": "2024-01-01"} for i in range(10)}
+    d["sessions_json"] = {
+        f"game_{i}.zip": {
+            "total_seconds": 3600 * i,
+            "total_sessions": i,
+            "last_start": "2024-05-01T20:00:00",
+            "last_end": "2024-05-01T22:00:00",
+        }
+        for i in range(games)
+    }
+    return d
+
+
+def per_record_us(fn, number: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def bind_hwid(parse, serialize, text: str) -> str:
+    d = parse(text)
+    d["hwid"] = "HWID-1234"
+    return serialize(d)
+
+
+def main_bench(games: int, number: int) -> None:
+    record = sample_record(games)
+    text_v1 = legacy_serialize(record)
+    main.record_format = "v2"
+    text_v2 = main.dict_to_text_with_sessions(record)
+    main.record_format = "text"
+
+    def serialize_v2(d):
+        return main.dict_to_record_v2(d)
+
+    cases = [
+        (
+            "parse",
+            lambda: legacy_parse(text_v1),
+            lambda: main.parse_text_with_sessions(text_v1),
+            lambda: main.parse_text_with_sessions(text_v2),
+        ),
+        (
+            "parse + read sessions",
+            lambda: legacy_parse(text_v1)["sessions_json"],
+            lambda: main.parse_text_with_sessions(text_v1)["sessions_json"],
+            lambda: main.parse_text_with_sessions(text_v2)["sessions_json"],
+        ),
+        (
+            "parse + read roles",
+            lambda: legacy_parse(text_v1)["roles"],
+            lambda: main.parse_text_with_sessions(text_v1)["roles"],
+            lambda: main.parse_text_with_sessions(text_v2)["roles"],
+        ),
+        (
+            "bind hwid (parse + write)",
+            lambda: bind_hwid(legacy_parse, legacy_serialize, text_v1),
+            lambda: bind_hwid(
+                main.parse_text_with_sessions, main.dict_to_text_with_sessions, text_v1
+            ),
+            lambda: bind_hwid(main.parse_text_with_sessions, serialize_v2, text_v2),
+        ),
+        (
+            "serialize decoded record",
+            lambda: legacy_serialize(record),
+            lambda: main.dict_to_text_with_sessions(record),
+            lambda: serialize_v2(record),
+        ),
+    ]
+
+    print(f"record with {games} games: text {len(text_v1)} bytes, v2 {len(text_v2)} bytes")
+    print(f"{'operation':<28}{'legacy us':>12}{'text us':>12}{'v2 us':>12}")
+    for name, legacy, text, v2 in cases:
+        print(
+            f"{name:<28}"
+            f"{per_record_us(legacy, number):>12.1f}"
+            f"{per_record_us(text, number):>12.1f}"
+            f"{per_record_us(v2, number):>12.1f}"
+        )
+    print()
+
+
+if __name__ == "__main__":
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for games in (0, 10, 100):
+        main_bench(games, number)
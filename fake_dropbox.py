@@ -0,0 +1,373 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+from collections import Counter
+
+from flask import Flask, Response, jsonify, request
+
+app = Flask(__name__)
+
+latency_ms = float(os.environ.get("FAKE_DROPBOX_LATENCY_MS", 0))
+jitter_ms = float(os.environ.get("FAKE_DROPBOX_JITTER_MS", 0))
+error_rate = float(os.environ.get("FAKE_DROPBOX_ERROR_RATE", 0))
+rate_limit_rate = float(os.environ.get("FAKE_DROPBOX_RATE_LIMIT_RATE", 0))
+token_ttl = int(os.environ.get("FAKE_DROPBOX_TOKEN_TTL", 14400))
+page_size = int(os.environ.get("FAKE_DROPBOX_PAGE_SIZE", 500))
+
+
+def parse_overrides(value: str) -> dict:
+    overrides = {}
+    for item in value.split(","):
+        if "=" in item:
+            endpoint, ms = item.split("=", 1)
+            overrides[endpoint.strip()] = float(ms)
+    return overrides
+
+
+latency_overrides = parse_overrides(os.environ.get("FAKE_DROPBOX_ENDPOINT_LATENCY_MS", ""))
+
+
+class FakeFiles:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.files = {}
+        self.deleted = {}
+        self.revision = 0
+
+    def _next_rev(self) -> int:
+        self.revision += 1
+        return self.revision
+
+    def _metadata(self, key: str) -> dict:
+        name, content, rev = self.files[key]
+        return {
+            ".tag": "file",
+            "name": name,
+            "path_lower": key,
+            "path_display": key,
+            "id": "id:" + base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii"),
+            "rev": f"{rev:09x}",
+            "size": len(content),
+        }
+
+    def get(self, path: str):
+        with self.lock:
+            key = path.lower()
+            if key not in self.files:
+                return None
+            return self.files[key][1], self._metadata(key)
+
+    def metadata(self, path: str):
+        with self.lock:
+            key = path.lower()
+            return self._metadata(key) if key in self.files else None
+
+    def put(self, path: str, content: bytes, mode) -> dict:
+        with self.lock:
+            key = path.lower()
+            if isinstance(mode, dict) and mode.get(".tag") == "update":
+                current = self.files.get(key)
+                if current is None or f"{current[2]:09x}" != mode.get("update"):
+                    return None
+            elif mode == "add" and key in self.files:
+                return None
+            self.files[key] = (path.rsplit("/", 1)[-1], content, self._next_rev())
+            self.deleted.pop(key, None)
+            self.changed.notify_all()
+            return self._metadata(key)
+
+    def move(self, from_path: str, to_path: str):
+        with self.lock:
+            src, dst = from_path.lower(), to_path.lower()
+            if src not in self.files:
+                return "from_lookup/not_found/"
+            if dst in self.files:
+                return "to/conflict/file/"
+            _, content, _ = self.files.pop(src)
+            rev = self._next_rev()
+            self.deleted[src] = rev
+            self.files[dst] = (to_path.rsplit("/", 1)[-1], content, rev)
+            self.changed.notify_all()
+            return self._metadata(dst)
+
+    def listing(self, folder: str, since: int):
+        prefix = "/" + folder.strip("/").lower() + "/"
+        with self.lock:
+            entries = [
+                (rev, self._metadata(key))
+                for key, (_, _, rev) in self.files.items()
+                if key.startswith(prefix) and "/" not in key[len(prefix):] and rev > since
+            ]
+            entries += [
+                (rev, {".tag": "deleted", "name": key.rsplit("/", 1)[-1], "path_lower": key})
+                for key, rev in self.deleted.items()
+                if since and key.startswith(prefix) and "/" not in key[len(prefix):] and rev > since
+            ]
+            return [meta for _, meta in sorted(entries, key=lambda e: e[0])], self.revision
+
+    def wait(self, since: int, folder: str, timeout: float) -> bool:
+        deadline = time.time() + timeout
+        while True:
+            if self.listing(folder, since)[0]:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            with self.changed:
+                self.changed.wait(min(remaining, 1.0))
+
+
+files = FakeFiles()
+tokens = set()
+tokens_lock = threading.Lock()
+calls = Counter()
+calls_lock = threading.Lock()
+
+
+def encode_cursor(folder: str, since: int, offset: int) -> str:
+    raw = json.dumps({"folder": folder, "since": since, "offset": offset})
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> dict:
+    return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+
+
+def dropbox_error(status: int, summary: str):
+    tag = summary.split("/", 1)[0]
+    return jsonify({"error_summary": summary, "error": {".tag": tag}}), status
+
+
+@app.before_request
+def simulate_upstream():
+    endpoint = request.path.lstrip("/")
+    if endpoint.startswith("2/"):
+        endpoint = endpoint[2:]
+    if endpoint.startswith("_fake/") or endpoint.startswith("_content/"):
+        return None
+
+    with calls_lock:
+        calls[endpoint] += 1
+        calls["total"] += 1
+
+    delay = latency_overrides.get(endpoint, latency_ms)
+    if jitter_ms:
+        delay += random.uniform(0, jitter_ms)
+    if delay > 0:
+        time.sleep(delay / 1000)
+
+    roll = random.random()
+    if roll < error_rate:
+        with calls_lock:
+            calls["injected_errors"] += 1
+        return jsonify({"error_summary": "internal_error/"}), 500
+    if roll < error_rate + rate_limit_rate:
+        with calls_lock:
+            calls["injected_rate_limits"] += 1
+        r = jsonify(
+            {
+                "error_summary": "too_many_requests/",
+                "error": {"reason": {".tag": "too_many_requests"}},
+            }
+        )
+        r.status_code = 429
+        r.headers["Retry-After"] = "1"
+        return r
+
+    if endpoint != "oauth2/token" and endpoint != "files/list_folder/longpoll":
+        auth = request.headers.get("Authorization", "")
+        with tokens_lock:
+            valid = auth.startswith("Bearer ") and auth[7:] in tokens
+        if not valid:
+            return jsonify({"error_summary": "expired_access_token/"}), 401
+    return None
+
+
+@app.route("/oauth2/token", methods=["POST"])
+def oauth_token():
+    if request.form.get("grant_type") != "refresh_token":
+        return jsonify({"error": "unsupported_grant_type"}), 400
+    token = secrets.token_urlsafe(24)
+    with tokens_lock:
+        tokens.add(token)
+    return jsonify({"access_token": token, "token_type": "bearer", "expires_in": token_ttl})
+
+
+@app.route("/2/files/download", methods=["POST"])
+def download():
+    arg = json.loads(request.headers.get("Dropbox-API-Arg", "{}"))
+    found = files.get(arg.get("path", ""))
+    if found is None:
+        return dropbox_error(409, "path/not_found/")
+    content, meta = found
+    return Response(
+        content,
+        mimetype="application/octet-stream",
+        headers={"Dropbox-API-Result": json.dumps(meta)},
+    )
+
+
+@app.route("/2/files/upload", methods=["POST"])
+def upload():
+    arg = json.loads(request.headers.get("Dropbox-API-Arg", "{}"))
+    meta = files.put(arg["path"], request.get_data(), arg.get("mode", "add"))
+    if meta is None:
+        return dropbox_error(409, "path/conflict/file/")
+    return jsonify(meta)
+
+
+@app.route("/2/files/move_v2", methods=["POST"])
+def move():
+    data = request.json or {}
+    result = files.move(data.get("from_path", ""), data.get("to_path", ""))
+    if isinstance(result, str):
+        return dropbox_error(409, result)
+    return jsonify({"metadata": result})
+
+
+@app.route("/2/files/get_metadata", methods=["POST"])
+def get_metadata():
+    meta = files.metadata((request.json or {}).get("path", ""))
+    if meta is None:
+        return dropbox_error(409, "path/not_found/")
+    return jsonify(meta)
+
+
+@app.route("/2/files/get_temporary_link", methods=["POST"])
+def get_temporary_link():
+    path = (request.json or {}).get("path", "")
+    meta = files.metadata(path)
+    if meta is None:
+        return dropbox_error(409, "path/not_found/")
+    return jsonify({"metadata": meta, "link": request.host_url + "_content" + meta["path_lower"]})
+
+
+def list_page(folder: str, since: int, offset: int):
+    entries, revision = files.listing(folder, since)
+    page = entries[offset:offset + page_size]
+    has_more = offset + page_size < len(entries)
+    if has_more:
+        cursor = encode_cursor(folder, since, offset + page_size)
+    else:
+        cursor = encode_cursor(folder, revision, 0)
+    return jsonify({"entries": page, "cursor": cursor, "has_more": has_more})
+
+
+@app.route("/2/files/list_folder", methods=["POST"])
+def list_folder():
+    return list_page((request.json or {}).get("path", ""), 0, 0)
+
+
+@app.route("/2/files/list_folder/continue", methods=["POST"])
+def list_folder_continue():
+    try:
+        cursor = decode_cursor((request.json or {}).get("cursor", ""))
+    except ValueError:
+        return dropbox_error(409, "reset/")
+    return list_page(cursor["folder"], cursor["since"], cursor["offset"])
+
+
+@app.route("/2/files/list_folder/longpoll", methods=["POST"])
+def list_folder_longpoll():
+    data = request.json or {}
+    try:
+        cursor = decode_cursor(data.get("cursor", ""))
+    except ValueError:
+        return dropbox_error(409, "reset/")
+    changes = files.wait(cursor["since"], cursor["folder"], min(int(data.get("timeout", 30)), 480))
+    return jsonify({"changes": changes})
+
+
+@app.route("/_content/<path:path>", methods=["GET"])
+def content(path):
+    found = files.get("/" + path)
+    if found is None:
+        return "", 404
+    return Response(found[0], mimetype="application/octet-stream")
+
+
+@app.route("/_fake/stats", methods=["GET"])
+def fake_stats():
+    with calls_lock:
+        return jsonify(dict(calls))
+
+
+@app.route("/_fake/reset", methods=["POST"])
+def fake_reset():
+    with calls_lock:
+        calls.clear()
+    return jsonify({"ok": True})
+
+
+@app.route("/_fake/config", methods=["POST"])
+def fake_config():
+    global latency_ms, jitter_ms, error_rate, rate_limit_rate
+    data = request.json or {}
+    latency_ms = float(data.get("latency_ms", latency_ms))
+    jitter_ms = float(data.get("jitter_ms", jitter_ms))
+    error_rate = float(data.get("error_rate", error_rate))
+    rate_limit_rate = float(data.get("rate_limit_rate", rate_limit_rate))
+    if "endpoint_latency_ms" in data:
+        latency_overrides.clear()
+        latency_overrides.update(data["endpoint_latency_ms"])
+    return jsonify(
+        {
+            "latency_ms": latency_ms,
+            "jitter_ms": jitter_ms,
+            "error_rate": error_rate,
+            "rate_limit_rate": rate_limit_rate,
+            "endpoint_latency_ms": latency_overrides,
+        }
+    )
+
+
+def load_seed(seed_dir: str) -> int:
+    root = os.path.abspath(seed_dir)
+    count = 0
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            full = os.path.join(dirpath, name)
+            path = "/" + os.path.relpath(full, root).replace(os.sep, "/")
+            with open(full, "rb") as fh:
+                files.put(path, fh.read(), "overwrite")
+            count += 1
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Local stand-in for the Dropbox endpoints used by main.py"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--seed", default="", help="directory copied into the fake namespace at startup"
+    )
+    parser.add_argument("--latency-ms", type=float, default=latency_ms)
+    parser.add_argument("--jitter-ms", type=float, default=jitter_ms)
+    parser.add_argument("--error-rate", type=float, default=error_rate)
+    parser.add_argument("--rate-limit-rate", type=float, default=rate_limit_rate)
+    args = parser.parse_args()
+
+    latency_ms = args.latency_ms
+    jitter_ms = args.jitter_ms
+    error_rate = args.error_rate
+    rate_limit_rate = args.rate_limit_rate
+    if args.seed:
+        print(f"Seeded {load_seed(args.seed)} files from {args.seed}")
+
+    base = f"http://{args.host}:{args.port}"
+    print("Point main.py at this server with:")
+    for name in ("AUTH", "API", "CONTENT", "NOTIFY"):
+        print(f"  export DROPBOX_{name}_URL={base}")
+    print("  export STORAGE_BACKEND=dropbox REFRESH_TOKEN=fake APP_KEY=fake APP_SECRET=fake")
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,373 @@
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+
+DEFAULT_MIX = "validate=50,login_account=20,games=15,session_license=10,session_account=5"
+
+
+def parse_mix(value: str) -> list:
+    mix = []
+    for item in value.split(","):
+        name, weight = item.split("=", 1)
+        mix.append((name.strip(), float(weight)))
+    return mix
+
+
+def license_name(i: int) -> str:
+    return f"lt_license_{i:05d}"
+
+
+def account_name(i: int) -> str:
+    return f"lt_account_{i:05d}"
+
+
+def hardware_for(i: int) -> dict:
+    return {
+        "hwid": f"HWID-{i:08d}",
+        "cpu_id": f"CPU-{i:08d}",
+        "ram": "17179869184",
+        "mac": f"00:1A:2B:{i // 65536 % 256:02X}:{i // 256 % 256:02X}:{i % 256:02X}",
+        "disk": f"DISK-{i:08d}",
+        "ip": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}",
+    }
+
+
+def record_text(fields: dict, games: int) -> str:
+    sessions = {
+        f"game_{g:03d}.zip": {
+            "total_seconds": 3600 * g,
+            "total_sessions": g,
+            "last_start": "2024-05-01T20:00:00",
+            "last_end": "2024-05-01T21:00:00",
+        }
+        for g in range(games)
+    }
+    lines = [f"{k}={v}" for k, v in fields.items()]
+    lines.append("roles={}")
+    lines.append("sessions_json=" + json.dumps(sessions, separators=(",", ":")))
+    return "\n".join(lines)
+
+
+def seed_fake(base_url: str, users: int, games: int, catalog: int) -> None:
+    session = requests.Session()
+    token = session.post(
+        f"{base_url}/oauth2/token",
+        data={"grant_type": "refresh_token", "refresh_token": "loadtest"},
+    ).json()["access_token"]
+
+    def upload(path: str, content: str) -> None:
+        r = session.post(
+            f"{base_url}/2/files/upload",
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Dropbox-API-Arg": json.dumps({"path": path, "mode": "overwrite"}),
+                "Content-Type": "application/octet-stream",
+            },
+            data=content.encode("utf-8"),
+        )
+        r.raise_for_status()
+
+    for i in range(users):
+        upload(
+            f"/licenses/{license_name(i)}.txt",
+            record_text(
+                {"pass": f"pw{i}", "expires": "2099-01-01T00:00:00", "global": "false"},
+                games,
+            ),
+        )
+        upload(
+            f"/accounts/{account_name(i)}.txt",
+            record_text(
+                {
+                    "username": account_name(i),
+                    "password": f"pw{i}",
+                    "avatar_url": "",
+                    "created_at": "2024-01-01T00:00:00",
+                },
+                games,
+            ),
+        )
+    for g in range(catalog):
+        upload(f"/elementos/game_{g:03d}.zip", "zip")
+    upload("/loader/loader.exe", "exe")
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    def record(self, route: str, seconds: float, status) -> None:
+        with self.lock:
+            self.latencies[route].append(seconds)
+            self.statuses[route][status] += 1
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class LoadClient:
+    def __init__(
+        self,
+        base_url: str,
+        users: int,
+        stats: Stats,
+        timeout: float,
+        batch_size=20,
+        service_token="",
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.users = users
+        self.batch_size = batch_size
+        self.service_token = service_token
+        self.stats = stats
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def session(self) -> requests.Session:
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+            if self.service_token:
+                self.local.session.headers["X-Service-Token"] = self.service_token
+        return self.local.session
+
+    def call(self, route: str, method: str, path: str, payload: dict = None):
+        started = time.perf_counter()
+        try:
+            r = self.session().request(
+                method, self.base_url + path, json=payload, timeout=self.timeout
+            )
+            status = r.status_code
+            is_json = r.headers.get("Content-Type", "").startswith("application/json")
+            body = r.json() if is_json else {}
+        except requests.RequestException as e:
+            status = type(e).__name__
+            body = {}
+        self.stats.record(route, time.perf_counter() - started, status)
+        return status, body
+
+    def validate(self) -> None:
+        i = random.randrange(self.users)
+        payload = {"username": license_name(i), "password": f"pw{i}", **hardware_for(i)}
+        self.call("/validate", "POST", "/validate", payload)
+
+    def login_account(self) -> None:
+        i = random.randrange(self.users)
+        payload = {"username": account_name(i), "password": f"pw{i}"}
+        self.call("/login_account", "POST", "/login_account", payload)
+
+    def games(self) -> None:
+        self.call("/games", "GET", "/games")
+
+    def session_pair(self, kind: str, username: str) -> None:
+        game = f"game_{random.randrange(10):03d}.zip"
+        status, body = self.call(
+            f"/start_session_{kind}",
+            "POST",
+            f"/start_session_{kind}",
+            {"username": username, "game_name": game},
+        )
+        if status != 200:
+            return
+        self.call(
+            f"/end_session_{kind}",
+            "POST",
+            f"/end_session_{kind}",
+            {"username": username, "game_name": game, "start_time": body["start_time"]},
+        )
+
+    def session_license(self) -> None:
+        self.session_pair("license", license_name(random.randrange(self.users)))
+
+    def session_account(self) -> None:
+        self.session_pair("account", account_name(random.randrange(self.users)))
+
+    def validate_batch(self) -> None:
+        items = []
+        for i in random.sample(range(self.users), min(self.batch_size, self.users)):
+            items.append({"username": license_name(i), "password": f"pw{i}", **hardware_for(i)})
+        self.call("/validate_batch", "POST", "/validate_batch", {"items": items})
+
+    def end_session_batch(self) -> None:
+        start_time = (datetime.utcnow() - timedelta(minutes=30)).isoformat()
+        sessions = []
+        for _ in range(self.batch_size):
+            kind = random.choice(("license", "account"))
+            i = random.randrange(self.users)
+            sessions.append(
+                {
+                    "kind": kind,
+                    "username": license_name(i) if kind == "license" else account_name(i),
+                    "game_name": f"game_{random.randrange(10):03d}.zip",
+                    "start_time": start_time,
+                }
+            )
+        self.call("/end_session_batch", "POST", "/end_session_batch", {"sessions": sessions})
+
+
+def fake_calls(fake_url: str) -> dict:
+    if not fake_url:
+        return {}
+    return requests.get(f"{fake_url}/_fake/stats", timeout=10).json()
+
+
+def run(client: LoadClient, mix: list, concurrency: int, duration: float, total: int) -> float:
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    deadline = time.perf_counter() + duration
+    issued = [0]
+    issued_lock = threading.Lock()
+
+    def worker() -> None:
+        while True:
+            with issued_lock:
+                if total and issued[0] >= total:
+                    return
+                if not total and time.perf_counter() >= deadline:
+                    return
+                issued[0] += 1
+            name = random.choices(names, weights)[0]
+            getattr(client, name)()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    return time.perf_counter() - started
+
+
+def report(stats: Stats, elapsed: float, upstream_before: dict, upstream_after: dict) -> None:
+    total_calls = sum(len(v) for v in stats.latencies.values())
+    print(f"{total_calls} HTTP calls in {elapsed:.1f}s ({total_calls / elapsed:.1f} req/s)")
+    print()
+    print(
+        f"{'route':<24}{'count':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}  statuses"
+    )
+    for route in sorted(stats.latencies):
+        values = stats.latencies[route]
+        statuses = ", ".join(f"{k}:{v}" for k, v in sorted(stats.statuses[route].items(), key=str))
+        print(
+            f"{route:<24}{len(values):>8}{len(values) / elapsed:>9.1f}"
+            f"{percentile(values, 50) * 1000:>9.1f}"
+            f"{percentile(values, 95) * 1000:>9.1f}"
+            f"{percentile(values, 99) * 1000:>9.1f}  {statuses}"
+        )
+
+    if not upstream_after:
+        return
+    delta = {
+        k: upstream_after.get(k, 0) - upstream_before.get(k, 0)
+        for k in upstream_after
+        if upstream_after.get(k, 0) != upstream_before.get(k, 0)
+    }
+    print()
+    print(
+        f"upstream calls: {delta.get('total', 0)} "
+        f"({delta.get('total', 0) / max(total_calls, 1):.2f} per request)"
+    )
+    for endpoint in sorted(delta):
+        if endpoint != "total":
+            print(f"  {endpoint:<32}{delta[endpoint]:>8}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay a request mix against the auth server")
+    parser.add_argument("--target", default="http://127.0.0.1:5000")
+    parser.add_argument(
+        "--fake", default="", help="fake_dropbox.py base URL, for seeding and upstream counts"
+    )
+    parser.add_argument(
+        "--seed", action="store_true", help="upload test licenses, accounts and catalog to --fake"
+    )
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--games", type=int, default=10, help="session entries per seeded record")
+    parser.add_argument("--catalog", type=int, default=50, help="zip files seeded into /elementos")
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help="weighted entries; validate_batch and end_session_batch are also available",
+    )
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument(
+        "--service-token", default="", help="BATCH_TOKEN of the target, for the batch routes"
+    )
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=0,
+        help="stop after this many mix entries instead of --duration",
+    )
+    parser.add_argument("--warmup", type=int, default=0, help="mix entries issued before measuring")
+    parser.add_argument(
+        "--per-route",
+        action="store_true",
+        help="also run each mix entry alone to attribute upstream calls",
+    )
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    fake_url = args.fake.rstrip("/")
+    if args.seed:
+        if not fake_url:
+            parser.error("--seed requires --fake")
+        seed_fake(fake_url, args.users, args.games, args.catalog)
+        print(f"Seeded {args.users} licenses, {args.users} accounts and {args.catalog} games")
+
+    mix = parse_mix(args.mix)
+
+    def client(stats: Stats) -> LoadClient:
+        return LoadClient(
+            args.target, args.users, stats, args.timeout, args.batch_size, args.service_token
+        )
+
+    if args.warmup:
+        warmup = client(Stats())
+        run(warmup, mix, args.concurrency, 0, args.warmup)
+
+    stats = Stats()
+    before = fake_calls(fake_url)
+    elapsed = run(
+        client(stats),
+        mix,
+        args.concurrency,
+        args.duration,
+        args.requests,
+    )
+    report(stats, elapsed, before, fake_calls(fake_url))
+
+    if args.per_route and fake_url:
+        print()
+        print(f"{'mix entry':<24}{'requests':>10}{'upstream':>10}{'per request':>13}")
+        per_route = max(args.requests // len(mix), 50) if args.requests else 200
+        for name, _ in mix:
+            route_stats = Stats()
+            before = fake_calls(fake_url)
+            run(
+                client(route_stats),
+                [(name, 1)],
+                args.concurrency,
+                0,
+                per_route,
+            )
+            upstream = fake_calls(fake_url).get("total", 0) - before.get("total", 0)
+            made = sum(len(v) for v in route_stats.latencies.values())
+            print(f"{name:<24}{made:>10}{upstream:>10}{upstream / max(made, 1):>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
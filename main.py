@@ -1,30 +1,399 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import time
 from datetime import datetime, timedelta
 import ast
+import atexit
+import base64
+import bisect
+import cProfile
+import contextlib
+import copy
+import fcntl
+import gzip
+import hashlib
+import hmac
 import threading
 import json
+import random
+import sqlite3
+import stat
+import sys
+import tempfile
+import logging
+import marshal
+import pstats
+import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.http import parse_accept_header, parse_etags
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
+log = logging.getLogger("auth")
+
+DROPBOX_AUTH_URL = os.environ.get("DROPBOX_AUTH_URL", "https://api.dropbox.com")
+DROPBOX_API_URL = os.environ.get("DROPBOX_API_URL", "https://api.dropboxapi.com")
+DROPBOX_CONTENT_URL = os.environ.get("DROPBOX_CONTENT_URL", "https://content.dropboxapi.com")
+DROPBOX_NOTIFY_URL = os.environ.get("DROPBOX_NOTIFY_URL", "https://notify.dropboxapi.com")
 
-access_token = None
-access_token_time = None
 server_start_time = time.time()
 
-refresh_token = os.environ["REFRESH_TOKEN"]
-app_key = os.environ["APP_KEY"]
-app_secret = os.environ["APP_SECRET"]
+storage_backend = os.environ.get("STORAGE_BACKEND", "dropbox").lower()
+
+refresh_token = os.environ.get("REFRESH_TOKEN", "")
+app_key = os.environ.get("APP_KEY", "")
+app_secret = os.environ.get("APP_SECRET", "")
 
 self_base_url = os.environ.get("SELF_BASE_URL", "https://auth-clco.onrender.com")
 
+keepalive_enabled = os.environ.get("KEEPALIVE_ENABLED", "false").lower() == "true"
 keepalive_interval = int(os.environ.get("KEEPALIVE_INTERVAL", 60))
-keepalive_running = True
+
+admin_token = os.environ.get("ADMIN_TOKEN", "")
+
+stats_max_age = float(os.environ.get("STATS_MAX_AGE", 300))
+
+record_format = os.environ.get("RECORD_FORMAT", "text").lower()
 
 username_registry_path = os.environ.get(
     "USERNAME_REGISTRY_PATH", "/accounts/_usernames.json"
 )
+username_registry_shard_dir = os.environ.get("USERNAME_REGISTRY_SHARD_DIR", "/accounts/_usernames")
+
+metrics_token = os.environ.get("METRICS_TOKEN", "")
+batch_token = os.environ.get("BATCH_TOKEN", "")
+
+
+def private_state_dir() -> str:
+    path = os.path.join(tempfile.gettempdir(), f"auth-{os.getuid()}")
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise RuntimeError(f"{path} must be a directory private to uid {os.getuid()}")
+    return path
+
+
+shared_cache_path = os.environ.get("SHARED_CACHE_PATH")
+if shared_cache_path is None:
+    shared_cache_path = (
+        "" if storage_backend == "memory" else os.path.join(private_state_dir(), "cache.sqlite3")
+    )
+
+storage_mirror_path = os.environ.get("STORAGE_MIRROR_PATH", "")
+
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DROPBOX_OPERATIONS = {
+    "oauth2/token": "token",
+    "2/files/download": "download",
+    "2/files/upload": "upload",
+    "2/files/list_folder": "list",
+    "2/files/list_folder/continue": "list",
+    "2/files/list_folder/longpoll": "longpoll",
+    "2/files/get_temporary_link": "link",
+    "2/files/get_metadata": "metadata",
+    "2/files/move_v2": "move",
+}
+
+
+class Metrics:
+    def __init__(self, enabled=True, buckets=METRIC_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.local = threading.local()
+        self.shards_lock = threading.Lock()
+        self.shards = []
+        self.retired = {"counters": {}, "histograms": {}}
+        self.kinds = {}
+
+    def define(self, name: str, kind: str, help_text: str) -> None:
+        self.kinds[name] = (kind, help_text)
+
+    def _shard(self) -> dict:
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = {"counters": {}, "histograms": {}}
+            self.local.shard = shard
+            with self.shards_lock:
+                if len(self.shards) >= 64:
+                    self._retire_dead()
+                self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _merge(self, into: dict, shard: dict) -> None:
+        counters = into["counters"]
+        for key, value in list(shard["counters"].items()):
+            counters[key] = counters.get(key, 0) + value
+        histograms = into["histograms"]
+        for key, values in list(shard["histograms"].items()):
+            merged = histograms.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, value in enumerate(list(values)):
+                merged[i] += value
+
+    def _retire_dead(self) -> None:
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge(self.retired, shard)
+        self.shards = alive
+
+    def inc(self, name: str, value=1, **labels) -> None:
+        if not self.enabled:
+            return
+        counters = self._shard()["counters"]
+        key = (name, tuple(labels.items()))
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        if not self.enabled:
+            return
+        histograms = self._shard()["histograms"]
+        key = (name, tuple(labels.items()))
+        values = histograms.get(key)
+        if values is None:
+            values = histograms[key] = [0] * (len(self.buckets) + 2)
+        values[bisect.bisect_left(self.buckets, seconds)] += 1
+        values[-1] += seconds
+
+    def snapshot(self) -> dict:
+        total = {"counters": {}, "histograms": {}}
+        with self.shards_lock:
+            self._retire_dead()
+            self._merge(total, self.retired)
+            for _, shard in self.shards:
+                self._merge(total, shard)
+        return total
+
+    def counter_value(self, snapshot: dict, name: str, **labels) -> float:
+        wanted = set(labels.items())
+        return sum(
+            value
+            for (metric, key), value in snapshot["counters"].items()
+            if metric == name and wanted <= set(key)
+        )
+
+    def render(self, gauges=(), snapshot: dict = None) -> str:
+        snapshot = snapshot or self.snapshot()
+        series = {}
+        for (name, labels), value in sorted(snapshot["counters"].items()):
+            series.setdefault(name, []).append(
+                f"{name}{_format_labels(labels)} {_format_value(value)}"
+            )
+        for (name, labels), values in sorted(snapshot["histograms"].items()):
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values[:-1]):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format_value(bound)
+                lines.append(
+                    f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}"
+                )
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(values[-1])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        for name, labels, value in gauges:
+            series.setdefault(name, []).append(
+                f"{name}{_format_labels(tuple(labels.items()))} {_format_value(value)}"
+            )
+
+        out = []
+        for name in sorted(series):
+            kind, help_text = self.kinds.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(series[name])
+        return "\n".join(out) + "\n"
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{k}="{v}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def dropbox_operation(url: str) -> str:
+    path = url.split("://", 1)[-1].split("/", 1)[-1]
+    return DROPBOX_OPERATIONS.get(path, path)
+
+
+metrics = Metrics(enabled=os.environ.get("METRICS_ENABLED", "true").lower() == "true")
+metrics.define("auth_http_requests_total", "counter", "HTTP requests by route, method and status")
+metrics.define(
+    "auth_http_request_duration_seconds", "histogram", "HTTP request latency by route"
+)
+metrics.define("auth_http_requests_in_flight", "gauge", "HTTP requests currently being served")
+metrics.define(
+    "auth_dropbox_requests_total", "counter", "Dropbox API calls by operation and status"
+)
+metrics.define(
+    "auth_dropbox_request_duration_seconds", "histogram", "Dropbox API call latency by operation"
+)
+metrics.define("auth_dropbox_retries_total", "counter", "Dropbox API calls retried by operation")
+metrics.define(
+    "auth_dropbox_short_circuits_total", "counter", "Dropbox API calls refused by an open breaker"
+)
+metrics.define("auth_dropbox_breaker_open", "gauge", "1 while the breaker for an operation is open")
+metrics.define(
+    "auth_record_conflicts_total", "counter", "Record writes rejected by a newer revision"
+)
+metrics.define(
+    "auth_coalesced_calls_total", "counter", "Callers that joined an in-flight upstream read"
+)
+metrics.define("auth_session_tokens_total", "counter", "Session tokens issued and verified")
+metrics.define("auth_cache_requests_total", "counter", "Cache lookups by cache and result")
+metrics.define("auth_cache_hit_ratio", "gauge", "Share of cache lookups served without a fetch")
+metrics.define("auth_cache_entries", "gauge", "Entries currently held by each cache")
+metrics.define("auth_session_journal_pending", "gauge", "Session events waiting to be flushed")
+metrics.define(
+    "auth_mirror_replicated_total", "counter", "Mirror changes replicated by direction and op"
+)
+metrics.define("auth_mirror_merges_total", "counter", "Mirror pushes merged with a Dropbox edit")
+metrics.define(
+    "auth_mirror_parked_total", "counter", "Mirror changes Dropbox rejected for good, by op"
+)
+metrics.define("auth_mirror_outbox", "gauge", "Mirror changes waiting to be pushed")
+metrics.define("auth_mirror_dirty", "gauge", "Mirrored files with changes not yet in Dropbox")
+metrics.define("auth_mirror_parked", "gauge", "Mirror changes parked after a permanent error")
+metrics.define("auth_uptime_seconds", "gauge", "Seconds since the process started")
+
+
+class RequestProfiler:
+    def __init__(self, sample_rate=0.0, interval=0.005):
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.profile_lock = threading.Lock()
+        self.active = {}
+        self.sampling = False
+        self.requests = {}
+        self.stacks = {}
+        self.stats = {}
+
+    def should_profile(self, forced=False) -> bool:
+        return forced or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def start(self, route: str):
+        with self.lock:
+            self.active[threading.get_ident()] = route
+            if not self.sampling:
+                self.sampling = True
+                threading.Thread(target=self._sample, name="request-profiler", daemon=True).start()
+        # Since Python 3.12 only one cProfile can be enabled per process; overlapping
+        # requests get stack samples only.
+        if not self.profile_lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            self.profile_lock.release()
+            return None
+        return profile
+
+    def stop(self, route: str, profile) -> None:
+        if profile is not None:
+            profile.disable()
+            self.profile_lock.release()
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+            self.requests[route] = self.requests.get(route, 0) + 1
+            if profile is None:
+                return
+            if route in self.stats:
+                self.stats[route].add(profile)
+            else:
+                self.stats[route] = pstats.Stats(profile)
+
+    def _sample(self) -> None:
+        while True:
+            with self.lock:
+                if not self.active:
+                    self.sampling = False
+                    return
+                active = dict(self.active)
+            frames = sys._current_frames()
+            for ident, route in active.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    filename = os.path.basename(code.co_filename)
+                    names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack = ";".join(reversed(names))
+                with self.lock:
+                    stacks = self.stacks.setdefault(route, {})
+                    stacks[stack] = stacks.get(stack, 0) + 1
+            del frames
+            time.sleep(self.interval)
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "sample_rate": self.sample_rate,
+                "interval_ms": self.interval * 1000,
+                "routes": {
+                    route: {
+                        "requests": count,
+                        "samples": sum(self.stacks.get(route, {}).values()),
+                    }
+                    for route, count in self.requests.items()
+                },
+            }
+
+    def collapsed(self, route: str = None) -> str:
+        with self.lock:
+            routes = [route] if route else list(self.stacks)
+            lines = [
+                f"{name};{stack} {count}"
+                for name in routes
+                for stack, count in self.stacks.get(name, {}).items()
+            ]
+        return "\n".join(sorted(lines)) + "\n"
+
+    def merged_stats(self, route: str = None):
+        with self.lock:
+            if route:
+                selected = [self.stats[route]] if route in self.stats else []
+            else:
+                selected = list(self.stats.values())
+            if not selected:
+                return None
+            merged = pstats.Stats()
+            merged.add(*selected)
+        return merged
+
+    def reset(self) -> None:
+        with self.lock:
+            self.requests.clear()
+            self.stacks.clear()
+            self.stats.clear()
+
+
+profiler = RequestProfiler(
+    sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", 0)),
+    interval=float(os.environ.get("PROFILE_INTERVAL_MS", 5)) / 1000,
+)
 
 
 def get_uptime():
@@ -35,14 +404,235 @@ def get_uptime():
     return f"{horas}h {minutos}m {segundos}s"
 
 
-def get_access_token():
-    global access_token, access_token_time
+class SQLiteDatabase:
+    def __init__(self, path: str, synchronous="NORMAL"):
+        self.path = path
+        self.synchronous = synchronous
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+        self._create_private()
+
+    def _create_private(self) -> None:
+        # The database holds records and the Dropbox token. Create it 0600 before SQLite
+        # opens it (the -wal and -shm files copy its mode) and refuse files, or links,
+        # that another user could have planted.
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            st = os.fstat(fd)
+            if st.st_uid != os.getuid():
+                raise RuntimeError(f"{self.path} is owned by uid {st.st_uid}, not {os.getuid()}")
+            if st.st_mode & 0o077:
+                os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+        for suffix in ("-wal", "-shm"):
+            try:
+                st = os.lstat(self.path + suffix)
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid():
+                raise RuntimeError(f"{self.path}{suffix} is not a file owned by uid {os.getuid()}")
+            if st.st_mode & 0o077:
+                os.chmod(self.path + suffix, 0o600)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is not None and self.local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        self.local.conn = conn
+        self.local.pid = os.getpid()
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def setup(self, schema: str) -> sqlite3.Connection:
+        conn = self.connection()
+        conn.executescript(schema)
+        return conn
+
+
+class SharedStore:
+    def __init__(self, path: str, poll_interval=1.0, log_retention=600):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.log_retention = log_retention
+        self.db = SQLiteDatabase(path)
+        self.poll_lock = threading.Lock()
+        self.listeners = []
+        self.polled_at = 0.0
+        conn = self.db.setup(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                rev TEXT NOT NULL DEFAULT '',
+                fetched REAL NOT NULL DEFAULT 0,
+                validated REAL NOT NULL DEFAULT 0,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS invalidations (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT NOT NULL,
+                origin INTEGER NOT NULL,
+                created REAL NOT NULL
+            );
+            """
+        )
+        self.seen = self._latest_seq(conn)
+
+    def _latest_seq(self, conn: sqlite3.Connection) -> int:
+        row = conn.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'invalidations'"
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _write(self, *statements) -> bool:
+        try:
+            with self.db.transaction() as conn:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+        except sqlite3.Error:
+            log.warning("Shared cache write failed", exc_info=True)
+            return False
+        return True
+
+    def get(self, key: str):
+        try:
+            row = self.db.connection().execute(
+                "SELECT value, rev, fetched, validated, expires_at FROM entries WHERE key = ?",
+                (key,),
+            ).fetchone()
+        except sqlite3.Error:
+            log.warning("Shared cache read failed", exc_info=True)
+            row = None
+        if row is None or row[4] < time.time():
+            metrics.inc("auth_cache_requests_total", cache="shared", result="miss")
+            return None
+        metrics.inc("auth_cache_requests_total", cache="shared", result="hit")
+        return {
+            "value": row[0],
+            "rev": row[1],
+            "fetched": row[2],
+            "validated": row[3],
+            "expires_at": row[4],
+        }
+
+    def set(
+        self,
+        key: str,
+        value: str,
+        expires_at: float,
+        rev="",
+        fetched=0.0,
+        validated=0.0,
+        notify=False,
+    ):
+        statements = [
+            (
+                "INSERT OR REPLACE INTO entries (key, value, rev, fetched, validated, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, value, rev, fetched, validated, expires_at),
+            )
+        ]
+        if notify:
+            statements.append(self._log_statement(key))
+        self._write(*statements)
+
+    def touch(self, key: str, rev: str, validated: float) -> None:
+        self._write(
+            (
+                "UPDATE entries SET validated = MAX(validated, ?) WHERE key = ? AND rev = ?",
+                (validated, key, rev),
+            )
+        )
+
+    def invalidate(self, key: str) -> None:
+        # A key ending in ":" names a whole namespace, e.g. "record:".
+        if key.endswith(":"):
+            delete = ("DELETE FROM entries WHERE substr(key, 1, ?) = ?", (len(key), key))
+        else:
+            delete = ("DELETE FROM entries WHERE key = ?", (key,))
+        self._write(delete, self._log_statement(key))
+
+    def _log_statement(self, key: str):
+        return (
+            "INSERT INTO invalidations (key, origin, created) VALUES (?, ?, ?)",
+            (key, os.getpid(), time.time()),
+        )
+
+    def subscribe(self, prefix: str, callback) -> None:
+        self.listeners.append((prefix, callback))
 
-    if access_token and (datetime.now() - access_token_time).seconds < 14400:
-        return access_token
+    def poll(self, force=False) -> None:
+        now = time.time()
+        if not force and now - self.polled_at < self.poll_interval:
+            return
+        if not self.poll_lock.acquire(blocking=False):
+            return
+        try:
+            self.polled_at = now
+            conn = self.db.connection()
+            latest = self._latest_seq(conn)
+            if latest <= self.seen:
+                return
+            rows = conn.execute(
+                "SELECT seq, key, origin FROM invalidations WHERE seq > ? ORDER BY seq",
+                (self.seen,),
+            ).fetchall()
+            if not rows or rows[0][0] > self.seen + 1:
+                log.warning("Shared cache invalidations were pruned; clearing local caches")
+                rows = [(latest, prefix, 0) for prefix, _ in self.listeners]
+            pid = os.getpid()
+            for _, key, origin in rows:
+                if origin == pid:
+                    continue
+                for prefix, callback in self.listeners:
+                    if key.startswith(prefix):
+                        callback(key[len(prefix):])
+            self.seen = max(latest, rows[-1][0])
+        except sqlite3.Error:
+            log.warning("Shared cache poll failed", exc_info=True)
+        finally:
+            self.poll_lock.release()
+
+    @contextlib.contextmanager
+    def locked(self, name: str):
+        with open(f"{self.path}.{name}.lock", "a") as fh:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def prune(self) -> None:
+        now = time.time()
+        self._write(
+            ("DELETE FROM entries WHERE expires_at < ?", (now,)),
+            ("DELETE FROM invalidations WHERE created < ?", (now - self.log_retention,)),
+        )
 
-    r = requests.post(
-        "https://api.dropbox.com/oauth2/token",
+
+shared = None
+if shared_cache_path:
+    shared = SharedStore(
+        shared_cache_path,
+        poll_interval=float(os.environ.get("SHARED_CACHE_POLL_INTERVAL", 1)),
+        log_retention=float(os.environ.get("SHARED_CACHE_LOG_RETENTION", 600)),
+    )
+
+
+def fetch_access_token():
+    r = dropbox.post(
+        f"{DROPBOX_AUTH_URL}/oauth2/token",
         data={
             "grant_type": "refresh_token",
             "refresh_token": refresh_token,
@@ -52,313 +642,3157 @@ def get_access_token():
     )
     r.raise_for_status()
 
-    access_token = r.json()["access_token"]
-    access_token_time = datetime.now()
-    return access_token
+    data = r.json()
+    return data["access_token"], int(data.get("expires_in", 14400))
+
+
+class TokenManager:
+    def __init__(self, fetch, refresh_margin=600, shared: SharedStore = None):
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.shared = shared
+        self.refresh_lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0.0
+
+    def get(self) -> str:
+        token, expires_at = self.token, self.expires_at
+        if token and time.time() < expires_at - 30:
+            metrics.inc("auth_cache_requests_total", cache="token", result="hit")
+            return token
+        if self._adopt_shared():
+            metrics.inc("auth_cache_requests_total", cache="token", result="shared")
+            return self.token
+        metrics.inc("auth_cache_requests_total", cache="token", result="miss")
+        return self.refresh(stale=token)
+
+    def _adopt_shared(self) -> bool:
+        if self.shared is None:
+            return False
+        item = self.shared.get("token")
+        if item and item["expires_at"] > self.expires_at:
+            self.token = item["value"]
+            self.expires_at = item["expires_at"]
+        return bool(self.token) and time.time() < self.expires_at - 30
+
+    def refresh(self, stale: str = None) -> str:
+        host_lock = self.shared.locked("token") if self.shared else contextlib.nullcontext()
+        with self.refresh_lock, host_lock:
+            self._adopt_shared()
+            if (
+                self.token
+                and self.token != stale
+                and time.time() < self.expires_at - self.refresh_margin
+            ):
+                return self.token
+
+            token, expires_in = self.fetch()
+            self.token = token
+            self.expires_at = time.time() + expires_in
+            if self.shared is not None:
+                self.shared.set("token", token, self.expires_at)
+        return token
+
+    def refresh_due(self) -> None:
+        if self.token and time.time() >= self.expires_at - self.refresh_margin:
+            self.refresh(stale=self.token)
+
+
+tokens = TokenManager(
+    fetch_access_token,
+    refresh_margin=int(os.environ.get("TOKEN_REFRESH_MARGIN", 600)),
+    shared=shared,
+)
+
 
+def get_access_token():
+    return tokens.get()
+
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+NON_IDEMPOTENT_OPERATIONS = ("move",)
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.failures < self.threshold:
+                return True
+            if self.probing or time.time() - self.opened_at < self.cooldown:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+    def record_throttled(self) -> None:
+        with self.lock:
+            self.probing = False
+
+    def release(self) -> None:
+        with self.lock:
+            self.probing = False
+
+    def state(self) -> str:
+        with self.lock:
+            if self.failures < self.threshold:
+                return "closed"
+            if self.probing or time.time() - self.opened_at >= self.cooldown:
+                return "half_open"
+            return "open"
+
+
+class UpstreamPolicy:
+    def __init__(
+        self,
+        max_attempts=3,
+        base_delay=0.2,
+        max_delay=5.0,
+        budget=10.0,
+        breaker_threshold=5,
+        breaker_cooldown=30.0,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.lock = threading.Lock()
+        self.breakers = {}
+
+    def breaker(self, operation: str) -> CircuitBreaker:
+        breaker = self.breakers.get(operation)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(
+                    operation, CircuitBreaker(self.breaker_threshold, self.breaker_cooldown)
+                )
+        return breaker
+
+    def retryable(
+        self, operation: str, status: int = None, connect_error=False, idempotent=True
+    ) -> bool:
+        if idempotent and operation not in NON_IDEMPOTENT_OPERATIONS:
+            return True
+        return connect_error or status in (429, 503)
+
+    def retry_delay(self, attempt: int, retry_after, elapsed: float):
+        if attempt + 1 >= self.max_attempts:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if elapsed + delay > self.budget:
+            return None
+        return delay
+
+    def states(self) -> dict:
+        with self.lock:
+            breakers = list(self.breakers.items())
+        return {operation: breaker.state() for operation, breaker in breakers}
+
+
+def parse_retry_after(value: str):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+upstream = UpstreamPolicy(
+    max_attempts=int(os.environ.get("DROPBOX_MAX_ATTEMPTS", 3)),
+    base_delay=float(os.environ.get("DROPBOX_RETRY_BASE_DELAY", 0.2)),
+    max_delay=float(os.environ.get("DROPBOX_RETRY_MAX_DELAY", 5)),
+    budget=float(os.environ.get("DROPBOX_RETRY_BUDGET", 10)),
+    breaker_threshold=int(os.environ.get("DROPBOX_BREAKER_THRESHOLD", 5)),
+    breaker_cooldown=float(os.environ.get("DROPBOX_BREAKER_COOLDOWN", 30)),
+)
 
-def download_license(username: str) -> str:
-    token = get_access_token()
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Dropbox-API-Arg": f'{{"path": "/licenses/{username}.txt"}}',
-    }
 
-    r = requests.post(
-        "https://content.dropboxapi.com/2/files/download",
-        headers=headers,
+class DropboxClient:
+    def __init__(self, pool_size=10, connect_timeout=5.0, read_timeout=30.0):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        for base_url in (
+            DROPBOX_AUTH_URL,
+            DROPBOX_API_URL,
+            DROPBOX_CONTENT_URL,
+            DROPBOX_NOTIFY_URL,
+        ):
+            self.session.mount(
+                base_url + "/",
+                HTTPAdapter(pool_connections=1, pool_maxsize=pool_size),
+            )
+
+    def _send(self, url: str, operation: str, **kwargs) -> requests.Response:
+        status = "error"
+        started = time.perf_counter()
+        try:
+            r = self.session.post(url, **kwargs)
+            status = str(r.status_code)
+            return r
+        finally:
+            metrics.observe(
+                "auth_dropbox_request_duration_seconds",
+                time.perf_counter() - started,
+                operation=operation,
+            )
+            metrics.inc("auth_dropbox_requests_total", operation=operation, status=status)
+
+    def post(self, url: str, idempotent=True, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        operation = dropbox_operation(url)
+        breaker = upstream.breaker(operation)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                metrics.inc("auth_dropbox_short_circuits_total", operation=operation)
+                raise UpstreamUnavailable(f"Dropbox {operation}: circuit open")
+            try:
+                r = self._send(url, operation, **kwargs)
+            except requests.RequestException as e:
+                breaker.record_failure()
+                error = e
+                retry_after = None
+                retryable = upstream.retryable(
+                    operation,
+                    connect_error=isinstance(e, requests.ConnectTimeout),
+                    idempotent=idempotent,
+                )
+            else:
+                if r.status_code not in RETRYABLE_STATUSES:
+                    breaker.record_success()
+                    return r
+                if r.status_code == 429:
+                    breaker.record_throttled()
+                else:
+                    breaker.record_failure()
+                error = None
+                retry_after = parse_retry_after(r.headers.get("Retry-After"))
+                retryable = upstream.retryable(
+                    operation, status=r.status_code, idempotent=idempotent
+                )
+            finally:
+                # A probe that ended in anything unexpected must not keep the breaker open.
+                breaker.release()
+
+            delay = None
+            if retryable:
+                delay = upstream.retry_delay(attempt, retry_after, time.monotonic() - started)
+            if delay is None:
+                detail = type(error).__name__ if error else f"HTTP {r.status_code}"
+                raise UpstreamUnavailable(f"Dropbox {operation}: {detail}") from error
+            metrics.inc("auth_dropbox_retries_total", operation=operation)
+            time.sleep(delay)
+            attempt += 1
+
+    def authorized_post(self, url: str, headers: dict = None, **kwargs) -> requests.Response:
+        token = tokens.get()
+        r = self.post(
+            url, headers={"Authorization": f"Bearer {token}", **(headers or {})}, **kwargs
+        )
+        if r.status_code == 401:
+            token = tokens.refresh(stale=token)
+            r = self.post(
+                url, headers={"Authorization": f"Bearer {token}", **(headers or {})}, **kwargs
+            )
+        r.raise_for_status()
+        return r
+
+    def rpc(self, endpoint: str, payload: dict) -> dict:
+        r = self.authorized_post(
+            f"{DROPBOX_API_URL}/2/{endpoint}",
+            headers={"Content-Type": "application/json"},
+            json=payload,
+        )
+        return r.json()
+
+    def longpoll(self, cursor: str, timeout: int = 30) -> dict:
+        r = self.post(
+            f"{DROPBOX_NOTIFY_URL}/2/files/list_folder/longpoll",
+            json={"cursor": cursor, "timeout": timeout},
+            timeout=(self.timeout[0], timeout + 90),
+        )
+        r.raise_for_status()
+        return r.json()
+
+    def download(self, path: str) -> requests.Response:
+        return self.authorized_post(
+            f"{DROPBOX_CONTENT_URL}/2/files/download",
+            headers={"Dropbox-API-Arg": json.dumps({"path": path})},
+        )
+
+    def upload(self, path: str, content: bytes, mode="overwrite") -> dict:
+        r = self.authorized_post(
+            f"{DROPBOX_CONTENT_URL}/2/files/upload",
+            headers={
+                "Dropbox-API-Arg": json.dumps({"path": path, "mode": mode}),
+                "Content-Type": "application/octet-stream",
+            },
+            data=content,
+            idempotent=mode == "overwrite",
+        )
+        return r.json()
+
+
+dropbox = DropboxClient(
+    pool_size=int(os.environ.get("DROPBOX_POOL_SIZE", 10)),
+    connect_timeout=float(os.environ.get("DROPBOX_CONNECT_TIMEOUT", 5)),
+    read_timeout=float(os.environ.get("DROPBOX_READ_TIMEOUT", 30)),
+)
+
+
+class StorageNotFound(Exception):
+    pass
+
+
+class StorageConflict(Exception):
+    pass
+
+
+class Storage:
+    def get(self, path: str):
+        raise NotImplementedError
+
+    def put(self, path: str, content: str, rev: str = None, create=False) -> str:
+        raise NotImplementedError
+
+    def move(self, from_path: str, to_path: str) -> None:
+        raise NotImplementedError
+
+    def list(self, folder_path: str) -> list:
+        raise NotImplementedError
+
+    def list_changes(self, folder_path: str, cursor: str = None) -> dict:
+        return {
+            "entries": self.list(folder_path),
+            "deleted": [],
+            "cursor": None,
+            "reset": True,
+        }
+
+    def wait_for_changes(self, cursor: str, timeout: int = 30):
+        raise NotImplementedError
+
+    def metadata(self, path: str):
+        raise NotImplementedError
+
+    def temporary_link(self, path: str) -> str:
+        raise NotImplementedError
+
+    def exists(self, path: str) -> bool:
+        return self.metadata(path) is not None
+
+
+def _dropbox_not_found(e: requests.HTTPError) -> bool:
+    r = e.response
+    return r is not None and r.status_code == 409 and "not_found" in r.text
+
+
+def _dropbox_conflict(e: requests.HTTPError) -> bool:
+    r = e.response
+    return r is not None and r.status_code == 409 and "conflict" in r.text
+
+
+def _dropbox_permanent(e: Exception) -> bool:
+    # Client errors other than auth, throttling and conflicts fail the same way on retry.
+    r = getattr(e, "response", None)
+    return (
+        isinstance(e, requests.HTTPError)
+        and r is not None
+        and 400 <= r.status_code < 500
+        and r.status_code not in (401, 403, 429)
+        and not _dropbox_conflict(e)
     )
-    r.raise_for_status()
-    return r.text
 
 
-def upload_license(username: str, content: str) -> bool:
-    token = get_access_token()
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Dropbox-API-Arg": f'{{"path": "/licenses/{username}.txt", "mode": "overwrite"}}',
-        "Content-Type": "application/octet-stream",
+def upload_mode(rev: str = None, create=False):
+    if rev:
+        return {".tag": "update", "update": rev}
+    return "add" if create else "overwrite"
+
+
+def _dropbox_entry(f: dict) -> dict:
+    return {
+        "name": f.get("name"),
+        "path": f.get("path_lower"),
+        "rev": f.get("rev"),
+        "size": f.get("size", 0),
     }
 
-    r = requests.post(
-        "https://content.dropboxapi.com/2/files/upload",
-        headers=headers,
-        data=content.encode(),
+
+class DropboxStorage(Storage):
+    def __init__(self, client: DropboxClient):
+        self.client = client
+
+    def get(self, path: str):
+        try:
+            r = self.client.download(path)
+        except requests.HTTPError as e:
+            if _dropbox_not_found(e):
+                raise StorageNotFound(path) from e
+            raise
+        meta = json.loads(r.headers.get("Dropbox-API-Result", "{}"))
+        return r.text, meta.get("rev")
+
+    def put(self, path: str, content: str, rev: str = None, create=False) -> str:
+        mode = upload_mode(rev, create)
+        try:
+            return self.client.upload(path, content.encode("utf-8"), mode=mode).get("rev")
+        except requests.HTTPError as e:
+            if (rev or create) and _dropbox_conflict(e):
+                raise StorageConflict(path) from e
+            raise
+
+    def move(self, from_path: str, to_path: str) -> None:
+        try:
+            self.client.rpc(
+                "files/move_v2",
+                {
+                    "from_path": from_path,
+                    "to_path": to_path,
+                    "autorename": False,
+                    "allow_shared_folder": False,
+                    "allow_ownership_transfer": False,
+                },
+            )
+        except requests.HTTPError as e:
+            if _dropbox_not_found(e):
+                raise StorageNotFound(from_path) from e
+            if _dropbox_conflict(e):
+                raise FileExistsError(to_path) from e
+            raise
+
+    def list(self, folder_path: str) -> list:
+        return self.list_changes(folder_path)["entries"]
+
+    def list_changes(self, folder_path: str, cursor: str = None) -> dict:
+        reset = cursor is None
+        try:
+            if reset:
+                listing = self.client.rpc(
+                    "files/list_folder",
+                    {
+                        "path": folder_path,
+                        "recursive": False,
+                        "include_deleted": False,
+                    },
+                )
+            else:
+                listing = self.client.rpc("files/list_folder/continue", {"cursor": cursor})
+        except requests.HTTPError as e:
+            r = e.response
+            if not reset and r is not None and r.status_code == 409 and "reset" in r.text:
+                return self.list_changes(folder_path)
+            if _dropbox_not_found(e):
+                raise StorageNotFound(folder_path) from e
+            raise
+
+        entries = []
+        deleted = []
+        while True:
+            for f in listing.get("entries", []):
+                if f.get(".tag") == "file":
+                    entries.append(_dropbox_entry(f))
+                elif f.get(".tag") == "deleted":
+                    deleted.append(f.get("path_lower"))
+            if not listing.get("has_more"):
+                break
+            listing = self.client.rpc(
+                "files/list_folder/continue", {"cursor": listing["cursor"]}
+            )
+
+        return {
+            "entries": entries,
+            "deleted": deleted,
+            "cursor": listing.get("cursor"),
+            "reset": reset,
+        }
+
+    def wait_for_changes(self, cursor: str, timeout: int = 30):
+        result = self.client.longpoll(cursor, timeout)
+        return bool(result.get("changes")), int(result.get("backoff", 0))
+
+    def metadata(self, path: str):
+        try:
+            f = self.client.rpc("files/get_metadata", {"path": path})
+        except requests.HTTPError as e:
+            if _dropbox_not_found(e):
+                return None
+            raise
+        if f.get(".tag") != "file":
+            return None
+        return _dropbox_entry(f)
+
+    def temporary_link(self, path: str) -> str:
+        return self.client.rpc("files/get_temporary_link", {"path": path}).get("link")
+
+
+class LocalStorage(Storage):
+    def __init__(self, root: str, base_url: str = ""):
+        self.root = os.path.abspath(root)
+        self.base_url = base_url.rstrip("/")
+
+    def _full_path(self, path: str) -> str:
+        full = os.path.abspath(os.path.join(self.root, path.lstrip("/")))
+        if full != self.root and not full.startswith(self.root + os.sep):
+            raise StorageNotFound(path)
+        return full
+
+    def _entry(self, path: str, full: str) -> dict:
+        st = os.stat(full)
+        return {
+            "name": os.path.basename(full),
+            "path": path.lower(),
+            "rev": f"{st.st_mtime_ns:x}{st.st_size:x}",
+            "size": st.st_size,
+        }
+
+    def get(self, path: str):
+        full = self._full_path(path)
+        try:
+            with open(full, "r", encoding="utf-8") as fh:
+                content = fh.read()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError) as e:
+            raise StorageNotFound(path) from e
+        return content, self._entry(path, full)["rev"]
+
+    def put(self, path: str, content: str, rev: str = None, create=False) -> str:
+        full = self._full_path(path)
+        folder = os.path.dirname(full)
+        os.makedirs(folder, exist_ok=True)
+        tmp = f"{full}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            fh.write(content)
+        fd = os.open(folder, os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if rev and (not os.path.isfile(full) or self._entry(path, full)["rev"] != rev):
+                os.remove(tmp)
+                raise StorageConflict(path)
+            if create and os.path.exists(full):
+                os.remove(tmp)
+                raise StorageConflict(path)
+            os.replace(tmp, full)
+            return self._entry(path, full)["rev"]
+        finally:
+            os.close(fd)
+
+    def move(self, from_path: str, to_path: str) -> None:
+        src = self._full_path(from_path)
+        dst = self._full_path(to_path)
+        if not os.path.isfile(src):
+            raise StorageNotFound(from_path)
+        if os.path.exists(dst):
+            raise FileExistsError(to_path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.rename(src, dst)
+
+    def list(self, folder_path: str) -> list:
+        full = self._full_path(folder_path)
+        try:
+            names = sorted(os.listdir(full))
+        except (FileNotFoundError, NotADirectoryError) as e:
+            raise StorageNotFound(folder_path) from e
+        folder = "/" + folder_path.strip("/")
+        return [
+            self._entry(f"{folder}/{name}", os.path.join(full, name))
+            for name in names
+            if os.path.isfile(os.path.join(full, name)) and not name.endswith(".tmp")
+        ]
+
+    def metadata(self, path: str):
+        full = self._full_path(path)
+        if not os.path.isfile(full):
+            return None
+        return self._entry(path, full)
+
+    def temporary_link(self, path: str) -> str:
+        if self.base_url:
+            return self.base_url + "/" + path.lstrip("/")
+        return "file://" + self._full_path(path)
+
+
+class MemoryStorage(Storage):
+    def __init__(self, seed_dir: str = ""):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.revision = 0
+        if seed_dir:
+            seed = LocalStorage(seed_dir)
+            for dirpath, _, names in os.walk(seed.root):
+                for name in names:
+                    rel = os.path.relpath(os.path.join(dirpath, name), seed.root)
+                    path = "/" + rel.replace(os.sep, "/")
+                    self.put(path, seed.get(path)[0])
+
+    def _entry(self, key: str, name: str, content: str, rev: str) -> dict:
+        return {"name": name, "path": key, "rev": rev, "size": len(content.encode("utf-8"))}
+
+    def get(self, path: str):
+        with self.lock:
+            item = self.files.get(path.lower())
+        if item is None:
+            raise StorageNotFound(path)
+        _, content, rev = item
+        return content, rev
+
+    def put(self, path: str, content: str, rev: str = None, create=False) -> str:
+        with self.lock:
+            current = self.files.get(path.lower())
+            if rev and (current is None or current[2] != rev):
+                raise StorageConflict(path)
+            if create and current is not None:
+                raise StorageConflict(path)
+            self.revision += 1
+            rev = f"{self.revision:09x}"
+            self.files[path.lower()] = (path.rsplit("/", 1)[-1], content, rev)
+        return rev
+
+    def move(self, from_path: str, to_path: str) -> None:
+        with self.lock:
+            item = self.files.get(from_path.lower())
+            if item is None:
+                raise StorageNotFound(from_path)
+            if to_path.lower() in self.files:
+                raise FileExistsError(to_path)
+            del self.files[from_path.lower()]
+            _, content, rev = item
+            self.files[to_path.lower()] = (to_path.rsplit("/", 1)[-1], content, rev)
+
+    def list(self, folder_path: str) -> list:
+        prefix = "/" + folder_path.strip("/").lower() + "/"
+        with self.lock:
+            items = sorted(self.files.items())
+        return [
+            self._entry(key, name, content, rev)
+            for key, (name, content, rev) in items
+            if key.startswith(prefix) and "/" not in key[len(prefix):]
+        ]
+
+    def metadata(self, path: str):
+        with self.lock:
+            item = self.files.get(path.lower())
+        if item is None:
+            return None
+        return self._entry(path.lower(), *item)
+
+    def temporary_link(self, path: str) -> str:
+        return "memory://" + path.lower()
+
+
+MIRROR_COLUMNS = ("display_path", "content", "rev", "base", "remote_rev", "dirty")
+
+
+class MirroredStorage(Storage):
+    def __init__(self, inner: Storage, path: str, folders=(), batch_size=100, concurrency=8):
+        self.inner = inner
+        self.folders = {"/" + f.strip("/").lower() for f in folders if f.strip("/")}
+        self.batch_size = batch_size
+        self.db = SQLiteDatabase(path, synchronous="FULL")
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="mirror")
+        self.ready_folders = set()
+        self.listeners = []
+        self.db.setup(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                folder TEXT NOT NULL,
+                display_path TEXT NOT NULL,
+                content TEXT,
+                rev TEXT NOT NULL,
+                base TEXT,
+                remote_rev TEXT,
+                remote_at REAL NOT NULL DEFAULT 0,
+                dirty INTEGER NOT NULL DEFAULT 0,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS files_folder ON files (folder);
+            CREATE TABLE IF NOT EXISTS outbox (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                op TEXT NOT NULL,
+                path TEXT NOT NULL,
+                to_path TEXT,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS folders (
+                folder TEXT PRIMARY KEY,
+                cursor TEXT,
+                pulled_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS parked (
+                seq INTEGER PRIMARY KEY,
+                op TEXT NOT NULL,
+                path TEXT NOT NULL,
+                to_path TEXT,
+                created REAL NOT NULL,
+                error TEXT NOT NULL,
+                parked_at REAL NOT NULL
+            );
+            """
+        )
+
+    def _folder(self, path: str) -> str:
+        return path.rpartition("/")[0].lower() or "/"
+
+    def _mirrored(self, path: str) -> bool:
+        return self._folder(path) in self.folders
+
+    def _ready(self, folder: str) -> bool:
+        if folder in self.ready_folders:
+            return True
+        row = self.db.connection().execute(
+            "SELECT 1 FROM folders WHERE folder = ?", (folder,)
+        ).fetchone()
+        if row:
+            self.ready_folders.add(folder)
+        return bool(row)
+
+    def _row(self, conn: sqlite3.Connection, key: str):
+        row = conn.execute(
+            f"SELECT {', '.join(MIRROR_COLUMNS)} FROM files WHERE path = ?", (key,)
+        ).fetchone()
+        return dict(zip(MIRROR_COLUMNS, row)) if row else None
+
+    def _local_row(self, path: str):
+        row = self._row(self.db.connection(), path.lower())
+        if row is None and not self._ready(self._folder(path)):
+            row = self._adopt(path)
+        return row
+
+    def _adopt(self, path: str):
+        # Read-through until the first pull of the folder has completed.
+        try:
+            content, remote_rev = self.inner.get(path)
+        except StorageNotFound:
+            return None
+        now = time.time()
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO files (path, folder, display_path, content, rev, base, "
+                "remote_rev, remote_at, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    path.lower(),
+                    self._folder(path),
+                    path,
+                    content,
+                    os.urandom(8).hex(),
+                    content,
+                    remote_rev,
+                    now,
+                    now,
+                ),
+            )
+            return self._row(conn, path.lower())
+
+    def _entry(self, key: str, row: dict) -> dict:
+        return {
+            "name": row["display_path"].rsplit("/", 1)[-1],
+            "path": key,
+            "rev": row["rev"],
+            "size": len(row["content"].encode("utf-8")),
+        }
+
+    def _enqueue(self, conn: sqlite3.Connection, op: str, key: str, to_key: str = None):
+        conn.execute(
+            "INSERT INTO outbox (op, path, to_path, created) VALUES (?, ?, ?, ?)",
+            (op, key, to_key, time.time()),
+        )
+
+    def subscribe(self, callback) -> None:
+        self.listeners.append(callback)
+
+    def _notify(self, path: str) -> None:
+        for callback in self.listeners:
+            callback(path)
+
+    def get(self, path: str):
+        if not self._mirrored(path):
+            return self.inner.get(path)
+        row = self._local_row(path)
+        if row is None or row["content"] is None:
+            raise StorageNotFound(path)
+        return row["content"], row["rev"]
+
+    def put(self, path: str, content: str, rev: str = None, create=False) -> str:
+        if not self._mirrored(path):
+            return self.inner.put(path, content, rev, create)
+        self._local_row(path)
+        key = path.lower()
+        new_rev = os.urandom(8).hex()
+        with self.db.transaction() as conn:
+            row = self._row(conn, key)
+            current = row["rev"] if row and row["content"] is not None else None
+            if (rev and current != rev) or (create and current is not None):
+                raise StorageConflict(path)
+            conn.execute(
+                "INSERT INTO files (path, folder, display_path, content, rev, dirty, updated) "
+                "VALUES (?, ?, ?, ?, ?, 1, ?) ON CONFLICT (path) DO UPDATE SET "
+                "content = excluded.content, rev = excluded.rev, dirty = 1, "
+                "updated = excluded.updated",
+                (key, self._folder(path), path, content, new_rev, time.time()),
+            )
+            self._enqueue(conn, "put", key)
+        return new_rev
+
+    def move(self, from_path: str, to_path: str) -> None:
+        if not (self._mirrored(from_path) and self._mirrored(to_path)):
+            return self.inner.move(from_path, to_path)
+        self._local_row(from_path)
+        self._local_row(to_path)
+        src_key, dst_key = from_path.lower(), to_path.lower()
+        now = time.time()
+        with self.db.transaction() as conn:
+            src = self._row(conn, src_key)
+            if src is None or src["content"] is None:
+                raise StorageNotFound(from_path)
+            dst = self._row(conn, dst_key)
+            if dst is not None and dst["content"] is not None:
+                raise FileExistsError(to_path)
+            conn.execute(
+                "INSERT OR REPLACE INTO files (path, folder, display_path, content, rev, dirty, "
+                "updated) VALUES (?, ?, ?, ?, ?, 1, ?)",
+                (dst_key, self._folder(to_path), to_path, src["content"], os.urandom(8).hex(), now),
+            )
+            conn.execute(
+                "UPDATE files SET content = NULL, rev = ?, dirty = 1, updated = ? WHERE path = ?",
+                (os.urandom(8).hex(), now, src_key),
+            )
+            self._enqueue(conn, "move", src_key, dst_key)
+            self._enqueue(conn, "put", dst_key)
+
+    def list(self, folder_path: str) -> list:
+        folder = "/" + folder_path.strip("/").lower()
+        if folder not in self.folders or not self._ready(folder):
+            return self.inner.list(folder_path)
+        rows = self.db.connection().execute(
+            f"SELECT path, {', '.join(MIRROR_COLUMNS)} FROM files "
+            "WHERE folder = ? AND content IS NOT NULL ORDER BY path",
+            (folder,),
+        ).fetchall()
+        return [self._entry(row[0], dict(zip(MIRROR_COLUMNS, row[1:]))) for row in rows]
+
+    def list_changes(self, folder_path: str, cursor: str = None) -> dict:
+        folder = "/" + folder_path.strip("/").lower()
+        if folder not in self.folders or not self._ready(folder):
+            return self.inner.list_changes(folder_path, cursor)
+        return super().list_changes(folder_path)
+
+    def metadata(self, path: str):
+        if not self._mirrored(path):
+            return self.inner.metadata(path)
+        row = self._local_row(path)
+        if row is None or row["content"] is None:
+            return None
+        return self._entry(path.lower(), row)
+
+    def wait_for_changes(self, cursor: str, timeout: int = 30):
+        # Mirrored folders list locally without a cursor; re-reading them is cheap.
+        if cursor is None:
+            time.sleep(timeout)
+            return True, 0
+        return self.inner.wait_for_changes(cursor, timeout)
+
+    def temporary_link(self, path: str) -> str:
+        return self.inner.temporary_link(path)
+
+    def push(self) -> int:
+        pushed = 0
+        while True:
+            batch = self._push_batch()
+            pushed += batch
+            if batch < self.batch_size:
+                return pushed
+
+    def _push_batch(self) -> int:
+        conn = self.db.connection()
+        ops = conn.execute(
+            "SELECT seq, op, path, to_path FROM outbox ORDER BY seq LIMIT ?", (self.batch_size,)
+        ).fetchall()
+        pending = list(ops)
+        while pending:
+            # Puts of different paths replicate in parallel; a rename waits for
+            # everything queued before it.
+            run = [pending.pop(0)]
+            while (
+                run[0][1] == "put"
+                and pending
+                and pending[0][1] == "put"
+                and all(op[2] != pending[0][2] for op in run)
+            ):
+                run.append(pending.pop(0))
+            list(self.executor.map(lambda op: self._push_op(*op), run))
+        return len(ops)
+
+    def _push_op(self, seq: int, op: str, key: str, to_key: str) -> None:
+        try:
+            if op == "move":
+                self._push_move(key, to_key)
+                done = ("DELETE FROM outbox WHERE seq = ?", (seq,))
+            else:
+                covered = self._push_put(key, seq)
+                done = (
+                    "DELETE FROM outbox WHERE op = 'put' AND path = ? AND seq <= ?",
+                    (key, covered),
+                )
+        except Exception as e:
+            if not _dropbox_permanent(e):
+                raise
+            self._park(op, key, seq, e)
+            return
+        with self.db.transaction() as conn:
+            conn.execute(*done)
+        metrics.inc("auth_mirror_replicated_total", direction="push", op=op)
+
+    def _park(self, op: str, key: str, seq: int, error: Exception) -> None:
+        # Keep the rejected change for inspection instead of retrying it on every push.
+        where = ("op = 'put' AND path = ?", (key,)) if op == "put" else ("seq = ?", (seq,))
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO parked (seq, op, path, to_path, created, error, "
+                "parked_at) SELECT seq, op, path, to_path, created, ?, ? FROM outbox "
+                f"WHERE {where[0]}",
+                (str(error), time.time(), *where[1]),
+            )
+            conn.execute(f"DELETE FROM outbox WHERE {where[0]}", where[1])
+            conn.execute("UPDATE files SET dirty = 0 WHERE path = ?", (key,))
+        metrics.inc("auth_mirror_parked_total", op=op)
+        log.error("Parked mirror %s of %s: Dropbox rejected it: %s", op, key, error)
+
+    def _push_put(self, key: str, seq: int) -> int:
+        conn = self.db.connection()
+        # Every put queued up to here is already folded into the row read below, except
+        # those past the next rename of this path.
+        covered = conn.execute(
+            "SELECT MAX(seq) FROM outbox WHERE op = 'put' AND path = ?", (key,)
+        ).fetchone()[0]
+        next_move = conn.execute(
+            "SELECT MIN(seq) FROM outbox WHERE op = 'move' AND seq > ? "
+            "AND (path = ? OR to_path = ?)",
+            (seq, key, key),
+        ).fetchone()[0]
+        if next_move is not None:
+            covered = min(covered, next_move - 1)
+        row = self._row(conn, key)
+        if row is None or row["content"] is None or not row["dirty"]:
+            return covered
+
+        path, content, remote_rev = row["display_path"], row["content"], row["remote_rev"]
+        if not remote_rev or content != row["base"]:
+            try:
+                remote_rev = self.inner.put(path, content, remote_rev, create=not remote_rev)
+            except StorageConflict:
+                try:
+                    remote, remote_rev = self.inner.get(path)
+                except StorageNotFound:
+                    log.warning("Dropping local changes to %s: deleted in Dropbox", path)
+                    self._drop(key)
+                    return covered
+                content = merge_file(path, row["base"] or "", content, remote)
+                remote_rev = self.inner.put(path, content, remote_rev)
+                metrics.inc("auth_mirror_merges_total", folder=self._folder(path))
+                log.info("Merged concurrent Dropbox edit into %s", path)
+
+        with self.db.transaction() as conn:
+            current = self._row(conn, key)
+            if current is None or current["content"] is None:
+                return covered
+            if current["rev"] != row["rev"]:
+                # Written again while uploading: keep that write, but fold in what the
+                # merge took from Dropbox so the next push does not undo it.
+                local = current["content"]
+                if content != row["content"]:
+                    local = merge_file(path, row["content"], local, content)
+                conn.execute(
+                    "UPDATE files SET content = ?, rev = ?, base = ?, remote_rev = ?, "
+                    "remote_at = ? WHERE path = ?",
+                    (
+                        local,
+                        current["rev"] if local == current["content"] else os.urandom(8).hex(),
+                        content,
+                        remote_rev,
+                        time.time(),
+                        key,
+                    ),
+                )
+            else:
+                conn.execute(
+                    "UPDATE files SET content = ?, rev = ?, base = ?, remote_rev = ?, "
+                    "remote_at = ?, dirty = 0 WHERE path = ?",
+                    (
+                        content,
+                        row["rev"] if content == row["content"] else os.urandom(8).hex(),
+                        content,
+                        remote_rev,
+                        time.time(),
+                        key,
+                    ),
+                )
+        if content != row["content"]:
+            self._notify(key)
+        return covered
+
+    def _push_move(self, src_key: str, dst_key: str) -> None:
+        conn = self.db.connection()
+        src = self._row(conn, src_key)
+        dst = self._row(conn, dst_key)
+        if src is None or dst is None:
+            return
+        try:
+            self.inner.move(src["display_path"], dst["display_path"])
+        except (StorageNotFound, FileExistsError) as e:
+            # The queued put of the target uploads (or merges) it instead.
+            if isinstance(e, FileExistsError):
+                log.warning(
+                    "Could not rename %s to %s in Dropbox: target exists",
+                    src["display_path"],
+                    dst["display_path"],
+                )
+            with self.db.transaction() as conn:
+                conn.execute(
+                    "UPDATE files SET dirty = 0 WHERE path = ? AND content IS NULL", (src_key,)
+                )
+            return
+        meta = self.inner.metadata(dst["display_path"])
+        now = time.time()
+        with self.db.transaction() as conn:
+            if src["content"] is None:
+                conn.execute("DELETE FROM files WHERE path = ? AND content IS NULL", (src_key,))
+            else:
+                conn.execute("UPDATE files SET remote_rev = NULL WHERE path = ?", (src_key,))
+            if meta is not None:
+                conn.execute(
+                    "UPDATE files SET base = ?, remote_rev = ?, remote_at = ? WHERE path = ?",
+                    (src["base"], meta["rev"], now, dst_key),
+                )
+
+    def _drop(self, key: str) -> None:
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM files WHERE path = ?", (key,))
+        self._notify(key)
+
+    def pull(self) -> int:
+        pulled = 0
+        for folder in sorted(self.folders):
+            pulled += self._pull_folder(folder)
+        return pulled
+
+    def _pull_folder(self, folder: str) -> int:
+        conn = self.db.connection()
+        started = time.time()
+        row = conn.execute("SELECT cursor FROM folders WHERE folder = ?", (folder,)).fetchone()
+        try:
+            changes = self.inner.list_changes(folder, row[0] if row else None)
+        except StorageNotFound:
+            changes = {"entries": [], "deleted": [], "cursor": None, "reset": True}
+
+        deleted = set(changes["deleted"])
+        if changes["reset"]:
+            listed = {e["path"] for e in changes["entries"]}
+            rows = conn.execute(
+                "SELECT path FROM files WHERE folder = ? AND remote_rev IS NOT NULL", (folder,)
+            ).fetchall()
+            deleted.update(path for (path,) in rows if path not in listed)
+        stale = []
+        for e in changes["entries"]:
+            current = self._row(conn, e["path"])
+            if current is None or (current["remote_rev"] != e["rev"] and not current["dirty"]):
+                stale.append(e)
+
+        pulled = 0
+        for e, fetched in zip(stale, self.executor.map(self._fetch, stale)):
+            if fetched is not None and self._apply_remote(e, *fetched):
+                pulled += 1
+        for key in deleted:
+            with self.db.transaction() as conn:
+                removed = conn.execute(
+                    "DELETE FROM files WHERE path = ? AND remote_rev IS NOT NULL "
+                    "AND remote_at < ?",
+                    (key, started),
+                ).rowcount
+            if removed:
+                pulled += 1
+                self._notify(key)
+
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO folders (folder, cursor, pulled_at) VALUES (?, ?, ?)",
+                (folder, changes["cursor"], time.time()),
+            )
+        self.ready_folders.add(folder)
+        if pulled:
+            metrics.inc("auth_mirror_replicated_total", pulled, direction="pull", op="put")
+        return pulled
+
+    def _fetch(self, entry: dict):
+        try:
+            return self.inner.get(entry["path"])
+        except StorageNotFound:
+            return None
+
+    def _apply_remote(self, entry: dict, content: str, remote_rev: str) -> bool:
+        key = entry["path"]
+        display_path = self._folder(key) + "/" + entry["name"]
+        now = time.time()
+        with self.db.transaction() as conn:
+            current = self._row(conn, key)
+            if current is not None and (current["dirty"] or current["remote_rev"] == remote_rev):
+                return False
+            changed = current is None or current["content"] != content
+            conn.execute(
+                "INSERT OR REPLACE INTO files (path, folder, display_path, content, rev, base, "
+                "remote_rev, remote_at, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    self._folder(key),
+                    current["display_path"] if current else display_path,
+                    content,
+                    os.urandom(8).hex() if changed else current["rev"],
+                    content,
+                    remote_rev,
+                    now,
+                    now,
+                ),
+            )
+        if changed:
+            self._notify(key)
+        return changed
+
+    def status(self) -> dict:
+        conn = self.db.connection()
+        folders = dict(conn.execute("SELECT folder, pulled_at FROM folders").fetchall())
+        now = time.time()
+        return {
+            "outbox": conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0],
+            "dirty": conn.execute("SELECT COUNT(*) FROM files WHERE dirty = 1").fetchone()[0],
+            "parked": conn.execute("SELECT COUNT(*) FROM parked").fetchone()[0],
+            "folders": {
+                folder: round(now - folders[folder], 1) if folder in folders else None
+                for folder in sorted(self.folders)
+            },
+        }
+
+
+def create_storage(backend: str) -> Storage:
+    if backend == "dropbox":
+        if not (refresh_token and app_key and app_secret):
+            raise RuntimeError(
+                "REFRESH_TOKEN, APP_KEY and APP_SECRET are required for the dropbox backend"
+            )
+        return DropboxStorage(dropbox)
+    if backend == "local":
+        return LocalStorage(
+            os.environ.get("LOCAL_STORAGE_ROOT", "storage"),
+            os.environ.get("LOCAL_STORAGE_BASE_URL", ""),
+        )
+    if backend == "memory":
+        return MemoryStorage(os.environ.get("MEMORY_STORAGE_SEED", ""))
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+
+
+storage = create_storage(storage_backend)
+if storage_mirror_path:
+    storage = MirroredStorage(
+        storage,
+        storage_mirror_path,
+        folders=os.environ.get(
+            "STORAGE_MIRROR_FOLDERS", f"/licenses,/accounts,{username_registry_shard_dir}"
+        ).split(","),
+        batch_size=int(os.environ.get("STORAGE_MIRROR_BATCH_SIZE", 100)),
+        concurrency=int(os.environ.get("STORAGE_MIRROR_CONCURRENCY", 8)),
     )
-    r.raise_for_status()
+
+
+link_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("LINK_CONCURRENCY", 8)),
+    thread_name_prefix="dropbox-link",
+)
+
+batch_max_items = int(os.environ.get("BATCH_MAX_ITEMS", 50))
+
+batch_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("BATCH_CONCURRENCY", 16)),
+    thread_name_prefix="batch",
+)
+
+
+def license_path(username: str) -> str:
+    return f"/licenses/{username}.txt"
+
+
+def account_path(username: str) -> str:
+    return f"/accounts/{username}.txt"
+
+
+def download_license(username: str) -> str:
+    return storage.get(license_path(username))[0]
+
+
+def upload_license(username: str, content: str) -> bool:
+    record_cache.put(license_path(username), content)
     return True
 
 
 def download_account(username: str) -> str:
-    token = get_access_token()
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Dropbox-API-Arg": f'{{"path": "/accounts/{username}.txt"}}',
-    }
-    r = requests.post(
-        "https://content.dropboxapi.com/2/files/download",
-        headers=headers,
-    )
-    r.raise_for_status()
-    return r.text
+    return storage.get(account_path(username))[0]
 
 
-def upload_account(username: str, content: str) -> bool:
-    token = get_access_token()
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Dropbox-API-Arg": f'{{"path": "/accounts/{username}.txt", "mode": "overwrite"}}',
-        "Content-Type": "application/octet-stream",
-    }
-    r = requests.post(
-        "https://content.dropboxapi.com/2/files/upload",
-        headers=headers,
-        data=content.encode(),
-    )
-    r.raise_for_status()
+def upload_account(username: str, content: str, create=False) -> bool:
+    record_cache.put(account_path(username), content, create=create)
     return True
 
 
+def load_license(username: str) -> dict:
+    return record_cache.get(license_path(username))[0]
+
+
+def load_account(username: str) -> dict:
+    return record_cache.get(account_path(username))[0]
+
+
 def rename_account_file(old_username: str, new_username: str) -> None:
-    token = get_access_token()
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
-    data = {
-        "from_path": f"/accounts/{old_username}.txt",
-        "to_path": f"/accounts/{new_username}.txt",
-        "autorename": False,
-        "allow_shared_folder": False,
-        "allow_ownership_transfer": False,
-    }
-    r = requests.post(
-        "https://api.dropboxapi.com/2/files/move_v2",
-        headers=headers,
-        json=data,
-    )
-    r.raise_for_status()
+    try:
+        storage.move(account_path(old_username), account_path(new_username))
+    finally:
+        record_cache.invalidate(account_path(old_username))
+        record_cache.invalidate(account_path(new_username))
+
+
+def _temporary_link(entry: dict):
+    try:
+        return {"name": entry["name"], "url": storage.temporary_link(entry["path"])}
+    except Exception:
+        return None
+
+
+def resolve_temporary_links(entries: list) -> list:
+    if len(entries) > 1:
+        return list(link_executor.map(_temporary_link, entries))
+    return [_temporary_link(entry) for entry in entries]
+
+
+def list_files_detailed(folder_path: str):
+    resolved = resolve_temporary_links(storage.list(folder_path))
+    files = [f for f in resolved if f is not None]
+    failed = len(resolved) - len(files)
+    if failed:
+        log.warning("%d of %d temporary links failed in %s", failed, len(resolved), folder_path)
+    return files, failed
 
 
 def list_files(folder_path: str):
-    token = get_access_token()
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
+    return list_files_detailed(folder_path)[0]
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, kind: str, key: str, fn):
+        with self.lock:
+            call = self.calls.get((kind, key))
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self.calls[(kind, key)] = call
+        if not leader:
+            metrics.inc("auth_coalesced_calls_total", call=kind)
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[(kind, key)]
+            call["done"].set()
+
+
+flights = SingleFlight()
+
+
+class FolderIndex:
+    def __init__(self, storage: Storage, folder_path: str, state_dir: str = ""):
+        self.storage = storage
+        self.folder_path = folder_path
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.entries = {}
+        self.cursor = None
+        self.version = 0
+        self.synced_at = 0.0
+        self.listed_at = 0.0
+        self.state_file = ""
+        if state_dir:
+            name = folder_path.strip("/").replace("/", "_") or "root"
+            self.state_file = os.path.join(state_dir, f"{name}.json")
+            self._load_state()
+
+    def _load_state(self) -> None:
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return
+        self.entries = {e["path"]: e for e in state.get("entries", [])}
+        self.cursor = state.get("cursor")
+        self.version = 1
+
+    def _save_state(self) -> None:
+        if not self.state_file or not self.cursor:
+            return
+        with self.lock:
+            state = {"cursor": self.cursor, "entries": list(self.entries.values())}
+        try:
+            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+            tmp = f"{self.state_file}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as fh:
+                json.dump(state, fh, separators=(",", ":"))
+            os.replace(tmp, self.state_file)
+        except OSError:
+            log.warning("Could not save folder index %s", self.state_file)
+
+    def sync(self) -> bool:
+        return flights.do("index", self.folder_path, self._sync)
+
+    def _sync(self) -> bool:
+        with self.sync_lock:
+            started = time.time()
+            changes = self.storage.list_changes(self.folder_path, self.cursor)
+            with self.lock:
+                if changes["reset"]:
+                    entries = {e["path"]: e for e in changes["entries"]}
+                    changed = entries != self.entries
+                    self.entries = entries
+                else:
+                    changed = bool(changes["entries"] or changes["deleted"])
+                    for path in changes["deleted"]:
+                        self.entries.pop(path, None)
+                    for e in changes["entries"]:
+                        self.entries[e["path"]] = e
+                self.cursor = changes["cursor"]
+                self.synced_at = time.time()
+                self.listed_at = started
+                if changed or not self.version:
+                    self.version += 1
+            if changed:
+                self._save_state()
+            return changed
+
+    def sync_if_stale(self, max_age: float) -> None:
+        if time.time() - self.synced_at >= max_age:
+            self.sync()
+
+    def files(self) -> list:
+        with self.lock:
+            return sorted(self.entries.values(), key=lambda e: e["name"])
+
+    def count(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+    def contains(self, path: str) -> bool:
+        with self.lock:
+            return path.lower() in self.entries
+
+
+class FolderIndexes:
+    def __init__(self, storage: Storage, sync_interval=30, longpoll=False, state_dir=""):
+        self.storage = storage
+        self.sync_interval = sync_interval
+        self.longpoll = longpoll and type(storage).wait_for_changes is not Storage.wait_for_changes
+        self.state_dir = state_dir
+        self.lock = threading.Lock()
+        self.indexes = {}
+        self.syncing = set()
+
+    def get(self, folder_path: str) -> FolderIndex:
+        index = self.indexes.get(folder_path)
+        if index is not None:
+            return index
+        with self.lock:
+            index = self.indexes.get(folder_path)
+            if index is None:
+                index = FolderIndex(self.storage, folder_path, self.state_dir)
+                self.indexes[folder_path] = index
+                if self.longpoll:
+                    threading.Thread(
+                        target=self._longpoll_loop, args=(index,), daemon=True
+                    ).start()
+        return index
+
+    def current(self, folder_path: str) -> FolderIndex:
+        index = self.get(folder_path)
+        max_age = self.sync_interval * 10 if self.longpoll else self.sync_interval
+        if not index.version:
+            index.sync()
+            return index
+        try:
+            index.sync_if_stale(max_age)
+        except UpstreamUnavailable:
+            log.warning("Serving stale index for %s: Dropbox unavailable", folder_path)
+            metrics.inc("auth_cache_requests_total", cache="index", result="stale")
+        return index
+
+    def cached(self, folder_path: str, max_age: float) -> FolderIndex:
+        index = self.get(folder_path)
+        if time.time() - index.synced_at < max_age:
+            return index
+        with self.lock:
+            if folder_path in self.syncing:
+                return index
+            self.syncing.add(folder_path)
+        threading.Thread(target=self._background_sync, args=(index,), daemon=True).start()
+        return index
+
+    def _background_sync(self, index: FolderIndex) -> None:
+        try:
+            index.sync()
+        except Exception:
+            log.warning("Background sync failed for %s", index.folder_path, exc_info=True)
+        finally:
+            with self.lock:
+                self.syncing.discard(index.folder_path)
 
-    r = requests.post(
-        "https://api.dropboxapi.com/2/files/list_folder",
-        headers=headers,
-        json={
-            "path": folder_path,
-            "recursive": False,
-            "include_deleted": False,
-        },
-    )
-    r.raise_for_status()
+    def _longpoll_loop(self, index: FolderIndex) -> None:
+        while True:
+            try:
+                if index.cursor is None:
+                    index.sync()
+                changes, backoff = self.storage.wait_for_changes(index.cursor)
+                if changes:
+                    index.sync()
+                if backoff:
+                    time.sleep(backoff)
+            except Exception:
+                log.warning("Longpoll failed for %s", index.folder_path, exc_info=True)
+                time.sleep(self.sync_interval)
 
-    files = []
 
-    for f in r.json().get("entries", []):
-        if f.get(".tag") != "file":
-            continue
+folder_indexes = FolderIndexes(
+    storage,
+    sync_interval=float(os.environ.get("FOLDER_INDEX_SYNC_INTERVAL", 30)),
+    longpoll=os.environ.get("FOLDER_INDEX_LONGPOLL", "false").lower() == "true",
+    state_dir=os.environ.get("FOLDER_INDEX_DIR", ""),
+)
 
+
+def response_etag(*parts) -> str:
+    raw = "\0".join(str(p) for p in parts)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:24]
+
+
+class CatalogCache:
+    def __init__(
+        self,
+        indexes: FolderIndexes,
+        ttl=12600,
+        refresh_ahead=1800,
+        max_entries=16,
+        shared: SharedStore = None,
+    ):
+        self.indexes = indexes
+        self.ttl = ttl
+        self.refresh_ahead = refresh_ahead
+        self.max_entries = max_entries
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        if shared is not None:
+            shared.subscribe("links:", lambda folder: self.forget(folder or None))
+
+    def get(self, folder_path: str) -> list:
+        return self.entry(folder_path)["files"]
+
+    def entry(self, folder_path: str) -> dict:
+        if self.shared is not None:
+            self.shared.poll()
+        index = self.indexes.current(folder_path)
+        with self.lock:
+            item = self.entries.get(folder_path)
+            if (
+                item
+                and item["version"] == index.version
+                and time.time() - item["oldest"] < self.ttl
+            ):
+                self.entries.move_to_end(folder_path)
+                metrics.inc("auth_cache_requests_total", cache="catalog", result="hit")
+                return item
+        metrics.inc("auth_cache_requests_total", cache="catalog", result="miss")
         try:
-            link_resp = requests.post(
-                "https://api.dropboxapi.com/2/files/get_temporary_link",
-                headers=headers,
-                json={"path": f.get("path_lower")},
-            )
-            link_resp.raise_for_status()
-            files.append(
-                {
-                    "name": f.get("name"),
-                    "url": link_resp.json().get("link"),
-                }
+            return self.refresh(folder_path, index)
+        except UpstreamUnavailable:
+            if not item:
+                raise
+            log.warning("Serving stale catalog for %s: Dropbox unavailable", folder_path)
+            metrics.inc("auth_cache_requests_total", cache="catalog", result="stale")
+            return item
+
+    def failed_links(self, folder_path: str) -> int:
+        with self.lock:
+            item = self.entries.get(folder_path)
+        return item["failed"] if item else 0
+
+    def refresh(self, folder_path: str, index: FolderIndex = None) -> dict:
+        return flights.do("catalog", folder_path, lambda: self._refresh(folder_path, index))
+
+    def _refresh(self, folder_path: str, index: FolderIndex = None) -> dict:
+        index = index or self.indexes.get(folder_path)
+        version = index.version
+        entries = index.files()
+        now = time.time()
+        with self.lock:
+            item = self.entries.get(folder_path)
+            previous = dict(item["links"]) if item else {}
+        for path, link in self._shared_links(folder_path).items():
+            if path not in previous or link[2] > previous[path][2]:
+                previous[path] = link
+
+        links = {}
+        stale = []
+        for e in entries:
+            cached = previous.get(e["path"])
+            if cached and cached[0] == e["rev"] and now - cached[2] < self.ttl - self.refresh_ahead:
+                links[e["path"]] = cached
+            else:
+                stale.append(e)
+        metrics.inc(
+            "auth_cache_requests_total", len(entries) - len(stale), cache="link", result="hit"
+        )
+        metrics.inc("auth_cache_requests_total", len(stale), cache="link", result="miss")
+
+        for e, f in zip(stale, resolve_temporary_links(stale)):
+            if f is not None:
+                links[e["path"]] = (e["rev"], f["url"], now)
+                continue
+            cached = previous.get(e["path"])
+            if cached and cached[0] == e["rev"] and now - cached[2] < self.ttl:
+                links[e["path"]] = cached
+                metrics.inc("auth_cache_requests_total", cache="link", result="stale")
+
+        files = [
+            {"name": e["name"], "url": links[e["path"]][1]}
+            for e in entries
+            if e["path"] in links
+        ]
+        failed = len(entries) - len(files)
+        if failed:
+            log.warning("%d of %d temporary links failed in %s", failed, len(entries), folder_path)
+
+        item = {
+            "files": files,
+            "links": links,
+            "failed": failed,
+            "version": version,
+            "oldest": min((link[2] for link in links.values()), default=now),
+            "etag": response_etag(json.dumps(files, sort_keys=True), failed),
+        }
+        with self.lock:
+            self.entries[folder_path] = item
+            self.entries.move_to_end(folder_path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if self.shared is not None and stale and links:
+            self.shared.set(
+                "links:" + folder_path,
+                json.dumps(links, separators=(",", ":")),
+                expires_at=item["oldest"] + self.ttl,
             )
-        except Exception:
-            pass
+        return item
+
+    def _shared_links(self, folder_path: str) -> dict:
+        if self.shared is None:
+            return {}
+        item = self.shared.get("links:" + folder_path)
+        if item is None:
+            return {}
+        return {path: tuple(link) for path, link in json.loads(item["value"]).items()}
+
+    def invalidate(self, folder_path: str = None) -> None:
+        self.forget(folder_path)
+        if self.shared is not None:
+            self.shared.invalidate("links:" + (folder_path or ""))
+
+    def forget(self, folder_path: str = None) -> None:
+        with self.lock:
+            if folder_path is None:
+                folders = list(self.entries)
+                self.entries.clear()
+            else:
+                folders = [folder_path]
+                self.entries.pop(folder_path, None)
+        for folder in folders:
+            self.indexes.get(folder).synced_at = 0.0
+
+    def refresh_due(self) -> None:
+        deadline = time.time() - (self.ttl - self.refresh_ahead)
+        with self.lock:
+            folders = list(self.entries)
+        for folder_path in folders:
+            try:
+                index = self.indexes.current(folder_path)
+                with self.lock:
+                    item = self.entries.get(folder_path)
+                if item and (item["version"] != index.version or item["oldest"] <= deadline):
+                    self.refresh(folder_path, index)
+            except Exception:
+                log.warning("Catalog refresh failed for %s", folder_path, exc_info=True)
+
+    def refresh_interval(self) -> float:
+        return max(1, min(60, self.refresh_ahead // 2))
+
 
-    return files
+catalog = CatalogCache(
+    folder_indexes,
+    ttl=int(os.environ.get("CATALOG_TTL", 12600)),
+    refresh_ahead=int(os.environ.get("CATALOG_REFRESH_AHEAD", 1800)),
+    max_entries=int(os.environ.get("CATALOG_MAX_ENTRIES", 16)),
+    shared=shared,
+)
 
 
 def count_licenses() -> int:
-    try:
-        return len(list_files("/licenses"))
-    except Exception:
-        return 0
+    return folder_indexes.cached("/licenses", stats_max_age).count()
 
 
 def count_loader_files() -> int:
+    return folder_indexes.cached("/loader", stats_max_age).count()
+
+
+def fill_missing(data: dict, entries: dict) -> bool:
+    missing = {k: v for k, v in entries.items() if k not in data}
+    data.update(missing)
+    return bool(missing)
+
+
+class UsernameRegistry:
+    def __init__(self, storage: Storage, shard_dir: str, shard_count=64, legacy_path="", ttl=30):
+        self.storage = storage
+        self.shard_dir = "/" + shard_dir.strip("/")
+        self.shard_count = shard_count
+        self.legacy_path = legacy_path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.migrate_lock = threading.Lock()
+        self.shard_locks = [threading.Lock() for _ in range(shard_count)]
+        self.shards = {}
+        self.migrated = False
+
+    def shard_id(self, username: str) -> int:
+        digest = hashlib.sha1(username.encode("utf-8")).hexdigest()
+        return int(digest[:8], 16) % self.shard_count
+
+    def shard_path(self, shard: int) -> str:
+        return f"{self.shard_dir}/{shard:03d}.json"
+
+    def _read_shard(self, shard: int) -> dict:
+        return self._load_shard(shard)[0]
+
+    def _load_shard(self, shard: int):
+        try:
+            content, rev = self.storage.get(self.shard_path(shard))
+            data = json.loads(content)
+        except StorageNotFound:
+            data, rev = {}, None
+        if not isinstance(data, dict):
+            data = {}
+        with self.lock:
+            self.shards[shard] = (data, time.time())
+        return data, rev
+
+    def _shard(self, shard: int) -> dict:
+        self.ensure_migrated()
+        with self.lock:
+            item = self.shards.get(shard)
+        if item and time.time() - item[1] < self.ttl:
+            return item[0]
+        return flights.do("registry", self.shard_path(shard), lambda: self._read_shard(shard))
+
+    def _update_shard(self, shard: int, mutate) -> None:
+        # Other workers and instances write the same shards; write against the revision
+        # that was read and re-read on conflict, like update_record.
+        path = self.shard_path(shard)
+        with self.shard_locks[shard]:
+            for attempt in range(record_update_attempts):
+                if attempt:
+                    time.sleep(conflict_delay(attempt))
+                data, rev = self._load_shard(shard)
+                data = dict(data)
+                if not mutate(data):
+                    return
+                content = json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+                try:
+                    self.storage.put(path, content, rev, create=rev is None)
+                except StorageConflict:
+                    metrics.inc("auth_record_conflicts_total", folder=self.shard_dir)
+                    log.info("Write conflict on %s, retrying (attempt %d)", path, attempt + 1)
+                    continue
+                with self.lock:
+                    self.shards[shard] = (data, time.time())
+                return
+        raise StorageConflict(path)
+
+    def get(self, username: str):
+        return self._shard(self.shard_id(username)).get(username)
+
+    def evict_expired(self) -> int:
+        deadline = time.time() - self.ttl
+        with self.lock:
+            expired = [shard for shard, item in self.shards.items() if item[1] < deadline]
+            for shard in expired:
+                del self.shards[shard]
+        return len(expired)
+
+    def contains(self, username: str) -> bool:
+        return username in self._shard(self.shard_id(username))
+
+    def add(self, username: str, entry: dict) -> None:
+        self.ensure_migrated()
+
+        def mutate(data: dict) -> bool:
+            data[username] = entry
+            return True
+
+        self._update_shard(self.shard_id(username), mutate)
+
+    def remove(self, username: str) -> None:
+        self.ensure_migrated()
+        self._update_shard(
+            self.shard_id(username), lambda data: data.pop(username, None) is not None
+        )
+
+    def rename(self, old_username: str, new_username: str, entry: dict) -> None:
+        self.add(new_username, entry)
+        self.remove(old_username)
+
+    def ensure_migrated(self) -> None:
+        if self.migrated:
+            return
+        with self.migrate_lock:
+            if self.migrated:
+                return
+            try:
+                has_shards = any(
+                    e["name"].endswith(".json") for e in self.storage.list(self.shard_dir)
+                )
+            except StorageNotFound:
+                has_shards = False
+            if not has_shards and self.legacy_path:
+                self._migrate_legacy()
+            self.migrated = True
+
+    def _migrate_legacy(self) -> None:
+        try:
+            legacy = json.loads(self.storage.get(self.legacy_path)[0])
+        except (StorageNotFound, ValueError):
+            return
+        if not isinstance(legacy, dict) or not legacy:
+            return
+        shards = {}
+        for username, entry in legacy.items():
+            shards.setdefault(self.shard_id(username), {})[username] = entry
+        for shard, entries in shards.items():
+            # Another worker may be migrating or adding names at the same time; only
+            # fill in names the shard does not have yet.
+            self._update_shard(shard, lambda data, entries=entries: fill_missing(data, entries))
+        log.info("Migrated %d usernames into %d registry shards", len(legacy), len(shards))
+
+
+username_registry = UsernameRegistry(
+    storage,
+    shard_dir=username_registry_shard_dir,
+    shard_count=int(os.environ.get("USERNAME_REGISTRY_SHARDS", 64)),
+    legacy_path=username_registry_path,
+    ttl=float(os.environ.get("USERNAME_REGISTRY_TTL", 30)),
+)
+
+
+class Scheduler:
+    def __init__(self, lock_path: str = "", tick=1.0):
+        self.lock_path = lock_path
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.executor = None
+        self.lock_file = None
+
+    def add(self, name: str, fn, interval: float, jitter=0.1, host_wide=False, on_stop=False):
+        self.jobs[name] = {
+            "fn": fn,
+            "interval": interval,
+            "jitter": jitter,
+            "host_wide": host_wide,
+            "on_stop": on_stop,
+            "next_run": time.time() + self._delay(interval, jitter),
+            "running": False,
+            "runs": 0,
+            "failures": 0,
+            "last_run": None,
+            "last_duration": 0.0,
+            "total_duration": 0.0,
+            "max_duration": 0.0,
+            "last_error": None,
+        }
+
+    def _delay(self, interval: float, jitter: float) -> float:
+        return interval * (1 + random.uniform(-jitter, jitter))
+
+    def is_host_leader(self) -> bool:
+        if self.lock_file is not None:
+            return True
+        if not self.lock_path:
+            return True
+        fh = open(self.lock_path, "a")
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fh.close()
+            return False
+        self.lock_file = fh
+        log.info("Scheduler in pid %d owns host-wide jobs", os.getpid())
+        return True
+
+    def start(self) -> None:
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="scheduler")
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=10.0) -> None:
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+        for name, job in self.jobs.items():
+            if job["on_stop"] and (not job["host_wide"] or self.lock_file is not None):
+                self._run(name, job)
+
+    def _loop(self) -> None:
+        while not self.stop_event.wait(self.tick):
+            now = time.time()
+            leader = None
+            for name, job in list(self.jobs.items()):
+                if job["running"] or now < job["next_run"]:
+                    continue
+                if job["host_wide"]:
+                    if leader is None:
+                        leader = self.is_host_leader()
+                    if not leader:
+                        job["next_run"] = now + self._delay(job["interval"], job["jitter"])
+                        continue
+                job["running"] = True
+                self.executor.submit(self._run, name, job)
+
+    def _run(self, name: str, job: dict) -> None:
+        started = time.perf_counter()
+        try:
+            job["fn"]()
+            job["last_error"] = None
+        except Exception as e:
+            job["failures"] += 1
+            job["last_error"] = str(e)
+            log.warning("Scheduled job %s failed", name, exc_info=True)
+        finally:
+            duration = time.perf_counter() - started
+            job["runs"] += 1
+            job["last_run"] = time.time()
+            job["last_duration"] = duration
+            job["total_duration"] += duration
+            job["max_duration"] = max(job["max_duration"], duration)
+            job["next_run"] = time.time() + self._delay(job["interval"], job["jitter"])
+            job["running"] = False
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "host_wide": job["host_wide"],
+                "interval": job["interval"],
+                "runs": job["runs"],
+                "failures": job["failures"],
+                "last_run": job["last_run"],
+                "last_duration_ms": round(job["last_duration"] * 1000, 2),
+                "avg_duration_ms": round(job["total_duration"] * 1000 / job["runs"], 2)
+                if job["runs"]
+                else 0.0,
+                "max_duration_ms": round(job["max_duration"] * 1000, 2),
+                "last_error": job["last_error"],
+            }
+            for name, job in list(self.jobs.items())
+        }
+
+
+scheduler = Scheduler(
+    lock_path=os.environ.get("SCHEDULER_LOCK_PATH")
+    or os.path.join(private_state_dir(), "scheduler.lock"),
+)
+atexit.register(scheduler.stop)
+
+
+def keepalive_ping() -> None:
+    requests.get(f"{self_base_url}/health", timeout=10)
+
+
+RECORD_V2_HEADER = "#record v2"
+LAZY_FIELDS = ("roles", "sessions_json")
+
+
+def _decode_roles_text(raw: str) -> dict:
     try:
-        return len(list_files("/loader"))
+        value = ast.literal_eval(raw)
     except Exception:
-        return 0
+        return {}
+    return value
 
 
-def download_username_registry() -> dict:
-    token = get_access_token()
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Dropbox-API-Arg": f'{{"path": "{username_registry_path}"}}',
-    }
+def _decode_json(raw: str) -> dict:
     try:
-        r = requests.post(
-            "https://content.dropboxapi.com/2/files/download",
-            headers=headers,
-        )
-        r.raise_for_status()
-        content = r.text
-        data = json.loads(content)
-        if isinstance(data, dict):
-            return data
-        return {}
+        return json.loads(raw)
     except Exception:
         return {}
 
 
-def upload_username_registry(registry: dict) -> None:
-    token = get_access_token()
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Dropbox-API-Arg": f'{{"path": "{username_registry_path}", "mode": "overwrite"}}',
-        "Content-Type": "application/octet-stream",
-    }
-    content = json.dumps(registry, separators=(",", ":"), ensure_ascii=False)
-    r = requests.post(
-        "https://content.dropboxapi.com/2/files/upload",
-        headers=headers,
-        data=content.encode("utf-8"),
+class LazyValue:
+    __slots__ = ("raw", "fmt", "decode")
+
+    def __init__(self, raw: str, fmt: str, decode):
+        self.raw = raw
+        self.fmt = fmt
+        self.decode = decode
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class Record(dict):
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if type(value) is LazyValue:
+            value = value.decode(value.raw)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def copy(self) -> "Record":
+        return Record(self)
+
+    def to_dict(self, exclude=()) -> dict:
+        return {key: self[key] for key in self if key not in exclude}
+
+
+def parse_text_with_sessions(text: str) -> Record:
+    if text.startswith(RECORD_V2_HEADER):
+        return parse_record_v2(text)
+
+    data = Record()
+    roles = None
+    sessions_json = None
+
+    for line in text.split("\n"):
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            continue
+        lowered = key.lower()
+        if lowered == "roles":
+            roles = value
+        elif lowered == "sessions_json":
+            sessions_json = value.strip()
+        else:
+            data[key.strip()] = value.strip()
+
+    data["roles"] = LazyValue(roles, "text", _decode_roles_text) if roles else {}
+    data["sessions_json"] = (
+        LazyValue(sessions_json, "json", _decode_json) if sessions_json else {}
     )
-    r.raise_for_status()
+    return data
+
+
+def parse_record_v2(text: str) -> Record:
+    lines = text.split("\n", 4)
+    data = Record(_decode_json(lines[1]) if len(lines) > 1 else {})
+    for key, raw in zip(LAZY_FIELDS, lines[2:4]):
+        data[key] = LazyValue(raw, "json", _decode_json) if raw else {}
+    for key in LAZY_FIELDS:
+        data.setdefault(key, {})
+    return data
+
+
+def _raw_field(d: dict, key: str, fmt: str, encode) -> str:
+    value = dict.get(d, key, {})
+    if type(value) is LazyValue:
+        if value.fmt == fmt:
+            return value.raw
+        value = value.decode(value.raw)
+    return encode(value)
+
+
+def _encode_json(value) -> str:
+    return json.dumps(value, separators=(",", ":"))
+
+
+def dict_to_text_with_sessions(d: dict) -> str:
+    if record_format == "v2":
+        return dict_to_record_v2(d)
+
+    lines = [f"{k}={v}" for k, v in d.items() if k not in LAZY_FIELDS]
+    lines.append("roles=" + _raw_field(d, "roles", "text", str))
+    lines.append("sessions_json=" + _raw_field(d, "sessions_json", "json", _encode_json))
+    return "\n".join(lines)
+
+
+def dict_to_record_v2(d: dict) -> str:
+    fields = {k: v for k, v in d.items() if k not in LAZY_FIELDS}
+    return "\n".join(
+        [
+            RECORD_V2_HEADER,
+            json.dumps(fields, separators=(",", ":"), ensure_ascii=False),
+            _raw_field(d, "roles", "json", _encode_json),
+            _raw_field(d, "sessions_json", "json", _encode_json),
+        ]
+    )
+
+
+_MISSING = object()
+
+
+def merge_fields(base: dict, local: dict, remote: dict, local_wins=False) -> dict:
+    merged = {}
+    for key in list(remote) + [k for k in local if k not in remote]:
+        b, l, r = (d.get(key, _MISSING) for d in (base, local, remote))
+        value = r if l == b or (r != b and not local_wins) else l
+        if value is not _MISSING:
+            merged[key] = value
+    return merged
 
 
-def keepalive_bot():
-    global keepalive_running
-    url = f"{self_base_url}/validate"
+SESSION_COUNTERS = ("total_seconds", "total_sessions")
 
-    while keepalive_running:
+
+def merge_sessions(base: dict, local: dict, remote: dict) -> dict:
+    # Every host only adds to the counters, so both sides' increments are kept. A game
+    # one side removed was reset on purpose and stays removed.
+    merged = {}
+    for game in list(remote) + [g for g in local if g not in remote]:
+        if game in base and (game not in local or game not in remote):
+            continue
+        b, l, r = (
+            s[game] if isinstance(s.get(game), dict) else {} for s in (base, local, remote)
+        )
+        entry = merge_fields(b, l, r)
+        for key in SESSION_COUNTERS:
+            entry[key] = int(l.get(key, 0)) + int(r.get(key, 0)) - int(b.get(key, 0))
+        for key in ("last_start", "last_end"):
+            entry[key] = max(l.get(key, ""), r.get(key, ""))
+        merged[game] = entry
+    return merged
+
+
+def merge_file(path: str, base: str, local: str, remote: str) -> str:
+    # Three-way merge of a local write with an edit made directly in Dropbox. Fields
+    # both sides changed keep the Dropbox value, except registry entries, which only
+    # this service writes, and session totals, which add up.
+    if path.endswith(".json"):
+        sides = [_decode_json(text or "{}") for text in (base, local, remote)]
+        merged = merge_fields(*[s if isinstance(s, dict) else {} for s in sides], local_wins=True)
+        return json.dumps(merged, separators=(",", ":"), ensure_ascii=False)
+    b, l, r = (parse_text_with_sessions(text) for text in (base, local, remote))
+    merged = Record(merge_fields(b, l, r))
+    sessions = [d["sessions_json"] for d in (b, l, r)]
+    if sessions[1] != sessions[0] and sessions[2] != sessions[0]:
+        merged["sessions_json"] = merge_sessions(*sessions)
+    return dict_to_text_with_sessions(merged)
+
+
+def migrate_record_format(folder_path: str) -> int:
+    migrated = 0
+    for entry in storage.list(folder_path):
+        content, rev = storage.get(entry["path"])
+        if content.startswith(RECORD_V2_HEADER) == (record_format == "v2"):
+            continue
         try:
-            payload = {
-                "username": "PING_KEEPALIVE",
-                "password": "",
-            }
-            headers = {"Content-Type": "application/json"}
-            requests.post(url, headers=headers, data=json.dumps(payload), timeout=10)
+            record_cache.put(
+                entry["path"],
+                dict_to_text_with_sessions(parse_text_with_sessions(content)),
+                rev=rev,
+            )
+        except StorageConflict:
+            log.info("Skipped migrating %s: it changed while being converted", entry["path"])
+            continue
+        migrated += 1
+    return migrated
+
+
+def parse_sessions(d: dict) -> dict:
+    sessions = d.get("sessions_json")
+    if isinstance(sessions, dict):
+        return sessions
+    return {}
+
+
+def add_session(d: dict, game_name: str, start_iso: str, end_iso: str, seconds: int):
+    sessions = parse_sessions(d)
+    g = sessions.get(
+        game_name,
+        {
+            "total_seconds": 0,
+            "total_sessions": 0,
+            "last_start": "",
+            "last_end": "",
+        },
+    )
+
+    g["total_seconds"] = int(g.get("total_seconds", 0)) + int(seconds)
+    g["total_sessions"] = int(g.get("total_sessions", 0)) + 1
+    g["last_start"] = start_iso
+    g["last_end"] = end_iso
+
+    sessions[game_name] = g
+    d["sessions_json"] = sessions
+
+
+class RecordCache:
+    def __init__(
+        self,
+        storage: Storage,
+        max_entries=1024,
+        ttl=600,
+        revalidate_after=15,
+        stale_ttl=3600,
+        shared: SharedStore = None,
+        indexes: FolderIndexes = None,
+        index_folders=(),
+        index_max_age=30,
+        negative_ttl=10,
+    ):
+        self.storage = storage
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.revalidate_after = revalidate_after
+        self.stale_ttl = stale_ttl
+        self.shared = shared
+        self.indexes = indexes
+        self.index_folders = {folder.lower(): folder for folder in index_folders}
+        self.index_max_age = index_max_age
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.missing = OrderedDict()
+        self.changed = OrderedDict()
+        self.changed_all = 0.0
+        if shared is not None:
+            shared.subscribe("record:", lambda key: self.forget(key or None))
+
+    def _item(self, key: str):
+        with self.lock:
+            item = self.entries.get(key)
+            if item:
+                self.entries.move_to_end(key)
+        return item
+
+    def _shared_item(self, key: str, item: dict):
+        row = self.shared.get("record:" + key)
+        if row is None:
+            return item
+        if item and row["rev"] == item["rev"]:
+            item["validated"] = max(item["validated"], row["validated"])
+            return item
+        if item and row["fetched"] <= item["fetched"]:
+            return item
+        item = {
+            "record": parse_text_with_sessions(row["value"]),
+            "rev": row["rev"],
+            "fetched": row["fetched"],
+            "validated": row["validated"],
+        }
+        self._store(key, item)
+        return item
+
+    def lookup(self, path: str, revalidate=False):
+        now = time.time()
+        key = path.lower()
+        if self.shared is not None:
+            self.shared.poll()
+        item = self._item(key)
+        if self.shared is not None and (
+            not item or now - item["validated"] >= self.revalidate_after
+        ):
+            item = self._shared_item(key, item)
+        if not item or now - item["fetched"] >= self.ttl:
+            return None, False
+        return item, not revalidate and now - item["validated"] < self.revalidate_after
+
+    def confirm(self, path: str, item: dict, meta) -> bool:
+        if meta is None:
+            self.invalidate(path)
+            self.remember_missing(path)
+            raise StorageNotFound(path)
+        if meta["rev"] != item["rev"]:
+            return False
+        item["validated"] = time.time()
+        if self.shared is not None:
+            self.shared.touch("record:" + path.lower(), item["rev"], item["validated"])
+        return True
+
+    def remember(self, path: str, content: str, rev: str, notify=False):
+        item = self._remember(path, content, rev, notify)
+        return copy.deepcopy(item["record"]), rev
+
+    def _remember(self, path: str, content: str, rev: str, notify=False) -> dict:
+        now = time.time()
+        key = path.lower()
+        item = {
+            "record": parse_text_with_sessions(content),
+            "rev": rev,
+            "fetched": now,
+            "validated": now,
+        }
+        self._store(key, item)
+        if notify:
+            self._mark_changed(key, now)
+        if self.shared is not None:
+            self.shared.set(
+                "record:" + key,
+                content,
+                expires_at=now + self.ttl + self.stale_ttl,
+                rev=rev,
+                fetched=now,
+                validated=now,
+                notify=notify,
+            )
+        return item
+
+    def stale(self, path: str):
+        key = path.lower()
+        item = self._item(key)
+        if self.shared is not None:
+            item = self._shared_item(key, item)
+        if not item or time.time() - item["fetched"] >= self.ttl + self.stale_ttl:
+            return None
+        log.warning("Serving stale record %s: Dropbox unavailable", path)
+        metrics.inc("auth_cache_requests_total", cache="record", result="stale")
+        return copy.deepcopy(item["record"]), item["rev"]
+
+    def known_missing(self, path: str) -> bool:
+        key = path.lower()
+        now = time.time()
+        with self.lock:
+            expires = self.missing.get(key)
+            if expires is not None and expires <= now:
+                del self.missing[key]
+                expires = None
+        if expires is not None:
+            metrics.inc("auth_cache_requests_total", cache="record", result="negative")
+            return True
+        # Only the fixed record folders are indexed; the rest of the path comes from
+        # the client, so a name with "/" in it must not create new indexes.
+        folder = self.index_folders.get(path.rsplit("/", 1)[0].lower())
+        if self.indexes is None or self.index_max_age <= 0 or folder is None:
+            return False
+        index = self.indexes.cached(folder, self.index_max_age)
+        if not index.version or now - index.listed_at >= self.index_max_age:
+            return False
+        with self.lock:
+            changed = max(self.changed.get(key, 0.0), self.changed_all)
+        if index.listed_at <= changed or index.contains(path):
+            return False
+        metrics.inc("auth_cache_requests_total", cache="record", result="unlisted")
+        return True
+
+    def remember_missing(self, path: str) -> None:
+        if self.negative_ttl <= 0:
+            return
+        with self.lock:
+            self.missing[path.lower()] = time.time() + self.negative_ttl
+            self.missing.move_to_end(path.lower())
+            while len(self.missing) > self.max_entries:
+                self.missing.popitem(last=False)
+
+    def get(self, path: str, revalidate=False):
+        item, fresh = self.lookup(path, revalidate)
+        if item and fresh:
+            metrics.inc("auth_cache_requests_total", cache="record", result="hit")
+            return copy.deepcopy(item["record"]), item["rev"]
+        if not item and not revalidate and self.known_missing(path):
+            raise StorageNotFound(path)
+        try:
+            fetched = flights.do("record", path.lower(), lambda: self._fetch(path, item))
+        except UpstreamUnavailable:
+            if revalidate:
+                raise
+            cached = self.stale(path)
+            if cached is None:
+                raise
+            return cached
+        return copy.deepcopy(fetched["record"]), fetched["rev"]
+
+    def _fetch(self, path: str, item: dict) -> dict:
+        if item and self.confirm(path, item, self.storage.metadata(path)):
+            metrics.inc("auth_cache_requests_total", cache="record", result="revalidated")
+            return item
+
+        metrics.inc("auth_cache_requests_total", cache="record", result="miss")
+        try:
+            content, rev = self.storage.get(path)
+        except StorageNotFound:
+            self.remember_missing(path)
+            raise
+        return self._remember(path, content, rev)
+
+    def put(self, path: str, content: str, rev: str = None, create=False) -> str:
+        try:
+            rev = self.storage.put(path, content, rev, create)
+        except StorageConflict:
+            self.forget(path)
+            raise
+        self.remember(path, content, rev, notify=True)
+        return rev
+
+    def _store(self, key: str, item: dict) -> None:
+        with self.lock:
+            self.missing.pop(key, None)
+            self.entries[key] = item
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def known(self, path: str) -> bool:
+        with self.lock:
+            return path.lower() in self.entries
+
+    def evict_expired(self) -> int:
+        now = time.time()
+        deadline = now - self.ttl - self.stale_ttl
+        with self.lock:
+            expired = [k for k, item in self.entries.items() if item["fetched"] < deadline]
+            for key in expired:
+                del self.entries[key]
+            for key in [k for k, expires in self.missing.items() if expires <= now]:
+                del self.missing[key]
+            for key in [k for k, at in self.changed.items() if at < now - self.index_max_age]:
+                del self.changed[key]
+        return len(expired)
+
+    def invalidate(self, path: str = None) -> None:
+        self.forget(path)
+        if self.shared is not None:
+            self.shared.invalidate("record:" + (path.lower() if path else ""))
+
+    def forget(self, path: str = None) -> None:
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+                self.missing.clear()
+                self.changed.clear()
+                self.changed_all = time.time()
+            else:
+                self.entries.pop(path.lower(), None)
+                self.missing.pop(path.lower(), None)
+        if path is not None:
+            self._mark_changed(path.lower(), time.time())
+
+    def _mark_changed(self, key: str, now: float) -> None:
+        with self.lock:
+            self.changed[key] = now
+            self.changed.move_to_end(key)
+            while len(self.changed) > self.max_entries:
+                self.changed.popitem(last=False)
+
+
+record_cache = RecordCache(
+    storage,
+    max_entries=int(os.environ.get("RECORD_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("RECORD_CACHE_TTL", 600)),
+    revalidate_after=float(os.environ.get("RECORD_CACHE_REVALIDATE", 15)),
+    stale_ttl=float(os.environ.get("RECORD_CACHE_STALE_TTL", 3600)),
+    shared=shared,
+    indexes=folder_indexes,
+    index_folders=("/licenses", "/accounts"),
+    index_max_age=float(os.environ.get("EXISTENCE_INDEX_MAX_AGE", 30)),
+    negative_ttl=float(os.environ.get("NEGATIVE_CACHE_TTL", 10)),
+)
+
+
+if isinstance(storage, MirroredStorage):
+    storage.subscribe(record_cache.invalidate)
+
+
+def record_path(kind: str, username: str) -> str:
+    return license_path(username) if kind == "license" else account_path(username)
+
+
+class KeyedLocks:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextlib.contextmanager
+    def hold(self, key: str):
+        with self.lock:
+            entry = self.locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[key]
+
+
+record_update_attempts = int(os.environ.get("RECORD_UPDATE_ATTEMPTS", 5))
+record_conflict_delay = float(os.environ.get("RECORD_CONFLICT_DELAY", 0.02))
+record_write_locks = KeyedLocks()
+
+
+def conflict_delay(attempt: int) -> float:
+    return random.uniform(0, record_conflict_delay * 2**attempt)
+
+
+def update_record(path: str, mutate) -> dict:
+    written = None
+    with record_write_locks.hold(path.lower()):
+        for attempt in range(record_update_attempts):
+            if attempt:
+                time.sleep(conflict_delay(attempt))
+            d, rev = record_cache.get(path, revalidate=attempt > 0)
+            if written is not None and dict_to_text_with_sessions(d) == written:
+                return d
+            if not mutate(d):
+                return d
+            written = dict_to_text_with_sessions(d)
+            try:
+                record_cache.put(path, written, rev=rev)
+                return d
+            except StorageConflict:
+                metrics.inc("auth_record_conflicts_total", folder=path.rsplit("/", 1)[0])
+                log.info("Write conflict on %s, retrying (attempt %d)", path, attempt + 1)
+    raise StorageConflict(path)
+
+
+def record_exists(kind: str, username: str) -> bool:
+    path = record_path(kind, username)
+    if record_cache.known(path):
+        return True
+    try:
+        record_cache.get(path)
+        return True
+    except UpstreamUnavailable:
+        raise
+    except Exception:
+        return False
+
+
+def apply_session_events(kind: str, username: str, events: list) -> None:
+    def add_sessions(d: dict) -> bool:
+        for e in events:
+            add_session(
+                d,
+                game_name=e["game_name"],
+                start_iso=e["start"],
+                end_iso=e["end"],
+                seconds=e["seconds"],
+            )
+        return True
+
+    update_record(record_path(kind, username), add_sessions)
+
+
+class SessionJournal:
+    def __init__(self, directory: str, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.sequence = 0
+        self.pending = []
+        self.inflight = []
+        os.makedirs(directory, exist_ok=True)
+        self.segment = self._open_segment()
+
+    def _open_segment(self):
+        self.sequence += 1
+        path = os.path.join(self.directory, f"sessions-{os.getpid()}-{self.sequence}.log")
+        fh = open(path, "ab")
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return path, fh
+
+    def _write(self, events: list) -> None:
+        _, fh = self.segment
+        for event in events:
+            fh.write(json.dumps(event, separators=(",", ":")).encode("utf-8") + b"\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+
+    def append(self, event: dict) -> None:
+        self.extend([event])
+
+    def extend(self, events: list) -> None:
+        with self.lock:
+            self._write(events)
+            self.pending.extend(events)
+
+    def recover(self) -> int:
+        total = 0
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".log") or path == self.segment[0]:
+                continue
+            try:
+                fh = open(path, "rb")
+            except OSError:
+                continue
+            with fh:
+                try:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                if os.fstat(fh.fileno()).st_nlink == 0:
+                    continue
+                recovered = []
+                for line in fh:
+                    try:
+                        recovered.append(json.loads(line))
+                    except ValueError:
+                        pass
+                if recovered:
+                    with self.lock:
+                        self._write(recovered)
+                        self.pending.extend(recovered)
+                os.remove(path)
+            total += len(recovered)
+        if total:
+            log.info("Recovered %d journaled session events", total)
+        return total
+
+    def flush(self) -> int:
+        with self.flush_lock:
+            with self.lock:
+                events = self.pending
+                if not events:
+                    return 0
+                self.pending = []
+                self.inflight = events
+                old_segment = self.segment
+                self.segment = self._open_segment()
+
+            grouped = OrderedDict()
+            for event in events:
+                grouped.setdefault((event["kind"], event["username"]), []).append(event)
+
+            retry = []
+            for (kind, username), group in grouped.items():
+                try:
+                    apply_session_events(kind, username, group)
+                except StorageNotFound:
+                    log.warning(
+                        "Dropping %d session events for missing %s %s", len(group), kind, username
+                    )
+                except Exception:
+                    log.warning("Session flush failed for %s %s", kind, username, exc_info=True)
+                    retry.extend(group)
+
+            with self.lock:
+                if retry:
+                    self._write(retry)
+                    self.pending = retry + self.pending
+                self.inflight = []
+                path, fh = old_segment
+                os.remove(path)
+                fh.close()
+            return len(events) - len(retry)
+
+    def pending_for(self, kind: str, username: str) -> list:
+        with self.lock:
+            return [
+                e
+                for e in self.inflight + self.pending
+                if e["kind"] == kind and e["username"] == username
+            ]
+
+
+session_journal_dir = os.environ.get("SESSION_JOURNAL_DIR", "session_journal")
+session_journal = None
+if session_journal_dir:
+    session_journal = SessionJournal(
+        session_journal_dir,
+        flush_interval=float(os.environ.get("SESSION_JOURNAL_FLUSH_INTERVAL", 5)),
+    )
+    session_journal.recover()
+
+
+scheduler.add("token_refresh", tokens.refresh_due, 30)
+scheduler.add("catalog_refresh", catalog.refresh_due, catalog.refresh_interval())
+scheduler.add("record_cache_eviction", record_cache.evict_expired, 60)
+scheduler.add("registry_eviction", username_registry.evict_expired, 60)
+if shared is not None:
+    scheduler.add("shared_cache_prune", shared.prune, 300, host_wide=True)
+if session_journal is not None:
+    scheduler.add(
+        "session_flush", session_journal.flush, session_journal.flush_interval, on_stop=True
+    )
+    scheduler.add("session_recovery", session_journal.recover, 60, host_wide=True)
+if isinstance(storage, MirroredStorage):
+    scheduler.add(
+        "mirror_push",
+        storage.push,
+        float(os.environ.get("STORAGE_MIRROR_PUSH_INTERVAL", 2)),
+        host_wide=True,
+        on_stop=True,
+    )
+    scheduler.add(
+        "mirror_pull",
+        storage.pull,
+        float(os.environ.get("STORAGE_MIRROR_PULL_INTERVAL", 30)),
+        host_wide=True,
+    )
+if keepalive_enabled and self_base_url and keepalive_interval > 0:
+    scheduler.add("keepalive", keepalive_ping, keepalive_interval, host_wide=True)
+
+
+@app.before_request
+def start_scheduler():
+    scheduler.start()
+
+
+@app.before_request
+def start_request_metrics():
+    if not metrics.enabled:
+        return
+    g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.metrics_started = time.perf_counter()
+    metrics.inc("auth_http_requests_in_flight", route=g.metrics_route)
+
+
+@app.before_request
+def start_request_profile():
+    forced = request.headers.get("X-Profile") == "1" and is_admin_request()
+    if not profiler.should_profile(forced):
+        return
+    g.profile_route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.profiling = True
+    g.profile = profiler.start(g.profile_route)
+
+
+@app.after_request
+def remember_response_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    if response.status_code != 200 or response.direct_passthrough:
+        return response
+    etag, _ = response.get_etag()
+    if response.mimetype != "application/json" or "Content-Encoding" in response.headers:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < compress_min_size:
+        return response
+    encoding = choose_encoding(request.headers.get("Accept-Encoding", ""))
+    if encoding is None:
+        return response
+
+    response.set_data(compressed_bodies.get(body, encoding, etag))
+    response.headers["Content-Encoding"] = encoding
+    if etag:
+        response.headers["ETag"] = f'"{etag}-{encoding}"'
+    return response
+
+
+@app.teardown_request
+def finish_request_profile(exc):
+    if g.pop("profiling", False):
+        profiler.stop(g.profile_route, g.pop("profile", None))
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return
+    route = g.metrics_route
+    metrics.inc("auth_http_requests_in_flight", -1, route=route)
+    metrics.observe(
+        "auth_http_request_duration_seconds", time.perf_counter() - started, route=route
+    )
+    metrics.inc(
+        "auth_http_requests_total",
+        route=route,
+        method=request.method,
+        status=str(g.get("metrics_status", 500)),
+    )
+
+
+def sessions_with_pending(kind: str, username: str, sessions: dict) -> dict:
+    events = session_journal.pending_for(kind, username) if session_journal else []
+    if not events:
+        return sessions
+    d = {"sessions_json": copy.deepcopy(sessions)}
+    for e in events:
+        add_session(
+            d,
+            game_name=e["game_name"],
+            start_iso=e["start"],
+            end_iso=e["end"],
+            seconds=e["seconds"],
+        )
+    return d["sessions_json"]
+
+
+def record_session_batch(events: list) -> set:
+    if session_journal is not None:
+        session_journal.extend(events)
+        return set()
+
+    grouped = OrderedDict()
+    for event in events:
+        grouped.setdefault((event["kind"], event["username"]), []).append(event)
+
+    def apply(key):
+        try:
+            apply_session_events(key[0], key[1], grouped[key])
         except Exception:
-            pass
-        time.sleep(keepalive_interval)
+            log.warning("Batched session write failed for %s %s", *key, exc_info=True)
+            return key
+        return None
+
+    return {key for key in batch_executor.map(apply, list(grouped)) if key}
+
+
+def record_session_end(
+    kind: str, username: str, game_name: str, start_iso: str, end_iso: str, seconds: int
+):
+    event = {
+        "kind": kind,
+        "username": username,
+        "game_name": game_name,
+        "start": start_iso,
+        "end": end_iso,
+        "seconds": seconds,
+    }
+    if session_journal is not None:
+        session_journal.append(event)
+    else:
+        apply_session_events(kind, username, [event])
+
+
+compress_min_size = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+
+ENCODING_SUFFIXES = ("", "-gzip", "-br")
+
 
+class CompressedBodies:
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
 
-def start_keepalive_thread():
-    t = threading.Thread(target=keepalive_bot, daemon=True)
-    t.start()
+    def get(self, body: bytes, encoding: str, etag: str = None) -> bytes:
+        key = (etag, encoding)
+        if etag:
+            with self.lock:
+                data = self.entries.get(key)
+                if data is not None:
+                    self.entries.move_to_end(key)
+                    return data
 
+        if encoding == "br":
+            data = brotli.compress(body, quality=5)
+        else:
+            data = gzip.compress(body, compresslevel=6, mtime=0)
 
-def parse_text_with_sessions(text: str) -> dict:
-    data = {}
-    roles_dict = {}
-    sessions_json = {}
+        if etag:
+            with self.lock:
+                self.entries[key] = data
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return data
+
+
+compressed_bodies = CompressedBodies(int(os.environ.get("COMPRESS_CACHE_SIZE", 64)))
+
+
+def choose_encoding(accept_encoding: str):
+    if not accept_encoding:
+        return None
+    accepted = parse_accept_header(accept_encoding)
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and brotli is None:
+            continue
+        if accepted.quality(encoding) > 0:
+            return encoding
+    return None
+
+
+def matched_etag(if_none_match: str, etag: str):
+    # A 304 repeats the validator the client holds: only a compressed 200 carried the
+    # encoding suffix, and whether the body was big enough to compress is unknown here.
+    if not if_none_match:
+        return None
+    etags = parse_etags(if_none_match)
+    if etags.star_tag:
+        return etag
+    for suffix in ENCODING_SUFFIXES:
+        if etags.contains_weak(etag + suffix):
+            return etag + suffix
+    return None
+
+
+def conditional_json(etag: str, build):
+    matched = matched_etag(request.headers.get("If-None-Match", ""), etag)
+    if matched:
+        response = Response(status=304)
+        etag = matched
+    else:
+        payload, status = build()
+        response = jsonify(payload)
+        response.status_code = status
+        if status != 200:
+            return response
+    response.headers["ETag"] = f'"{etag}"'
+    response.headers["Cache-Control"] = "no-cache"
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def upstream_unavailable():
+    return {
+        "error": True,
+        "code": "UPSTREAM_UNAVAILABLE",
+        "status": "Servicio temporalmente no disponible, intenta de nuevo.",
+    }, 503
+
+
+def write_conflict():
+    return {
+        "error": True,
+        "code": "WRITE_CONFLICT",
+        "status": "El registro cambió mientras se guardaba, intenta de nuevo.",
+    }, 409
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class SessionTokens:
+    def __init__(self, keys: str, ttl=1800):
+        self.ttl = ttl
+        self.keys = OrderedDict()
+        for item in keys.split(","):
+            kid, sep, secret = item.strip().partition(":")
+            if sep and kid and secret:
+                self.keys[kid] = secret.encode("utf-8")
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.keys)
+
+    def _signature(self, kid: str, body: str) -> str:
+        message = f"{kid}.{body}".encode("ascii")
+        return _b64encode(hmac.new(self.keys[kid], message, hashlib.sha256).digest())
+
+    def issue(self, kind: str, username: str, not_after: float = None) -> dict:
+        if not self.keys:
+            return {}
+        expires_at = int(time.time() + self.ttl)
+        if not_after is not None:
+            expires_at = min(expires_at, int(not_after))
+        kid = next(iter(self.keys))
+        claims = {"sub": username, "kind": kind, "exp": expires_at}
+        body = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+        metrics.inc("auth_session_tokens_total", result="issued")
+        return {
+            "session_token": f"{kid}.{body}.{self._signature(kid, body)}",
+            "session_token_expires_at": expires_at,
+        }
+
+    def verify(self, token: str, kind: str, username: str) -> bool:
+        # A session can outlive its token, so callers treat a failed check like a
+        # request without a token and look the record up instead.
+        if not token or not self.keys:
+            return False
+        valid = self._verify(token, kind, username)
+        metrics.inc("auth_session_tokens_total", result="valid" if valid else "invalid")
+        return valid
+
+    def _verify(self, token: str, kind: str, username: str) -> bool:
+        kid, _, rest = token.partition(".")
+        body, _, signature = rest.partition(".")
+        if kid not in self.keys or not body or not signature:
+            return False
+        if not hmac.compare_digest(signature, self._signature(kid, body)):
+            return False
+        try:
+            claims = json.loads(_b64decode(body))
+        except ValueError:
+            return False
+        return (
+            isinstance(claims, dict)
+            and claims.get("kind") == kind
+            and str(claims.get("sub", "")).lower() == username.lower()
+            and isinstance(claims.get("exp"), int)
+            and claims["exp"] > time.time()
+        )
+
+
+session_tokens = SessionTokens(
+    os.environ.get("SESSION_TOKEN_KEYS", ""),
+    ttl=int(os.environ.get("SESSION_TOKEN_TTL", 1800)),
+)
+
+
+def license_token(username: str, lic_core: dict) -> dict:
+    try:
+        expires = datetime.fromisoformat(lic_core.get("expires", "2100-01-01T00:00:00"))
+    except ValueError:
+        expires = None
+    return session_tokens.issue(
+        "license", username, expires.timestamp() if expires is not None else None
+    )
+
+
+def bearer_token(headers) -> str:
+    scheme, _, token = headers.get("Authorization", "").partition(" ")
+    return token.strip() if scheme.lower() == "bearer" else ""
+
+
+NOT_FOUND_MESSAGES = {"license": "Usuario no encontrado.", "account": "Cuenta no encontrada."}
+
+
+def prepare_session_end(kind: str, data: dict, token: str = ""):
+    username = (data.get("username") or "").strip()
+    game_name = (data.get("game_name") or "").strip()
+    start_time = (data.get("start_time") or "").strip()
+
+    if not username or not game_name or not start_time:
+        return None, (
+            {
+                "error": True,
+                "status": "username, game_name y start_time son obligatorios.",
+            },
+            400,
+        )
+
+    token = token or data.get("session_token") or ""
+    if not session_tokens.verify(token, kind, username):
+        try:
+            exists = record_exists(kind, username)
+        except UpstreamUnavailable:
+            return None, upstream_unavailable()
+        if not exists:
+            return None, ({"error": True, "status": NOT_FOUND_MESSAGES[kind]}, 404)
+
+    try:
+        dt_start, dt_end, seconds = session_window(start_time)
+    except Exception:
+        return None, ({"error": True, "status": "start_time invalido."}, 400)
+
+    return {
+        "kind": kind,
+        "username": username,
+        "game_name": game_name,
+        "start": dt_start.isoformat(),
+        "end": dt_end.isoformat(),
+        "seconds": seconds,
+    }, None
+
+
+HARDWARE_FIELDS = ("hwid", "cpu_id", "ram", "mac", "disk", "ip")
+MATCHED_HARDWARE_FIELDS = ("hwid", "cpu_id", "mac")
+
+
+def keepalive_status() -> dict:
+    return {
+        "error": False,
+        "status": "servidor_activo",
+        "server_time": datetime.now().isoformat(),
+        "uptime": get_uptime(),
+        "licenses_total": count_licenses(),
+        "loader_files": count_loader_files(),
+    }
+
+
+def liveness_status() -> dict:
+    return {"error": False, "status": "servidor_activo", "uptime": get_uptime()}
+
+
+def health_status() -> dict:
+    now = time.time()
+    status = keepalive_status()
+    status["jobs"] = scheduler.stats()
+    status["upstream"] = upstream.states()
+    status["indexes"] = {
+        folder: {
+            "entries": index.count(),
+            "age_seconds": round(now - index.synced_at, 1) if index.synced_at else None,
+        }
+        for folder, index in list(folder_indexes.indexes.items())
+    }
+    if isinstance(storage, MirroredStorage):
+        status["mirror"] = storage.status()
+    return status
+
+
+def metrics_gauges(snapshot: dict) -> list:
+    gauges = [("auth_uptime_seconds", {}, round(time.time() - server_start_time, 3))]
+    for cache in ("record", "catalog", "link", "token"):
+        hits = sum(
+            metrics.counter_value(snapshot, "auth_cache_requests_total", cache=cache, result=r)
+            for r in ("hit", "revalidated")
+        )
+        total = metrics.counter_value(snapshot, "auth_cache_requests_total", cache=cache)
+        if total:
+            gauges.append(("auth_cache_hit_ratio", {"cache": cache}, round(hits / total, 4)))
+    for operation, state in upstream.states().items():
+        gauges.append(
+            ("auth_dropbox_breaker_open", {"operation": operation}, int(state == "open"))
+        )
+    gauges.append(("auth_cache_entries", {"cache": "record"}, len(record_cache.entries)))
+    gauges.append(("auth_cache_entries", {"cache": "catalog"}, len(catalog.entries)))
+    if isinstance(storage, MirroredStorage):
+        mirror = storage.status()
+        gauges.append(("auth_mirror_outbox", {}, mirror["outbox"]))
+        gauges.append(("auth_mirror_dirty", {}, mirror["dirty"]))
+        gauges.append(("auth_mirror_parked", {}, mirror["parked"]))
+    if session_journal is not None:
+        gauges.append(
+            (
+                "auth_session_journal_pending",
+                {},
+                len(session_journal.pending) + len(session_journal.inflight),
+            )
+        )
+    return gauges
 
-    for line in text.splitlines():
-        line = line.strip()
-        if not line:
-            continue
-        if line.lower().startswith("roles="):
-            try:
-                roles_dict = ast.literal_eval(line.split("=", 1)[1])
-            except Exception:
-                roles_dict = {}
-        elif line.lower().startswith("sessions_json="):
-            raw = line.split("=", 1)[1].strip()
-            try:
-                sessions_json = json.loads(raw)
-            except Exception:
-                sessions_json = {}
-        elif "=" in line:
-            k, v = line.split("=", 1)
-            data[k.strip()] = v.strip()
 
-    data["roles"] = roles_dict
-    data["sessions_json"] = sessions_json
-    return data
+def check_license(lic_core: dict, password: str):
+    if lic_core.get("pass") and lic_core["pass"] != password:
+        return {"error": True, "status": "Contraseña incorrecta."}, 403
 
+    expire_date = datetime.fromisoformat(lic_core.get("expires", "2100-01-01T00:00:00"))
+    if datetime.now() > expire_date:
+        return {"error": True, "status": "Licencia expirada."}, 403
 
-def dict_to_text_with_sessions(d: dict) -> str:
-    roles = d.get("roles", {})
-    sessions_json = d.get("sessions_json", {})
+    return None
 
-    lines = []
-    for k, v in d.items():
-        if k in ("roles", "sessions_json"):
-            continue
-        lines.append(f"{k}={v}")
 
-    lines.append(f"roles={roles}")
-    lines.append("sessions_json=" + json.dumps(sessions_json, separators=(",", ":")))
-    return "\n".join(lines)
+def bind_hardware(lic_core: dict, data: dict) -> bool:
+    actualizado = False
+    for k in HARDWARE_FIELDS:
+        v = data.get(k, "")
+        if v and not lic_core.get(k):
+            lic_core[k] = v
+            actualizado = True
+    return actualizado
 
 
-def parse_sessions(d: dict) -> dict:
-    sessions = d.get("sessions_json")
-    if isinstance(sessions, dict):
-        return sessions
-    return {}
+def hardware_mismatch(lic_core: dict, data: dict):
+    for k in MATCHED_HARDWARE_FIELDS:
+        v = data.get(k, "")
+        if v and lic_core.get(k) and v != lic_core.get(k):
+            return {"error": True, "status": f"{k.upper()} no coincide."}, 403
+    return None
 
 
-def add_session(d: dict, game_name: str, start_iso: str, end_iso: str, seconds: int):
-    sessions = parse_sessions(d)
-    g = sessions.get(
-        game_name,
-        {
-            "total_seconds": 0,
-            "total_sessions": 0,
-            "last_start": "",
-            "last_end": "",
-        },
+def license_response(username: str, lic_full: dict) -> dict:
+    response = lic_full.to_dict(exclude=LAZY_FIELDS)
+    response["sessions_json"] = sessions_with_pending(
+        "license", username, lic_full.get("sessions_json", {})
     )
+    response["roles"] = lic_full.get("roles", {})
+    return response
 
-    g["total_seconds"] = int(g.get("total_seconds", 0)) + int(seconds)
-    g["total_sessions"] = int(g.get("total_sessions", 0)) + 1
-    g["last_start"] = start_iso
-    g["last_end"] = end_iso
 
-    sessions[game_name] = g
-    d["sessions_json"] = sessions
+def session_window(start_time: str):
+    dt_start = datetime.fromisoformat(start_time)
+    dt_end = datetime.utcnow()
+    return dt_start, dt_end, int((dt_end - dt_start).total_seconds())
 
 
-@app.route("/update_account", methods=["POST"])
-def update_account():
-    data = request.json or {}
+def session_end_response(kind: str, seconds: int) -> dict:
+    return {
+        "error": False,
+        "status": f"Sesion registrada ({kind}).",
+        "seconds": seconds,
+        "minutes": round(seconds / 60, 2),
+        "hours": round(seconds / 3600, 2),
+    }
+
 
+def apply_account_update(data: dict):
     current_username = (data.get("current_username") or "").strip()
     new_username = (data.get("new_username") or "").strip()
     new_password = (data.get("new_password") or "").strip()
     new_avatar_url = (data.get("new_avatar_url") or "").strip()
 
     if not current_username:
-        return jsonify(
-            {
-                "error": True,
-                "code": "MISSING_FIELDS",
-                "status": "El usuario actual es obligatorio.",
-            }
-        ), 400
+        return {
+            "error": True,
+            "code": "MISSING_FIELDS",
+            "status": "El usuario actual es obligatorio.",
+        }, 400
 
     try:
-        content = download_account(current_username)
+        acc_full = load_account(current_username)
+    except UpstreamUnavailable:
+        return upstream_unavailable()
     except Exception:
-        return jsonify(
-            {
-                "error": True,
-                "code": "ACCOUNT_NOT_FOUND",
-                "status": "La cuenta no existe.",
-            }
-        ), 404
+        return {
+            "error": True,
+            "code": "ACCOUNT_NOT_FOUND",
+            "status": "La cuenta no existe.",
+        }, 404
 
-    acc_full = parse_text_with_sessions(content)
-    acc = {k: v for k, v in acc_full.items() if k not in ("roles", "sessions_json")}
+    acc = acc_full.to_dict(exclude=LAZY_FIELDS)
 
     ahora = datetime.now()
 
@@ -387,143 +3821,129 @@ def update_account():
     if new_username and new_username != old_username:
         if ahora - last_username_change_at < min_delta:
             restante = min_delta - (ahora - last_username_change_at)
-            return jsonify(
-                {
-                    "error": True,
-                    "code": "USERNAME_CHANGE_COOLDOWN",
-                    "status": "No puedes cambiar el usuario todavía.",
-                    "seconds_remaining": int(restante.total_seconds()),
-                }
-            ), 403
-
-        registry = download_username_registry()
-        if new_username in registry:
-            return jsonify(
-                {
-                    "error": True,
-                    "code": "USERNAME_TAKEN",
-                    "status": "Este usuario ya está en uso.",
-                }
-            ), 409
+            return {
+                "error": True,
+                "code": "USERNAME_CHANGE_COOLDOWN",
+                "status": "No puedes cambiar el usuario todavía.",
+                "seconds_remaining": int(restante.total_seconds()),
+            }, 403
+
+        if username_registry.contains(new_username):
+            return {
+                "error": True,
+                "code": "USERNAME_TAKEN",
+                "status": "Este usuario ya está en uso.",
+            }, 409
 
         acc["username"] = new_username
         acc["last_username_change_at"] = ahora.isoformat()
 
-        created = registry.get(old_username, {}).get("created_at", acc["created_at"])
-        registry.pop(old_username, None)
-        registry[new_username] = {"created_at": created}
-        upload_username_registry(registry)
+        created = (username_registry.get(old_username) or {}).get(
+            "created_at", acc["created_at"]
+        )
+        username_registry.rename(old_username, new_username, {"created_at": created})
 
         try:
             rename_account_file(current_username, new_username)
         except Exception as e:
-            return jsonify(
-                {
-                    "error": True,
-                    "code": "ACCOUNT_RENAME_ERROR",
-                    "status": f"No se pudo renombrar el archivo de cuenta: {e}",
-                }
-            ), 500
+            return {
+                "error": True,
+                "code": "ACCOUNT_RENAME_ERROR",
+                "status": f"No se pudo renombrar el archivo de cuenta: {e}",
+            }, 500
 
         current_username = new_username
 
     if new_password:
         if len(new_password) < 4:
-            return jsonify(
-                {
-                    "error": True,
-                    "code": "PASSWORD_TOO_SHORT",
-                    "status": "La contraseña debe tener al menos 4 caracteres.",
-                }
-            ), 400
+            return {
+                "error": True,
+                "code": "PASSWORD_TOO_SHORT",
+                "status": "La contraseña debe tener al menos 4 caracteres.",
+            }, 400
         acc["password"] = new_password
 
     if new_avatar_url and new_avatar_url != acc.get("avatar_url"):
         if ahora - last_avatar_change_at < min_delta:
             restante = min_delta - (ahora - last_avatar_change_at)
-            return jsonify(
-                {
-                    "error": True,
-                    "code": "AVATAR_CHANGE_COOLDOWN",
-                    "status": "No puedes cambiar el avatar todavía.",
-                    "seconds_remaining": int(restante.total_seconds()),
-                }
-            ), 403
+            return {
+                "error": True,
+                "code": "AVATAR_CHANGE_COOLDOWN",
+                "status": "No puedes cambiar el avatar todavía.",
+                "seconds_remaining": int(restante.total_seconds()),
+            }, 403
         acc["avatar_url"] = new_avatar_url
         acc["last_avatar_change_at"] = ahora.isoformat()
 
-    acc_full_updated = dict(acc_full)
-    acc_full_updated.update(acc)
+    changes = {k: v for k, v in acc.items() if acc_full.get(k) != v}
+
+    def apply_changes(d: dict) -> bool:
+        d.update(changes)
+        return bool(changes)
 
-    contenido = dict_to_text_with_sessions(acc_full_updated)
-    upload_account(current_username, contenido)
+    try:
+        acc_full_updated = update_record(account_path(current_username), apply_changes)
+    except StorageConflict:
+        return write_conflict()
 
-    account_response = dict(acc)
+    account_response = acc_full_updated.to_dict(exclude=LAZY_FIELDS)
     account_response["sessions_json"] = acc_full_updated.get("sessions_json", {})
 
-    return jsonify(
-        {
-            "error": False,
-            "status": "Cuenta actualizada.",
-            "account": account_response,
-        }
-    ), 200
+    return {
+        "error": False,
+        "status": "Cuenta actualizada.",
+        "account": account_response,
+    }, 200
 
 
-@app.route("/create_account", methods=["POST"])
-def create_account():
-    data = request.json or {}
+@app.route("/update_account", methods=["POST"])
+def update_account():
+    payload, status = apply_account_update(request.json or {})
+    return jsonify(payload), status
 
+
+def apply_account_creation(data: dict):
     username = (data.get("username") or "").strip()
     password = (data.get("password") or "").strip()
     avatar_url = (data.get("avatar_url") or "").strip()
 
     if not username or not password:
-        return jsonify(
-            {
-                "error": True,
-                "code": "MISSING_FIELDS",
-                "status": "Usuario y contraseña son obligatorios.",
-            }
-        ), 400
+        return {
+            "error": True,
+            "code": "MISSING_FIELDS",
+            "status": "Usuario y contraseña son obligatorios.",
+        }, 400
 
     if len(username) < 3:
-        return jsonify(
-            {
-                "error": True,
-                "code": "USERNAME_TOO_SHORT",
-                "status": "El usuario debe tener al menos 3 caracteres.",
-            }
-        ), 400
+        return {
+            "error": True,
+            "code": "USERNAME_TOO_SHORT",
+            "status": "El usuario debe tener al menos 3 caracteres.",
+        }, 400
 
     if len(password) < 4:
-        return jsonify(
-            {
-                "error": True,
-                "code": "PASSWORD_TOO_SHORT",
-                "status": "La contraseña debe tener al menos 4 caracteres.",
-            }
-        ), 400
-
-    registry = download_username_registry()
-    if username in registry:
-        return jsonify(
-            {
-                "error": True,
-                "code": "USERNAME_TAKEN",
-                "status": "Este usuario ya está en uso.",
-            }
-        ), 409
+        return {
+            "error": True,
+            "code": "PASSWORD_TOO_SHORT",
+            "status": "La contraseña debe tener al menos 4 caracteres.",
+        }, 400
+
+    if username_registry.contains(username):
+        return {
+            "error": True,
+            "code": "USERNAME_TAKEN",
+            "status": "Este usuario ya está en uso.",
+        }, 409
 
     try:
-        _ = download_account(username)
-        return jsonify(
-            {
-                "error": True,
-                "code": "USERNAME_TAKEN",
-                "status": "Este usuario ya está en uso.",
-            }
-        ), 409
+        _ = load_account(username)
+        return {
+            "error": True,
+            "code": "USERNAME_TAKEN",
+            "status": "Este usuario ya está en uso.",
+        }, 409
+    except UpstreamUnavailable:
+        return upstream_unavailable()
     except Exception:
         pass
 
@@ -543,32 +3963,39 @@ def create_account():
 
     contenido = dict_to_text_with_sessions(full_account)
     try:
-        upload_account(username, contenido)
+        upload_account(username, contenido, create=True)
+    except StorageConflict:
+        return {
+            "error": True,
+            "code": "USERNAME_TAKEN",
+            "status": "Este usuario ya está en uso.",
+        }, 409
     except Exception as e:
-        return jsonify(
-            {
-                "error": True,
-                "code": "ACCOUNT_SAVE_ERROR",
-                "status": f"Error al guardar la cuenta: {e}",
-            }
-        ), 500
+        return {
+            "error": True,
+            "code": "ACCOUNT_SAVE_ERROR",
+            "status": f"Error al guardar la cuenta: {e}",
+        }, 500
 
-    registry[username] = {"created_at": account_core["created_at"]}
     try:
-        upload_username_registry(registry)
+        username_registry.add(username, {"created_at": account_core["created_at"]})
     except Exception:
         pass
 
     account_response = dict(account_core)
     account_response["sessions_json"] = {}
 
-    return jsonify(
-        {
-            "error": False,
-            "status": "Cuenta creada correctamente.",
-            "account": account_response,
-        }
-    ), 201
+    return {
+        "error": False,
+        "status": "Cuenta creada correctamente.",
+        "account": account_response,
+    }, 201
+
+
+@app.route("/create_account", methods=["POST"])
+def create_account():
+    payload, status = apply_account_creation(request.json or {})
+    return jsonify(payload), status
 
 
 @app.route("/login_account", methods=["POST"])
@@ -588,7 +4015,10 @@ def login_account():
         ), 400
 
     try:
-        content = download_account(username)
+        acc_full = load_account(username)
+    except UpstreamUnavailable:
+        payload, status = upstream_unavailable()
+        return jsonify(payload), status
     except Exception:
         return jsonify(
             {
@@ -598,8 +4028,7 @@ def login_account():
             }
         ), 404
 
-    acc_full = parse_text_with_sessions(content)
-    acc_core = {k: v for k, v in acc_full.items() if k not in ("roles", "sessions_json")}
+    acc_core = acc_full.to_dict(exclude=LAZY_FIELDS)
 
     if acc_core.get("password") != password:
         return jsonify(
@@ -611,13 +4040,15 @@ def login_account():
         ), 403
 
     try:
-        files = list_files("/elementos")
+        files = catalog.get("/elementos")
         games = [f for f in files if f["name"].lower().endswith(".zip")]
     except Exception:
         games = []
 
     account_response = dict(acc_core)
-    account_response["sessions_json"] = acc_full.get("sessions_json", {})
+    account_response["sessions_json"] = sessions_with_pending(
+        "account", username, acc_full.get("sessions_json", {})
+    )
 
     return jsonify(
         {
@@ -625,113 +4056,141 @@ def login_account():
             "status": "Inicio de sesión correcto.",
             "account": account_response,
             "games": games,
+            **session_tokens.issue("account", username),
         }
     ), 200
 
 
+def games_payload(item: dict) -> dict:
+    return {
+        "error": False,
+        "status": "ok",
+        "files": [f for f in item["files"] if f["name"].lower().endswith(".zip")],
+        "failed_links": item["failed"],
+    }
+
+
 @app.route("/games", methods=["GET"])
 def games():
     try:
-        files = list_files("/elementos")
+        item = catalog.entry("/elementos")
+    except UpstreamUnavailable:
+        payload, status = upstream_unavailable()
+        return jsonify({**payload, "files": []}), status
     except Exception as e:
         return jsonify({"error": True, "status": str(e), "files": []}), 500
 
-    zip_files = [f for f in files if f["name"].lower().endswith(".zip")]
+    return conditional_json(item["etag"], lambda: (games_payload(item), 200))
 
-    return jsonify({"error": False, "status": "ok", "files": zip_files}), 200
 
+def catalog_files(folder_path: str) -> list:
+    try:
+        return catalog.get(folder_path)
+    except Exception:
+        return []
 
-@app.route("/validate", methods=["POST"])
-def validate():
-    data = request.json or {}
-
-    if data.get("username") == "PING_KEEPALIVE":
-        return jsonify(
-            {
-                "error": False,
-                "status": "servidor_activo",
-                "server_time": datetime.now().isoformat(),
-                "uptime": get_uptime(),
-                "licenses_total": count_licenses(),
-                "loader_files": count_loader_files(),
-            }
-        ), 200
 
+def apply_validation(data: dict):
     username = data.get("username")
     password = data.get("password", "")
-    hwid = data.get("hwid", "")
-    cpu_id = data.get("cpu_id", "")
-    ram = data.get("ram", "")
-    mac = data.get("mac", "")
-    disk = data.get("disk", "")
-    ip = data.get("ip", "")
 
     try:
-        content = download_license(username)
+        lic_full = load_license(username)
+    except UpstreamUnavailable:
+        return upstream_unavailable()
     except Exception:
-        return jsonify({"error": True, "status": "Usuario no encontrado."}), 404
+        return {"error": True, "status": "Usuario no encontrado."}, 404
 
-    lic_full = parse_text_with_sessions(content)
-    lic_core = {k: v for k, v in lic_full.items() if k not in ("roles", "sessions_json")}
-
-    if lic_core.get("pass") and lic_core["pass"] != password:
-        return jsonify({"error": True, "status": "Contraseña incorrecta."}), 403
+    lic_core = lic_full.to_dict(exclude=LAZY_FIELDS)
 
-    expire_date = datetime.fromisoformat(lic_core.get("expires", "2100-01-01T00:00:00"))
-    if datetime.now() > expire_date:
-        return jsonify({"error": True, "status": "Licencia expirada."}), 403
+    error = check_license(lic_core, password)
+    if error:
+        return error
 
     is_global = lic_core.get("global", "false").lower() == "true"
 
     if not is_global:
-        actualizado = False
-
-        for k, v in [
-            ("hwid", hwid),
-            ("cpu_id", cpu_id),
-            ("ram", ram),
-            ("mac", mac),
-            ("disk", disk),
-            ("ip", ip),
-        ]:
-            if v and not lic_core.get(k):
-                lic_core[k] = v
-                actualizado = True
-
-        if actualizado:
-            merged = dict(lic_full)
-            merged.update(lic_core)
-            upload_license(username, dict_to_text_with_sessions(merged))
-            lic_full = merged
-            lic_core = {k: v for k, v in lic_full.items() if k not in ("roles", "sessions_json")}
-
-        for k, v in [("hwid", hwid), ("cpu_id", cpu_id), ("mac", mac)]:
-            if v and lic_core.get(k) and v != lic_core.get(k):
-                return jsonify(
-                    {"error": True, "status": f"{k.upper()} no coincide."}
-                ), 403
+        if bind_hardware(lic_core, data):
+            try:
+                lic_full = update_record(
+                    license_path(username), lambda d: bind_hardware(d, data)
+                )
+            except UpstreamUnavailable:
+                return upstream_unavailable()
+            except StorageConflict:
+                return write_conflict()
+            lic_core = lic_full.to_dict(exclude=LAZY_FIELDS)
+
+        error = hardware_mismatch(lic_core, data)
+        if error:
+            return error
+
+    return {
+        "error": False,
+        "status": "Inicio de sesión correcto.",
+        "license": license_response(username, lic_full),
+        **license_token(username, lic_core),
+    }, 200
 
-    try:
-        loader_files = list_files("/loader")
-    except Exception:
-        loader_files = []
 
-    try:
-        game_files = list_files("/elementos")
-    except Exception:
-        game_files = []
+@app.route("/validate", methods=["POST"])
+def validate():
+    data = request.json or {}
+
+    if data.get("username") == "PING_KEEPALIVE":
+        return jsonify(keepalive_status()), 200
+
+    payload, status = apply_validation(data)
+    if status == 200:
+        payload["files"] = catalog_files("/loader")
+        payload["games"] = catalog_files("/elementos")
+    return jsonify(payload), status
+
+
+def is_batch_request(headers) -> bool:
+    token = headers.get("X-Service-Token", "")
+    return bool(batch_token) and hmac.compare_digest(token, batch_token)
+
+
+def batch_items(data: dict, key: str):
+    items = data.get(key)
+    if not isinstance(items, list):
+        return None, ({"error": True, "status": f"{key} debe ser una lista."}, 400)
+    if len(items) > batch_max_items:
+        return None, (
+            {"error": True, "status": f"Lote demasiado grande (maximo {batch_max_items})."},
+            413,
+        )
+    return items, None
+
+
+def batch_result(result) -> dict:
+    payload, status = result
+    return {**payload, "http_status": status}
 
-    license_response = dict(lic_core)
-    license_response["sessions_json"] = lic_full.get("sessions_json", {})
-    license_response["roles"] = lic_full.get("roles", {})
+
+@app.route("/validate_batch", methods=["POST"])
+def validate_batch():
+    if not is_batch_request(request.headers):
+        return jsonify({"error": True, "status": "No autorizado."}), 403
+    items, error = batch_items(request.json or {}, "items")
+    if error:
+        return jsonify(error[0]), error[1]
+
+    def validate_item(item):
+        if not isinstance(item, dict):
+            return {"error": True, "status": "Elemento invalido."}, 400
+        return apply_validation(item)
+
+    results = [batch_result(r) for r in batch_executor.map(validate_item, items)]
 
     return jsonify(
         {
             "error": False,
-            "status": "Inicio de sesión correcto.",
-            "license": license_response,
-            "files": loader_files,
-            "games": game_files,
+            "status": "ok",
+            "results": results,
+            "files": catalog_files("/loader"),
+            "games": catalog_files("/elementos"),
         }
     ), 200
 
@@ -750,12 +4209,15 @@ def start_session_license():
             }
         ), 400
 
-    try:
-        content = download_license(username)
-    except Exception:
-        return jsonify({"error": True, "status": "Usuario no encontrado."}), 404
-
-    _ = parse_text_with_sessions(content)
+    token = data.get("session_token") or bearer_token(request.headers)
+    if not session_tokens.verify(token, "license", username):
+        try:
+            load_license(username)
+        except UpstreamUnavailable:
+            payload, status = upstream_unavailable()
+            return jsonify(payload), status
+        except Exception:
+            return jsonify({"error": True, "status": "Usuario no encontrado."}), 404
 
     start_time = datetime.utcnow().isoformat()
     return jsonify(
@@ -769,53 +4231,22 @@ def start_session_license():
 
 @app.route("/end_session_license", methods=["POST"])
 def end_session_license():
-    data = request.json or {}
-    username = (data.get("username") or "").strip()
-    game_name = (data.get("game_name") or "").strip()
-    start_time = (data.get("start_time") or "").strip()
-
-    if not username or not game_name or not start_time:
-        return jsonify(
-            {
-                "error": True,
-                "status": "username, game_name y start_time son obligatorios.",
-            }
-        ), 400
-
-    try:
-        content = download_license(username)
-    except Exception:
-        return jsonify({"error": True, "status": "Usuario no encontrado."}), 404
-
-    d = parse_text_with_sessions(content)
-
-    try:
-        dt_start = datetime.fromisoformat(start_time)
-    except Exception:
-        return jsonify({"error": True, "status": "start_time invalido."}), 400
-
-    dt_end = datetime.utcnow()
-    seconds = int((dt_end - dt_start).total_seconds())
-
-    add_session(
-        d,
-        game_name=game_name,
-        start_iso=dt_start.isoformat(),
-        end_iso=dt_end.isoformat(),
-        seconds=seconds,
+    event, error = prepare_session_end(
+        "license", request.json or {}, bearer_token(request.headers)
+    )
+    if error:
+        return jsonify(error[0]), error[1]
+
+    record_session_end(
+        "license",
+        event["username"],
+        game_name=event["game_name"],
+        start_iso=event["start"],
+        end_iso=event["end"],
+        seconds=event["seconds"],
     )
 
-    upload_license(username, dict_to_text_with_sessions(d))
-
-    return jsonify(
-        {
-            "error": False,
-            "status": "Sesion registrada (license).",
-            "seconds": seconds,
-            "minutes": round(seconds / 60, 2),
-            "hours": round(seconds / 3600, 2),
-        }
-    ), 200
+    return jsonify(session_end_response("license", event["seconds"])), 200
 
 
 @app.route("/start_session_account", methods=["POST"])
@@ -832,12 +4263,15 @@ def start_session_account():
             }
         ), 400
 
-    try:
-        content = download_account(username)
-    except Exception:
-        return jsonify({"error": True, "status": "Cuenta no encontrada."}), 404
-
-    _ = parse_text_with_sessions(content)
+    token = data.get("session_token") or bearer_token(request.headers)
+    if not session_tokens.verify(token, "account", username):
+        try:
+            load_account(username)
+        except UpstreamUnavailable:
+            payload, status = upstream_unavailable()
+            return jsonify(payload), status
+        except Exception:
+            return jsonify({"error": True, "status": "Cuenta no encontrada."}), 404
 
     start_time = datetime.utcnow().isoformat()
     return jsonify(
@@ -851,53 +4285,78 @@ def start_session_account():
 
 @app.route("/end_session_account", methods=["POST"])
 def end_session_account():
-    data = request.json or {}
-    username = (data.get("username") or "").strip()
-    game_name = (data.get("game_name") or "").strip()
-    start_time = (data.get("start_time") or "").strip()
+    event, error = prepare_session_end(
+        "account", request.json or {}, bearer_token(request.headers)
+    )
+    if error:
+        return jsonify(error[0]), error[1]
+
+    record_session_end(
+        "account",
+        event["username"],
+        game_name=event["game_name"],
+        start_iso=event["start"],
+        end_iso=event["end"],
+        seconds=event["seconds"],
+    )
 
-    if not username or not game_name or not start_time:
-        return jsonify(
-            {
-                "error": True,
-                "status": "username, game_name y start_time son obligatorios.",
-            }
-        ), 400
+    return jsonify(session_end_response("account", event["seconds"])), 200
+
+
+@app.route("/end_session_batch", methods=["POST"])
+def end_session_batch():
+    if not is_batch_request(request.headers):
+        return jsonify({"error": True, "status": "No autorizado."}), 403
+    items, error = batch_items(request.json or {}, "sessions")
+    if error:
+        return jsonify(error[0]), error[1]
+
+    def prepare_item(item):
+        if not isinstance(item, dict):
+            return None, ({"error": True, "status": "Elemento invalido."}, 400)
+        kind = (item.get("kind") or "").strip()
+        if kind not in NOT_FOUND_MESSAGES:
+            return None, ({"error": True, "status": "kind debe ser license o account."}, 400)
+        return prepare_session_end(kind, item)
+
+    prepared = list(batch_executor.map(prepare_item, items))
+    failed = record_session_batch([event for event, _ in prepared if event])
+
+    results = []
+    for event, error in prepared:
+        if error:
+            results.append(batch_result(error))
+        elif (event["kind"], event["username"]) in failed:
+            results.append(
+                batch_result(({"error": True, "status": "No se pudo registrar la sesion."}, 500))
+            )
+        else:
+            results.append(
+                batch_result((session_end_response(event["kind"], event["seconds"]), 200))
+            )
+
+    return jsonify({"error": False, "status": "ok", "results": results}), 200
 
-    try:
-        content = download_account(username)
-    except Exception:
-        return jsonify({"error": True, "status": "Cuenta no encontrada."}), 404
 
-    d = parse_text_with_sessions(content)
+def sessions_etag(kind: str, username: str, rev: str) -> str:
+    pending = session_journal.pending_for(kind, username) if session_journal else []
+    return response_etag(kind, username, rev, json.dumps(pending, sort_keys=True))
 
+
+def sessions_response(kind: str, username: str):
     try:
-        dt_start = datetime.fromisoformat(start_time)
+        d, rev = record_cache.get(record_path(kind, username))
+    except UpstreamUnavailable:
+        payload, status = upstream_unavailable()
+        return jsonify(payload), status
     except Exception:
-        return jsonify({"error": True, "status": "start_time invalido."}), 400
-
-    dt_end = datetime.utcnow()
-    seconds = int((dt_end - dt_start).total_seconds())
-
-    add_session(
-        d,
-        game_name=game_name,
-        start_iso=dt_start.isoformat(),
-        end_iso=dt_end.isoformat(),
-        seconds=seconds,
-    )
+        return jsonify({"error": True, "status": NOT_FOUND_MESSAGES[kind]}), 404
 
-    upload_account(username, dict_to_text_with_sessions(d))
+    def build():
+        sessions = sessions_with_pending(kind, username, parse_sessions(d))
+        return {"error": False, "status": "ok", "sessions": sessions}, 200
 
-    return jsonify(
-        {
-            "error": False,
-            "status": "Sesion registrada (account).",
-            "seconds": seconds,
-            "minutes": round(seconds / 60, 2),
-            "hours": round(seconds / 3600, 2),
-        }
-    ), 200
+    return conditional_json(sessions_etag(kind, username, rev), build)
 
 
 @app.route("/sessions_license/<username>", methods=["GET"])
@@ -906,14 +4365,7 @@ def get_sessions_license(username):
     if not username:
         return jsonify({"error": True, "status": "username requerido."}), 400
 
-    try:
-        content = download_license(username)
-    except Exception:
-        return jsonify({"error": True, "status": "Usuario no encontrado."}), 404
-
-    d = parse_text_with_sessions(content)
-    sessions = parse_sessions(d)
-    return jsonify({"error": False, "status": "ok", "sessions": sessions}), 200
+    return sessions_response("license", username)
 
 
 @app.route("/sessions_account/<username>", methods=["GET"])
@@ -922,22 +4374,109 @@ def get_sessions_account(username):
     if not username:
         return jsonify({"error": True, "status": "username requerido."}), 400
 
-    try:
-        content = download_account(username)
-    except Exception:
-        return jsonify({"error": True, "status": "Cuenta no encontrada."}), 404
+    return sessions_response("account", username)
 
-    d = parse_text_with_sessions(content)
-    sessions = parse_sessions(d)
-    return jsonify({"error": False, "status": "ok", "sessions": sessions}), 200
+
+@app.errorhandler(UpstreamUnavailable)
+def handle_upstream_unavailable(e):
+    log.warning("Upstream unavailable: %s", e)
+    payload, status = upstream_unavailable()
+    return jsonify(payload), status
+
+
+@app.errorhandler(StorageConflict)
+def handle_storage_conflict(e):
+    log.warning("Giving up on write after repeated conflicts: %s", e)
+    payload, status = write_conflict()
+    return jsonify(payload), status
+
+
+def is_metrics_request(headers) -> bool:
+    auth = headers.get("Authorization", "")
+    return bool(metrics_token) and hmac.compare_digest(auth, f"Bearer {metrics_token}")
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    if not is_metrics_request(request.headers):
+        return jsonify(liveness_status()), 200
+    return jsonify(health_status()), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if not is_metrics_request(request.headers):
+        return jsonify({"error": True, "status": "No autorizado."}), 403
+    snapshot = metrics.snapshot()
+    return Response(
+        metrics.render(metrics_gauges(snapshot), snapshot), mimetype="text/plain; version=0.0.4"
+    )
+
+
+def is_admin_request() -> bool:
+    token = request.headers.get("X-Admin-Token", "")
+    return bool(admin_token) and hmac.compare_digest(token, admin_token)
+
+
+@app.route("/debug/profile", methods=["GET", "DELETE"])
+def profile_report():
+    if not is_admin_request():
+        return jsonify({"error": True, "status": "No autorizado."}), 403
+
+    if request.method == "DELETE":
+        profiler.reset()
+        return jsonify({"error": False, "status": "ok"}), 200
+
+    route = request.args.get("route") or None
+    fmt = request.args.get("format", "summary")
+    if fmt == "collapsed":
+        return Response(profiler.collapsed(route), mimetype="text/plain")
+    if fmt in ("pstats", "text"):
+        stats = profiler.merged_stats(route)
+        if stats is None:
+            return jsonify({"error": True, "status": "Sin perfiles para esa ruta."}), 404
+        if fmt == "pstats":
+            return Response(
+                marshal.dumps(stats.stats),
+                mimetype="application/octet-stream",
+                headers={"Content-Disposition": "attachment; filename=profile.pstats"},
+            )
+        sort = request.args.get("sort", "cumulative")
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            return jsonify({"error": True, "status": "sort invalido."}), 400
+        try:
+            limit = int(request.args.get("limit", 40))
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            return jsonify({"error": True, "status": "limit invalido."}), 400
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats(sort).print_stats(limit)
+        return Response(out.getvalue(), mimetype="text/plain")
+    return jsonify(profiler.summary()), 200
+
+
+@app.route("/catalog/invalidate", methods=["POST"])
+def invalidate_catalog():
+    if not is_admin_request():
+        return jsonify({"error": True, "status": "No autorizado."}), 403
+
+    data = request.json or {}
+    folder = (data.get("folder") or "").strip() or None
+    catalog.invalidate(folder)
+    return jsonify({"error": False, "status": "ok", "folder": folder}), 200
 
 
 if __name__ == "__main__":
-    import logging
+    if sys.argv[1:2] == ["migrate-records"]:
+        for folder in ("/licenses", "/accounts"):
+            print(f"{folder}: {migrate_record_format(folder)} records rewritten")
+        sys.exit(0)
 
     logging.getLogger("werkzeug").setLevel(logging.ERROR)
 
-    start_keepalive_thread()
+    scheduler.start()
 
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
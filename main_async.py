@@ -0,0 +1,838 @@
+import asyncio
+import contextlib
+import copy
+import hmac
+import json
+import os
+import time
+from datetime import datetime
+
+import aiohttp
+from aiohttp import web
+
+import main
+
+
+class DropboxHTTPError(Exception):
+    def __init__(self, status: int, text: str):
+        super().__init__(f"{status} {text[:200]}")
+        self.status = status
+        self.text = text
+
+
+async def current_token() -> str:
+    tokens = main.tokens
+    if tokens.token and time.time() < tokens.expires_at - 30:
+        return tokens.token
+    return await asyncio.to_thread(tokens.get)
+
+
+class AsyncDropboxClient:
+    def __init__(self, pool_size=100, connect_timeout=5.0, read_timeout=30.0):
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.session = None
+
+    async def start(self) -> None:
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size),
+            timeout=self.timeout,
+        )
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+    async def _send(self, url: str, operation: str, headers: dict, **kwargs):
+        status = "error"
+        started = time.perf_counter()
+        try:
+            async with self.session.post(url, headers=headers, **kwargs) as r:
+                status = str(r.status)
+                return (
+                    r.status,
+                    r.headers.get("Dropbox-API-Result", "{}"),
+                    r.headers.get("Retry-After"),
+                    await r.text(),
+                )
+        finally:
+            main.metrics.observe(
+                "auth_dropbox_request_duration_seconds",
+                time.perf_counter() - started,
+                operation=operation,
+            )
+            main.metrics.inc("auth_dropbox_requests_total", operation=operation, status=status)
+
+    async def _post(self, url: str, token: str, headers: dict, idempotent=True, **kwargs):
+        headers = {"Authorization": f"Bearer {token}", **headers}
+        operation = main.dropbox_operation(url)
+        breaker = main.upstream.breaker(operation)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                main.metrics.inc("auth_dropbox_short_circuits_total", operation=operation)
+                raise main.UpstreamUnavailable(f"Dropbox {operation}: circuit open")
+            try:
+                status, result, retry_after, text = await self._send(
+                    url, operation, headers, **kwargs
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                breaker.record_failure()
+                error = e
+                retry_after = None
+                retryable = main.upstream.retryable(
+                    operation,
+                    connect_error=isinstance(e, aiohttp.ClientConnectorError),
+                    idempotent=idempotent,
+                )
+            else:
+                if status not in main.RETRYABLE_STATUSES:
+                    breaker.record_success()
+                    return status, result, text
+                if status == 429:
+                    breaker.record_throttled()
+                else:
+                    breaker.record_failure()
+                error = None
+                retry_after = main.parse_retry_after(retry_after)
+                retryable = main.upstream.retryable(
+                    operation, status=status, idempotent=idempotent
+                )
+            finally:
+                breaker.release()
+
+            delay = None
+            if retryable:
+                delay = main.upstream.retry_delay(attempt, retry_after, time.monotonic() - started)
+            if delay is None:
+                detail = type(error).__name__ if error else f"HTTP {status}"
+                raise main.UpstreamUnavailable(f"Dropbox {operation}: {detail}") from error
+            main.metrics.inc("auth_dropbox_retries_total", operation=operation)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def authorized_post(self, url: str, headers: dict = None, **kwargs):
+        token = await current_token()
+        status, result, text = await self._post(url, token, headers or {}, **kwargs)
+        if status == 401:
+            token = await asyncio.to_thread(main.tokens.refresh, token)
+            status, result, text = await self._post(url, token, headers or {}, **kwargs)
+        if status >= 400:
+            raise DropboxHTTPError(status, text)
+        return result, text
+
+    async def rpc(self, endpoint: str, payload: dict) -> dict:
+        _, text = await self.authorized_post(
+            f"{main.DROPBOX_API_URL}/2/{endpoint}",
+            headers={"Content-Type": "application/json"},
+            data=json.dumps(payload),
+        )
+        return json.loads(text)
+
+    async def download(self, path: str):
+        result, text = await self.authorized_post(
+            f"{main.DROPBOX_CONTENT_URL}/2/files/download",
+            headers={"Dropbox-API-Arg": json.dumps({"path": path})},
+        )
+        return text, json.loads(result).get("rev")
+
+    async def upload(self, path: str, content: bytes, mode="overwrite") -> dict:
+        _, text = await self.authorized_post(
+            f"{main.DROPBOX_CONTENT_URL}/2/files/upload",
+            headers={
+                "Dropbox-API-Arg": json.dumps({"path": path, "mode": mode}),
+                "Content-Type": "application/octet-stream",
+            },
+            data=content,
+            idempotent=mode == "overwrite",
+        )
+        return json.loads(text)
+
+
+def _not_found(e: DropboxHTTPError) -> bool:
+    return e.status == 409 and "not_found" in e.text
+
+
+def _conflict(e: DropboxHTTPError) -> bool:
+    return e.status == 409 and "conflict" in e.text
+
+
+class AsyncStorage:
+    def __init__(self, storage: main.Storage, client: AsyncDropboxClient = None):
+        self.storage = storage
+        self.client = client
+
+    async def get(self, path: str):
+        if self.client is None:
+            return await asyncio.to_thread(self.storage.get, path)
+        try:
+            return await self.client.download(path)
+        except DropboxHTTPError as e:
+            if _not_found(e):
+                raise main.StorageNotFound(path) from e
+            raise
+
+    async def put(self, path: str, content: str, rev: str = None) -> str:
+        if self.client is None:
+            return await asyncio.to_thread(self.storage.put, path, content, rev)
+        mode = main.upload_mode(rev)
+        try:
+            return (await self.client.upload(path, content.encode("utf-8"), mode)).get("rev")
+        except DropboxHTTPError as e:
+            if rev and _conflict(e):
+                raise main.StorageConflict(path) from e
+            raise
+
+    async def metadata(self, path: str):
+        if self.client is None:
+            return await asyncio.to_thread(self.storage.metadata, path)
+        try:
+            f = await self.client.rpc("files/get_metadata", {"path": path})
+        except DropboxHTTPError as e:
+            if _not_found(e):
+                return None
+            raise
+        if f.get(".tag") != "file":
+            return None
+        return main._dropbox_entry(f)
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, kind: str, key: str, fn):
+        future = self.calls.get((kind, key))
+        if future is not None:
+            main.metrics.inc("auth_coalesced_calls_total", call=kind)
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self.calls[(kind, key)] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            del self.calls[(kind, key)]
+        return result
+
+
+flights = AsyncSingleFlight()
+
+
+async def cache_call(fn, *args):
+    # With a shared store the record cache reads and writes SQLite, and a write can
+    # wait up to its busy timeout on another worker; keep that off the event loop.
+    if main.shared is None:
+        return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+
+async def fetch_record(path: str, item: dict) -> dict:
+    cache = main.record_cache
+    if item and await cache_call(cache.confirm, path, item, await astorage.metadata(path)):
+        main.metrics.inc("auth_cache_requests_total", cache="record", result="revalidated")
+        return item
+
+    main.metrics.inc("auth_cache_requests_total", cache="record", result="miss")
+    try:
+        content, rev = await astorage.get(path)
+    except main.StorageNotFound:
+        cache.remember_missing(path)
+        raise
+    return await cache_call(cache._remember, path, content, rev)
+
+
+async def load_record(path: str, revalidate=False):
+    cache = main.record_cache
+    item, fresh = await cache_call(cache.lookup, path, revalidate)
+    if item and fresh:
+        main.metrics.inc("auth_cache_requests_total", cache="record", result="hit")
+        return copy.deepcopy(item["record"]), item["rev"]
+    if not item and not revalidate and cache.known_missing(path):
+        raise main.StorageNotFound(path)
+    try:
+        fetched = await flights.do("record", path.lower(), lambda: fetch_record(path, item))
+    except main.UpstreamUnavailable:
+        cached = None if revalidate else await cache_call(cache.stale, path)
+        if cached is None:
+            raise
+        return cached
+    return copy.deepcopy(fetched["record"]), fetched["rev"]
+
+
+record_write_locks = {}
+
+
+@contextlib.asynccontextmanager
+async def record_write_lock(path: str):
+    key = path.lower()
+    entry = record_write_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del record_write_locks[key]
+
+
+async def update_record(path: str, mutate) -> dict:
+    written = None
+    async with record_write_lock(path):
+        for attempt in range(main.record_update_attempts):
+            if attempt:
+                await asyncio.sleep(main.conflict_delay(attempt))
+            d, rev = await load_record(path, revalidate=attempt > 0)
+            if written is not None and main.dict_to_text_with_sessions(d) == written:
+                return d
+            if not mutate(d):
+                return d
+            written = main.dict_to_text_with_sessions(d)
+            try:
+                rev = await astorage.put(path, written, rev)
+            except main.StorageConflict:
+                main.record_cache.forget(path)
+                main.metrics.inc("auth_record_conflicts_total", folder=path.rsplit("/", 1)[0])
+                main.log.info("Write conflict on %s, retrying (attempt %d)", path, attempt + 1)
+                continue
+            await cache_call(main.record_cache.remember, path, written, rev, True)
+            return d
+    raise main.StorageConflict(path)
+
+
+async def record_exists(kind: str, username: str) -> bool:
+    path = main.record_path(kind, username)
+    if main.record_cache.known(path):
+        return True
+    try:
+        await load_record(path)
+        return True
+    except main.UpstreamUnavailable:
+        raise
+    except Exception:
+        return False
+
+
+async def catalog_files(folder_path: str) -> list:
+    try:
+        return await asyncio.to_thread(main.catalog.get, folder_path)
+    except Exception:
+        return []
+
+
+async def read_json(request: web.Request) -> dict:
+    try:
+        data = await request.json()
+    except (ValueError, UnicodeDecodeError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def reply(payload: dict, status: int = 200) -> web.Response:
+    return web.json_response(payload, status=status)
+
+
+def conditional_reply(request: web.Request, etag: str, build) -> web.Response:
+    matched = main.matched_etag(request.headers.get("If-None-Match", ""), etag)
+    if matched:
+        response = web.Response(status=304)
+        etag = matched
+    else:
+        response = reply(*build())
+        if response.status != 200:
+            return response
+    response.etag = etag
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+
+async def apply_validation(data: dict):
+    username = data.get("username")
+    password = data.get("password", "")
+
+    try:
+        lic_full, _ = await load_record(main.license_path(username or ""))
+    except main.UpstreamUnavailable:
+        return main.upstream_unavailable()
+    except Exception:
+        lic_full = None
+    if not username or lic_full is None:
+        return {"error": True, "status": "Usuario no encontrado."}, 404
+
+    lic_core = lic_full.to_dict(exclude=main.LAZY_FIELDS)
+
+    error = main.check_license(lic_core, password)
+    if error:
+        return error
+
+    if lic_core.get("global", "false").lower() != "true":
+        if main.bind_hardware(lic_core, data):
+            try:
+                lic_full = await update_record(
+                    main.license_path(username), lambda d: main.bind_hardware(d, data)
+                )
+            except main.UpstreamUnavailable:
+                return main.upstream_unavailable()
+            except main.StorageConflict:
+                return main.write_conflict()
+            lic_core = lic_full.to_dict(exclude=main.LAZY_FIELDS)
+
+        error = main.hardware_mismatch(lic_core, data)
+        if error:
+            return error
+
+    return {
+        "error": False,
+        "status": "Inicio de sesión correcto.",
+        "license": main.license_response(username, lic_full),
+        **main.license_token(username, lic_core),
+    }, 200
+
+
+async def validate(request: web.Request) -> web.Response:
+    data = await read_json(request)
+
+    if data.get("username") == "PING_KEEPALIVE":
+        return reply(await asyncio.to_thread(main.keepalive_status))
+
+    (payload, status), loader_files, game_files = await asyncio.gather(
+        apply_validation(data),
+        catalog_files("/loader"),
+        catalog_files("/elementos"),
+    )
+    if status == 200:
+        payload["files"] = loader_files
+        payload["games"] = game_files
+    return reply(payload, status)
+
+
+async def validate_batch(request: web.Request) -> web.Response:
+    if not main.is_batch_request(request.headers):
+        return reply({"error": True, "status": "No autorizado."}, 403)
+    items, error = main.batch_items(await read_json(request), "items")
+    if error:
+        return reply(*error)
+
+    async def validate_item(item):
+        if not isinstance(item, dict):
+            return {"error": True, "status": "Elemento invalido."}, 400
+        return await apply_validation(item)
+
+    results, loader_files, game_files = await asyncio.gather(
+        asyncio.gather(*(validate_item(item) for item in items)),
+        catalog_files("/loader"),
+        catalog_files("/elementos"),
+    )
+    return reply(
+        {
+            "error": False,
+            "status": "ok",
+            "results": [main.batch_result(r) for r in results],
+            "files": loader_files,
+            "games": game_files,
+        }
+    )
+
+
+async def login_account(request: web.Request) -> web.Response:
+    data = await read_json(request)
+
+    username = (data.get("username") or "").strip()
+    password = (data.get("password") or "").strip()
+
+    if not username or not password:
+        return reply(
+            {
+                "error": True,
+                "code": "MISSING_FIELDS",
+                "status": "Usuario y contraseña son obligatorios.",
+            },
+            400,
+        )
+
+    account_result, files = await asyncio.gather(
+        load_record(main.account_path(username)),
+        catalog_files("/elementos"),
+        return_exceptions=True,
+    )
+    if isinstance(account_result, main.UpstreamUnavailable):
+        return reply(*main.upstream_unavailable())
+    if isinstance(account_result, BaseException):
+        return reply(
+            {
+                "error": True,
+                "code": "ACCOUNT_NOT_FOUND",
+                "status": "La cuenta no existe.",
+            },
+            404,
+        )
+
+    acc_full, _ = account_result
+    acc_core = acc_full.to_dict(exclude=main.LAZY_FIELDS)
+
+    if acc_core.get("password") != password:
+        return reply(
+            {
+                "error": True,
+                "code": "INVALID_PASSWORD",
+                "status": "La contraseña es incorrecta.",
+            },
+            403,
+        )
+
+    account_response = dict(acc_core)
+    account_response["sessions_json"] = main.sessions_with_pending(
+        "account", username, acc_full.get("sessions_json", {})
+    )
+
+    return reply(
+        {
+            "error": False,
+            "status": "Inicio de sesión correcto.",
+            "account": account_response,
+            "games": [f for f in files if f["name"].lower().endswith(".zip")],
+            **main.session_tokens.issue("account", username),
+        }
+    )
+
+
+async def games(request: web.Request) -> web.Response:
+    try:
+        item = await asyncio.to_thread(main.catalog.entry, "/elementos")
+    except main.UpstreamUnavailable:
+        payload, status = main.upstream_unavailable()
+        return reply({**payload, "files": []}, status)
+    except Exception as e:
+        return reply({"error": True, "status": str(e), "files": []}, 500)
+
+    return conditional_reply(request, item["etag"], lambda: (main.games_payload(item), 200))
+
+
+async def prepare_session_end(kind: str, data: dict, token: str = ""):
+    username = (data.get("username") or "").strip()
+    game_name = (data.get("game_name") or "").strip()
+    start_time = (data.get("start_time") or "").strip()
+
+    if not username or not game_name or not start_time:
+        return None, (
+            {
+                "error": True,
+                "status": "username, game_name y start_time son obligatorios.",
+            },
+            400,
+        )
+
+    token = token or data.get("session_token") or ""
+    if not main.session_tokens.verify(token, kind, username):
+        try:
+            exists = await record_exists(kind, username)
+        except main.UpstreamUnavailable:
+            return None, main.upstream_unavailable()
+        if not exists:
+            return None, ({"error": True, "status": main.NOT_FOUND_MESSAGES[kind]}, 404)
+
+    try:
+        dt_start, dt_end, seconds = main.session_window(start_time)
+    except Exception:
+        return None, ({"error": True, "status": "start_time invalido."}, 400)
+
+    return {
+        "kind": kind,
+        "username": username,
+        "game_name": game_name,
+        "start": dt_start.isoformat(),
+        "end": dt_end.isoformat(),
+        "seconds": seconds,
+    }, None
+
+
+async def apply_session_events(kind: str, username: str, events: list) -> None:
+    def add_sessions(d: dict) -> bool:
+        for e in events:
+            main.add_session(d, e["game_name"], e["start"], e["end"], e["seconds"])
+        return True
+
+    await update_record(main.record_path(kind, username), add_sessions)
+
+
+async def record_session_batch(events: list) -> set:
+    if main.session_journal is not None:
+        await asyncio.to_thread(main.session_journal.extend, events)
+        return set()
+
+    grouped = {}
+    for event in events:
+        grouped.setdefault((event["kind"], event["username"]), []).append(event)
+    results = await asyncio.gather(
+        *(
+            apply_session_events(kind, username, group)
+            for (kind, username), group in grouped.items()
+        ),
+        return_exceptions=True,
+    )
+    return {key for key, r in zip(grouped, results) if isinstance(r, BaseException)}
+
+
+async def end_session_batch(request: web.Request) -> web.Response:
+    if not main.is_batch_request(request.headers):
+        return reply({"error": True, "status": "No autorizado."}, 403)
+    items, error = main.batch_items(await read_json(request), "sessions")
+    if error:
+        return reply(*error)
+
+    async def prepare_item(item):
+        if not isinstance(item, dict):
+            return None, ({"error": True, "status": "Elemento invalido."}, 400)
+        kind = (item.get("kind") or "").strip()
+        if kind not in main.NOT_FOUND_MESSAGES:
+            return None, ({"error": True, "status": "kind debe ser license o account."}, 400)
+        return await prepare_session_end(kind, item)
+
+    prepared = await asyncio.gather(*(prepare_item(item) for item in items))
+    failed = await record_session_batch([event for event, _ in prepared if event])
+
+    results = []
+    for event, error in prepared:
+        if error:
+            results.append(main.batch_result(error))
+        elif (event["kind"], event["username"]) in failed:
+            results.append(
+                main.batch_result(
+                    ({"error": True, "status": "No se pudo registrar la sesion."}, 500)
+                )
+            )
+        else:
+            results.append(
+                main.batch_result((main.session_end_response(event["kind"], event["seconds"]), 200))
+            )
+
+    return reply({"error": False, "status": "ok", "results": results})
+
+
+def session_handlers(kind: str, not_found: str):
+    async def start_session(request: web.Request) -> web.Response:
+        data = await read_json(request)
+        username = (data.get("username") or "").strip()
+        game_name = (data.get("game_name") or "").strip()
+
+        if not username or not game_name:
+            return reply({"error": True, "status": "username y game_name son obligatorios."}, 400)
+
+        token = data.get("session_token") or main.bearer_token(request.headers)
+        if not main.session_tokens.verify(token, kind, username):
+            try:
+                await load_record(main.record_path(kind, username))
+            except main.UpstreamUnavailable:
+                return reply(*main.upstream_unavailable())
+            except Exception:
+                return reply({"error": True, "status": not_found}, 404)
+
+        return reply(
+            {
+                "error": False,
+                "status": f"Sesion iniciada ({kind}).",
+                "start_time": datetime.utcnow().isoformat(),
+            }
+        )
+
+    async def end_session(request: web.Request) -> web.Response:
+        event, error = await prepare_session_end(
+            kind, await read_json(request), main.bearer_token(request.headers)
+        )
+        if error:
+            return reply(*error)
+
+        if await record_session_batch([event]):
+            return reply({"error": True, "status": "No se pudo registrar la sesion."}, 500)
+        return reply(main.session_end_response(kind, event["seconds"]))
+
+    async def get_sessions(request: web.Request) -> web.Response:
+        username = (request.match_info.get("username") or "").strip()
+        if not username:
+            return reply({"error": True, "status": "username requerido."}, 400)
+
+        try:
+            d, rev = await load_record(main.record_path(kind, username))
+        except main.UpstreamUnavailable:
+            return reply(*main.upstream_unavailable())
+        except Exception:
+            return reply({"error": True, "status": not_found}, 404)
+
+        def build():
+            sessions = main.sessions_with_pending(kind, username, main.parse_sessions(d))
+            return {"error": False, "status": "ok", "sessions": sessions}, 200
+
+        return conditional_reply(request, main.sessions_etag(kind, username, rev), build)
+
+    return start_session, end_session, get_sessions
+
+
+async def health(request: web.Request) -> web.Response:
+    if not main.is_metrics_request(request.headers):
+        return reply(main.liveness_status())
+    return reply(await asyncio.to_thread(main.health_status))
+
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    if not main.is_metrics_request(request.headers):
+        return reply({"error": True, "status": "No autorizado."}, 403)
+    snapshot = main.metrics.snapshot()
+    return web.Response(
+        text=main.metrics.render(await asyncio.to_thread(main.metrics_gauges, snapshot), snapshot),
+        content_type="text/plain",
+        charset="utf-8",
+    )
+
+
+@web.middleware
+async def request_metrics(request: web.Request, handler):
+    if not main.metrics.enabled:
+        return await handler(request)
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else "unmatched"
+    status = 500
+    started = time.perf_counter()
+    main.metrics.inc("auth_http_requests_in_flight", route=route)
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        main.metrics.inc("auth_http_requests_in_flight", -1, route=route)
+        main.metrics.observe(
+            "auth_http_request_duration_seconds", time.perf_counter() - started, route=route
+        )
+        main.metrics.inc(
+            "auth_http_requests_total", route=route, method=request.method, status=str(status)
+        )
+
+
+@web.middleware
+async def upstream_errors(request: web.Request, handler):
+    try:
+        return await handler(request)
+    except main.UpstreamUnavailable as e:
+        main.log.warning("Upstream unavailable: %s", e)
+        return reply(*main.upstream_unavailable())
+    except main.StorageConflict as e:
+        main.log.warning("Giving up on write after repeated conflicts: %s", e)
+        return reply(*main.write_conflict())
+
+
+@web.middleware
+async def compress_responses(request: web.Request, handler):
+    response = await handler(request)
+    if response.status != 200 or not isinstance(response, web.Response):
+        return response
+    encoding = main.choose_encoding(request.headers.get("Accept-Encoding", ""))
+    etag = response.etag.value if response.etag else None
+    if response.content_type != "application/json" or "Content-Encoding" in response.headers:
+        return response
+
+    response.headers["Vary"] = "Accept-Encoding"
+    body = response.body
+    if encoding is None or not isinstance(body, bytes) or len(body) < main.compress_min_size:
+        return response
+    response.body = main.compressed_bodies.get(body, encoding, etag)
+    response.headers["Content-Encoding"] = encoding
+    if etag:
+        response.etag = f"{etag}-{encoding}"
+    return response
+
+
+async def update_account(request: web.Request) -> web.Response:
+    data = await read_json(request)
+    return reply(*await asyncio.to_thread(main.apply_account_update, data))
+
+
+async def create_account(request: web.Request) -> web.Response:
+    data = await read_json(request)
+    return reply(*await asyncio.to_thread(main.apply_account_creation, data))
+
+
+async def invalidate_catalog(request: web.Request) -> web.Response:
+    token = request.headers.get("X-Admin-Token", "")
+    if not (main.admin_token and hmac.compare_digest(token, main.admin_token)):
+        return reply({"error": True, "status": "No autorizado."}, 403)
+
+    data = await read_json(request)
+    folder = (data.get("folder") or "").strip() or None
+    main.catalog.invalidate(folder)
+    return reply({"error": False, "status": "ok", "folder": folder})
+
+
+dropbox = AsyncDropboxClient(
+    pool_size=int(os.environ.get("ASYNC_DROPBOX_POOL_SIZE", 100)),
+    connect_timeout=float(os.environ.get("DROPBOX_CONNECT_TIMEOUT", 5)),
+    read_timeout=float(os.environ.get("DROPBOX_READ_TIMEOUT", 30)),
+)
+astorage = AsyncStorage(
+    main.storage, dropbox if isinstance(main.storage, main.DropboxStorage) else None
+)
+
+
+async def on_startup(_app: web.Application) -> None:
+    await dropbox.start()
+    main.scheduler.start()
+
+
+async def on_cleanup(_app: web.Application) -> None:
+    await dropbox.close()
+
+
+def create_app() -> web.Application:
+    application = web.Application(
+        middlewares=[request_metrics, compress_responses, upstream_errors]
+    )
+    application.on_startup.append(on_startup)
+    application.on_cleanup.append(on_cleanup)
+
+    start_license, end_license, sessions_license = session_handlers(
+        "license", "Usuario no encontrado."
+    )
+    start_account, end_account, sessions_account = session_handlers(
+        "account", "Cuenta no encontrada."
+    )
+
+    application.add_routes(
+        [
+            web.post("/update_account", update_account),
+            web.post("/create_account", create_account),
+            web.post("/login_account", login_account),
+            web.get("/games", games),
+            web.post("/validate", validate),
+            web.post("/validate_batch", validate_batch),
+            web.post("/end_session_batch", end_session_batch),
+            web.post("/start_session_license", start_license),
+            web.post("/end_session_license", end_license),
+            web.post("/start_session_account", start_account),
+            web.post("/end_session_account", end_account),
+            web.get("/sessions_license/{username}", sessions_license),
+            web.get("/sessions_account/{username}", sessions_account),
+            web.get("/health", health),
+            web.get("/metrics", metrics_endpoint),
+            web.post("/catalog/invalidate", invalidate_catalog),
+        ]
+    )
+    return application
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    web.run_app(app, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,77 @@
+import os
+import sys
+import tempfile
+import threading
+import uuid
+
+import pytest
+
+STATE_DIR = tempfile.mkdtemp(prefix="auth-tests-")
+
+os.environ.update(
+    {
+        "STORAGE_BACKEND": "memory",
+        "MEMORY_STORAGE_SEED": "",
+        "SHARED_CACHE_PATH": "",
+        "STORAGE_MIRROR_PATH": "",
+        "SESSION_JOURNAL_DIR": os.path.join(STATE_DIR, "journal"),
+        "SCHEDULER_LOCK_PATH": os.path.join(STATE_DIR, "scheduler.lock"),
+        "SELF_BASE_URL": "",
+        "SESSION_TOKEN_KEYS": "",
+        "RECORD_CONFLICT_DELAY": "0",
+    }
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def record_text(sessions: dict = None, password="secret") -> str:
+    return main.dict_to_text_with_sessions(
+        main.Record({"password": password, "roles": {}, "sessions_json": sessions or {}})
+    )
+
+
+def sessions_of(text: str) -> dict:
+    return dict(main.parse_text_with_sessions(text)["sessions_json"])
+
+
+def game(seconds: int, count: int, when: str) -> dict:
+    return {
+        "total_seconds": seconds,
+        "total_sessions": count,
+        "last_start": when,
+        "last_end": when,
+    }
+
+
+@pytest.fixture
+def username():
+    return f"user{uuid.uuid4().hex[:12]}"
+
+
+@pytest.fixture
+def license_record(username):
+    path = main.record_path("license", username)
+    main.record_cache.put(path, record_text(), create=True)
+    return path
+
+
+@pytest.fixture
+def fake_dropbox(monkeypatch):
+    from werkzeug.serving import make_server
+
+    import fake_dropbox as fake
+
+    server = make_server("127.0.0.1", 0, fake.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    for name in ("AUTH", "API", "CONTENT", "NOTIFY"):
+        monkeypatch.setattr(main, f"DROPBOX_{name}_URL", base_url)
+    monkeypatch.setattr(main, "refresh_token", "test-refresh-token")
+    monkeypatch.setattr(main.tokens, "token", None)
+    monkeypatch.setattr(main.tokens, "expires_at", 0.0)
+    yield main.DropboxStorage(main.DropboxClient())
+    server.shutdown()
+    thread.join()
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+AUTH = {"X-Service-Token": "svc-token"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "batch_token", "svc-token")
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize("endpoint", ["/validate_batch", "/end_session_batch"])
+@pytest.mark.parametrize("headers", [{}, {"X-Service-Token": "wrong"}])
+def test_batches_need_the_service_token(client, endpoint, headers):
+    r = client.post(endpoint, json={"items": [], "sessions": []}, headers=headers)
+    assert r.status_code == 403
+    assert r.get_json() == {"error": True, "status": "No autorizado."}
+
+
+@pytest.mark.parametrize("endpoint", ["/validate_batch", "/end_session_batch"])
+def test_batches_are_disabled_without_a_configured_token(client, monkeypatch, endpoint):
+    monkeypatch.setattr(main, "batch_token", "")
+    r = client.post(endpoint, json={}, headers={"X-Service-Token": ""})
+    assert r.status_code == 403
+
+
+@pytest.mark.parametrize(
+    "endpoint, key", [("/validate_batch", "items"), ("/end_session_batch", "sessions")]
+)
+def test_batch_size_is_limited(client, monkeypatch, endpoint, key):
+    monkeypatch.setattr(main, "batch_max_items", 2)
+    r = client.post(endpoint, json={key: [{}, {}, {}]}, headers=AUTH)
+    assert r.status_code == 413
+    assert "maximo 2" in r.get_json()["status"]
+
+    r = client.post(endpoint, json={key: "nope"}, headers=AUTH)
+    assert r.status_code == 400
+    assert r.get_json()["status"] == f"{key} debe ser una lista."
+
+
+def test_validate_batch_reports_each_item(client, username, license_record):
+    items = [{"username": username}, {"username": username + "x"}, "bad"]
+    r = client.post("/validate_batch", json={"items": items}, headers=AUTH)
+    assert r.status_code == 200
+
+    ok, missing, bad = r.get_json()["results"]
+    assert (ok["error"], ok["http_status"]) == (False, 200)
+    assert missing == {"error": True, "status": "Usuario no encontrado.", "http_status": 404}
+    assert bad == {"error": True, "status": "Elemento invalido.", "http_status": 400}
+
+
+def test_end_session_batch_reports_each_item(client, username, license_record):
+    start = (datetime.utcnow() - timedelta(minutes=2)).isoformat()
+    event = {"kind": "license", "username": username, "game_name": "g", "start_time": start}
+    sessions = [
+        event,
+        {**event, "kind": "other"},
+        {**event, "start_time": "yesterday"},
+        {**event, "username": username + "x"},
+        {"kind": "license"},
+        7,
+    ]
+    r = client.post("/end_session_batch", json={"sessions": sessions}, headers=AUTH)
+    assert r.status_code == 200
+
+    results = r.get_json()["results"]
+    assert [item["http_status"] for item in results] == [200, 400, 400, 404, 400, 400]
+    assert results[0]["seconds"] >= 120
+    assert results[1]["status"] == "kind debe ser license o account."
+    assert results[5]["status"] == "Elemento invalido."
@@ -0,0 +1,26 @@
+import pytest
+
+import main
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def test_health_is_liveness_only_without_the_metrics_token(client, monkeypatch):
+    monkeypatch.setattr(main, "metrics_token", "")
+    r = client.get("/health")
+    assert r.status_code == 200
+    assert set(r.get_json()) == {"error", "status", "uptime"}
+    assert client.get("/metrics").status_code == 403
+
+    monkeypatch.setattr(main, "metrics_token", "t0ken")
+    assert "jobs" not in client.get("/health", headers={"Authorization": "Bearer nope"}).get_json()
+
+
+def test_health_details_and_metrics_need_the_metrics_token(client, monkeypatch):
+    monkeypatch.setattr(main, "metrics_token", "t0ken")
+    auth = {"Authorization": "Bearer t0ken"}
+    assert {"jobs", "upstream", "indexes"} <= set(client.get("/health", headers=auth).get_json())
+    assert client.get("/metrics", headers=auth).status_code == 200
@@ -0,0 +1,81 @@
+import gzip
+import json
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+@pytest.fixture
+def compress_all(monkeypatch):
+    monkeypatch.setattr(main, "compress_min_size", 0)
+
+
+def vary(response) -> set:
+    return {v.strip() for v in response.headers.get("Vary", "").split(",")}
+
+
+def test_matching_etag_returns_304(client):
+    r = client.get("/games")
+    etag = r.headers["ETag"]
+    assert r.status_code == 200
+    assert r.headers["Cache-Control"] == "no-cache"
+
+    cached = client.get("/games", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.data == b""
+    assert cached.headers["ETag"] == etag
+    assert "Accept-Encoding" in vary(cached)
+
+    assert client.get("/games", headers={"If-None-Match": '"other"'}).status_code == 200
+    assert client.get("/games", headers={"If-None-Match": "*"}).status_code == 304
+
+
+def test_small_bodies_keep_the_bare_etag(client):
+    r = client.get("/games", headers={"Accept-Encoding": "gzip"})
+    assert len(r.data) < main.compress_min_size
+    assert "Content-Encoding" not in r.headers
+
+    cached = client.get(
+        "/games", headers={"Accept-Encoding": "gzip", "If-None-Match": r.headers["ETag"]}
+    )
+    assert cached.status_code == 304
+    assert cached.headers["ETag"] == r.headers["ETag"]
+
+
+def test_gzip_negotiation(client, compress_all):
+    plain = client.get("/games")
+    r = client.get("/games", headers={"Accept-Encoding": "gzip"})
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(r.data)) == plain.get_json()
+    assert r.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+    assert "Accept-Encoding" in vary(r)
+
+    cached = client.get(
+        "/games", headers={"Accept-Encoding": "gzip", "If-None-Match": r.headers["ETag"]}
+    )
+    assert cached.status_code == 304
+    assert cached.headers["ETag"] == r.headers["ETag"]
+
+
+def test_brotli_is_preferred_when_available(client, compress_all):
+    if main.brotli is None:
+        pytest.skip("brotli is not installed")
+    r = client.get("/games", headers={"Accept-Encoding": "gzip, br"})
+    assert r.headers["Content-Encoding"] == "br"
+    assert json.loads(main.brotli.decompress(r.data)) == client.get("/games").get_json()
+    assert r.headers["ETag"].endswith('-br"')
+
+
+@pytest.mark.parametrize("accept", ["", "identity", "gzip;q=0", "compress"])
+def test_no_acceptable_encoding_sends_identity(client, compress_all, accept):
+    r = client.get("/games", headers={"Accept-Encoding": accept})
+    assert r.status_code == 200
+    assert "Content-Encoding" not in r.headers
+    assert "Accept-Encoding" in vary(r)
+    assert r.get_json()["error"] is False
@@ -0,0 +1,172 @@
+import json
+import re
+import uuid
+
+import pytest
+import requests
+
+import main
+from conftest import game, record_text, sessions_of
+
+
+def rejected(status: int, summary: str) -> requests.HTTPError:
+    r = requests.Response()
+    r.status_code = status
+    r._content = json.dumps({"error_summary": summary}).encode("utf-8")
+    return requests.HTTPError(response=r)
+
+
+class RejectingStorage(main.MemoryStorage):
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    def put(self, path: str, content: str, rev: str = None, create=False) -> str:
+        if path.endswith("/bad.txt"):
+            raise self.error
+        return super().put(path, content, rev, create)
+
+
+def mirror_over(inner, tmp_path):
+    return main.MirroredStorage(
+        inner, str(tmp_path / "mirror.sqlite3"), folders=["/licenses"], concurrency=2
+    )
+
+
+@pytest.fixture
+def path():
+    return f"/licenses/{uuid.uuid4().hex[:12]}.txt"
+
+
+@pytest.fixture(params=["memory", "dropbox"])
+def inner(request):
+    if request.param == "memory":
+        return main.MemoryStorage()
+    return request.getfixturevalue("fake_dropbox")
+
+
+def test_push_merges_concurrent_session_totals(inner, path, tmp_path):
+    inner.put(path, record_text({"g": game(100, 2, "2026-01-01")}))
+    mirror = mirror_over(inner, tmp_path)
+    mirror.pull()
+
+    _, rev = mirror.get(path)
+    mirror.put(path, record_text({"g": game(160, 3, "2026-01-03")}), rev)
+    _, remote_rev = inner.get(path)
+    inner.put(
+        path,
+        record_text({"g": game(130, 4, "2026-01-02"), "h": game(7, 1, "2026-01-02")}),
+        remote_rev,
+    )
+
+    assert mirror.push() == 1
+    expected = {"g": game(190, 5, "2026-01-03"), "h": game(7, 1, "2026-01-02")}
+    assert sessions_of(inner.get(path)[0]) == expected
+    assert sessions_of(mirror.get(path)[0]) == expected
+    assert mirror.status()["outbox"] == 0
+    assert mirror.status()["dirty"] == 0
+
+
+def test_push_keeps_fields_edited_in_dropbox(inner, path, tmp_path):
+    inner.put(path, record_text())
+    mirror = mirror_over(inner, tmp_path)
+    mirror.pull()
+
+    _, rev = mirror.get(path)
+    mirror.put(path, record_text({"g": game(60, 1, "2026-01-01")}), rev)
+    inner.put(path, record_text(password="changed"), inner.get(path)[1])
+    mirror.push()
+
+    merged = main.parse_text_with_sessions(inner.get(path)[0])
+    assert merged["password"] == "changed"
+    assert dict(merged["sessions_json"]) == {"g": game(60, 1, "2026-01-01")}
+
+
+def test_session_reset_on_one_side_is_kept(path, tmp_path):
+    inner = main.MemoryStorage()
+    inner.put(path, record_text({"g": game(100, 2, "2026-01-01")}))
+    mirror = mirror_over(inner, tmp_path)
+    mirror.pull()
+
+    _, rev = mirror.get(path)
+    mirror.put(path, record_text({"g": game(100, 2, "2026-01-01"), "h": game(5, 1, "x")}), rev)
+    inner.put(path, record_text(), inner.get(path)[1])
+    mirror.push()
+
+    assert sessions_of(inner.get(path)[0]) == {"h": game(5, 1, "x")}
+
+
+def test_pull_applies_remote_changes_but_not_over_local_writes(path, tmp_path):
+    inner = main.MemoryStorage()
+    inner.put(path, record_text())
+    mirror = mirror_over(inner, tmp_path)
+    assert mirror.pull() == 1
+
+    inner.put(path, record_text(password="remote"), inner.get(path)[1])
+    assert mirror.pull() == 1
+    assert main.parse_text_with_sessions(mirror.get(path)[0])["password"] == "remote"
+
+    local = record_text({"g": game(30, 1, "2026-01-01")}, password="remote")
+    mirror.put(path, local, mirror.get(path)[1])
+    inner.put(path, record_text(password="newer"), inner.get(path)[1])
+    assert mirror.pull() == 0
+    assert mirror.get(path)[0] == local
+
+    mirror.push()
+    merged = main.parse_text_with_sessions(inner.get(path)[0])
+    assert merged["password"] == "newer"
+    assert dict(merged["sessions_json"]) == {"g": game(30, 1, "2026-01-01")}
+
+
+def test_pull_drops_files_deleted_in_dropbox(path, tmp_path):
+    inner = main.MemoryStorage()
+    inner.put(path, record_text())
+    mirror = mirror_over(inner, tmp_path)
+    mirror.pull()
+
+    inner.move(path, path.replace(".txt", ".bak"))
+    mirror.pull()
+    with pytest.raises(main.StorageNotFound):
+        mirror.get(path)
+
+
+def test_rejected_uploads_are_parked(path, tmp_path):
+    inner = RejectingStorage(rejected(409, "path/disallowed_name/"))
+    mirror = mirror_over(inner, tmp_path)
+    mirror.pull()
+    mirror.put("/licenses/bad.txt", record_text(), create=True)
+    mirror.put(path, record_text(), create=True)
+
+    assert mirror.push() == 2
+    assert inner.get(path)[0] == record_text()
+    assert mirror.get("/licenses/bad.txt")[0] == record_text()
+    status = mirror.status()
+    assert (status["outbox"], status["dirty"], status["parked"]) == (0, 0, 1)
+    assert mirror.push() == 0
+
+
+@pytest.mark.parametrize(
+    "error",
+    [
+        rejected(500, "internal_error/"),
+        rejected(429, "too_many_write_operations/"),
+        main.UpstreamUnavailable("down"),
+    ],
+)
+def test_transient_upload_errors_stay_queued(error, tmp_path):
+    mirror = mirror_over(RejectingStorage(error), tmp_path)
+    mirror.pull()
+    mirror.put("/licenses/bad.txt", record_text(), create=True)
+
+    with pytest.raises(type(error)):
+        mirror.push()
+    status = mirror.status()
+    assert (status["outbox"], status["dirty"], status["parked"]) == (1, 1, 0)
+
+
+def test_mirror_metrics_are_typed():
+    gauges = [(name, {}, 0) for name in ("auth_mirror_outbox", "auth_mirror_dirty")]
+    main.metrics.inc("auth_mirror_merges_total", folder="/licenses")
+    rendered = main.metrics.render(gauges)
+    for name in ("auth_mirror_merges_total", "auth_mirror_outbox", "auth_mirror_dirty"):
+        assert re.search(rf"^# TYPE {name} (counter|gauge)$", rendered, re.M)
@@ -0,0 +1,110 @@
+import pytest
+
+import main
+
+
+class StaticIndexes:
+    def __init__(self, index):
+        self.index = index
+
+    def cached(self, folder_path: str, max_age: float):
+        return self.index
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [main.time.time()]
+    monkeypatch.setattr(main.time, "time", lambda: clock[0])
+    return clock
+
+
+@pytest.fixture
+def inner():
+    storage = main.MemoryStorage()
+    storage.put("/licenses/listed.txt", "pass=x")
+    return storage
+
+
+@pytest.fixture
+def index(inner):
+    index = main.FolderIndex(inner, "/licenses")
+    assert index.sync()
+    return index
+
+
+def cache_over(storage, index=None, **kwargs) -> main.RecordCache:
+    return main.RecordCache(
+        storage,
+        indexes=StaticIndexes(index) if index else None,
+        index_folders=("/licenses",),
+        **kwargs,
+    )
+
+
+def test_missing_records_are_remembered_for_the_negative_ttl(inner, clock):
+    cache = cache_over(inner, negative_ttl=10)
+    with pytest.raises(main.StorageNotFound):
+        cache.get("/licenses/ghost.txt")
+    assert cache.known_missing("/licenses/GHOST.txt")
+
+    clock[0] += 11
+    assert not cache.known_missing("/licenses/ghost.txt")
+    assert "/licenses/ghost.txt" not in cache.missing
+
+
+def test_zero_negative_ttl_disables_the_negative_cache(inner):
+    cache = cache_over(inner, negative_ttl=0)
+    with pytest.raises(main.StorageNotFound):
+        cache.get("/licenses/ghost.txt")
+    assert not cache.known_missing("/licenses/ghost.txt")
+
+
+def test_creating_a_record_clears_its_negative_entry(inner):
+    cache = cache_over(inner, negative_ttl=60)
+    with pytest.raises(main.StorageNotFound):
+        cache.get("/licenses/new.txt")
+
+    cache.put("/licenses/new.txt", "pass=y", create=True)
+    assert not cache.known_missing("/licenses/new.txt")
+    assert cache.get("/licenses/new.txt")[0]["pass"] == "y"
+
+
+def test_unlisted_records_are_known_missing_while_the_index_is_fresh(inner, index, clock):
+    cache = cache_over(inner, index, index_max_age=30)
+    assert cache.known_missing("/licenses/ghost.txt")
+    assert not cache.known_missing("/licenses/listed.txt")
+    assert not cache.known_missing("/accounts/ghost.txt")
+
+    clock[0] += 31
+    assert not cache.known_missing("/licenses/ghost.txt")
+
+
+def test_records_written_after_the_listing_are_not_known_missing(inner, index, clock):
+    cache = cache_over(inner, index, index_max_age=30)
+    clock[0] += 1
+    cache.put("/licenses/fresh.txt", "pass=z", create=True)
+    cache.entries.clear()
+
+    assert not cache.known_missing("/licenses/fresh.txt")
+    assert cache.get("/licenses/fresh.txt")[0]["pass"] == "z"
+
+    cache.forget()
+    assert not cache.known_missing("/licenses/ghost.txt")
+
+
+def test_unsynced_index_is_never_trusted(inner):
+    cache = cache_over(inner, main.FolderIndex(inner, "/licenses"), index_max_age=30)
+    assert not cache.known_missing("/licenses/ghost.txt")
+
+
+def test_created_account_can_log_in_right_away(username):
+    client = main.app.test_client()
+    credentials = {"username": username, "password": "secret"}
+
+    missing = client.post("/login_account", json=credentials)
+    assert missing.status_code == 404
+    assert main.record_cache.known_missing(main.account_path(username))
+
+    assert client.post("/create_account", json=credentials).status_code == 201
+    assert not main.record_cache.known_missing(main.account_path(username))
+    assert client.post("/login_account", json=credentials).status_code == 200
@@ -0,0 +1,47 @@
+import pytest
+
+import main
+
+ADMIN = {"X-Admin-Token": "adm1n"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "admin_token", "adm1n")
+    client = main.app.test_client()
+    client.delete("/debug/profile", headers=ADMIN)
+    assert client.get("/games", headers={**ADMIN, "X-Profile": "1"}).status_code == 200
+    yield client
+    client.delete("/debug/profile", headers=ADMIN)
+
+
+def test_profile_needs_the_admin_token(client):
+    assert client.get("/debug/profile").status_code == 403
+    assert client.get("/debug/profile", headers={"X-Admin-Token": "nope"}).status_code == 403
+
+
+def test_text_report(client):
+    r = client.get("/debug/profile?format=text&sort=tottime&limit=5", headers=ADMIN)
+    assert r.status_code == 200
+    assert "function calls" in r.get_data(as_text=True)
+
+
+@pytest.mark.parametrize(
+    "query, status",
+    [
+        ("sort=nope", "sort invalido."),
+        ("sort=", "sort invalido."),
+        ("limit=abc", "limit invalido."),
+        ("limit=0", "limit invalido."),
+        ("limit=-3", "limit invalido."),
+    ],
+)
+def test_bad_report_arguments_are_rejected(client, query, status):
+    r = client.get(f"/debug/profile?format=text&{query}", headers=ADMIN)
+    assert r.status_code == 400
+    assert r.get_json() == {"error": True, "status": status}
+
+
+def test_unknown_route_has_no_profiles(client):
+    r = client.get("/debug/profile?format=text&route=/nope", headers=ADMIN)
+    assert r.status_code == 404
@@ -0,0 +1,115 @@
+import copy
+import json
+import uuid
+
+import pytest
+
+import main
+
+TEXT_RECORD = "\n".join(
+    [
+        "pass=abc123",
+        "expires=2026-12-31",
+        "hwid=H1",
+        "roles={'admin': True, 'tier': 'gold'}",
+        'sessions_json={"g1":{"total_seconds":60,"total_sessions":1,'
+        '"last_start":"a","last_end":"b"}}',
+    ]
+)
+ROLES = {"admin": True, "tier": "gold"}
+SESSIONS = {"g1": {"total_seconds": 60, "total_sessions": 1, "last_start": "a", "last_end": "b"}}
+
+
+@pytest.fixture
+def record_format(monkeypatch):
+    def use(fmt: str):
+        monkeypatch.setattr(main, "record_format", fmt)
+
+    use("text")
+    return use
+
+
+def test_text_round_trip_is_byte_identical(record_format):
+    d = main.parse_text_with_sessions(TEXT_RECORD)
+    assert main.dict_to_text_with_sessions(d) == TEXT_RECORD
+
+
+def test_v2_round_trip(record_format):
+    record_format("v2")
+    d = main.parse_text_with_sessions(TEXT_RECORD)
+    text = main.dict_to_text_with_sessions(d)
+    assert text.startswith(main.RECORD_V2_HEADER + "\n")
+
+    decoded = main.parse_text_with_sessions(text)
+    assert decoded.to_dict() == {
+        "pass": "abc123",
+        "expires": "2026-12-31",
+        "hwid": "H1",
+        "roles": ROLES,
+        "sessions_json": SESSIONS,
+    }
+    assert main.dict_to_text_with_sessions(decoded) == text
+
+    record_format("text")
+    back = main.parse_text_with_sessions(main.dict_to_text_with_sessions(decoded))
+    assert back.to_dict() == decoded.to_dict()
+
+
+def test_fields_decode_lazily_and_once():
+    d = main.parse_text_with_sessions(TEXT_RECORD)
+    assert type(dict.__getitem__(d, "roles")) is main.LazyValue
+    assert type(dict.__getitem__(d, "sessions_json")) is main.LazyValue
+
+    assert d["roles"] == ROLES
+    assert dict.__getitem__(d, "roles") == ROLES
+    assert type(dict.__getitem__(d, "sessions_json")) is main.LazyValue
+
+    clone = copy.deepcopy(d)
+    assert type(clone) is main.Record
+    assert dict.__getitem__(clone, "sessions_json") is dict.__getitem__(d, "sessions_json")
+    assert clone.get("sessions_json") == SESSIONS
+
+
+def test_empty_and_broken_lazy_fields():
+    d = main.parse_text_with_sessions("pass=x\nroles=not a dict(\nsessions_json={broken")
+    assert d["roles"] == {}
+    assert d["sessions_json"] == {}
+    assert main.parse_text_with_sessions("pass=x").to_dict() == {
+        "pass": "x",
+        "roles": {},
+        "sessions_json": {},
+    }
+
+
+def test_records_serialize_through_to_dict():
+    d = main.parse_text_with_sessions(TEXT_RECORD)
+    with pytest.raises(TypeError):
+        json.dumps(d)
+    assert json.loads(json.dumps(d.to_dict()))["sessions_json"] == SESSIONS
+    assert d.to_dict(exclude=main.LAZY_FIELDS) == {
+        "pass": "abc123",
+        "expires": "2026-12-31",
+        "hwid": "H1",
+    }
+
+
+def test_migrate_record_format(record_format):
+    folder = f"/migrate{uuid.uuid4().hex[:8]}"
+    for name in ("a", "b"):
+        main.storage.put(f"{folder}/{name}.txt", TEXT_RECORD)
+    record_format("v2")
+    main.storage.put(
+        f"{folder}/c.txt",
+        main.dict_to_text_with_sessions(main.parse_text_with_sessions(TEXT_RECORD)),
+    )
+
+    assert main.migrate_record_format(folder) == 2
+    assert main.migrate_record_format(folder) == 0
+    for name in ("a", "b", "c"):
+        content, _ = main.storage.get(f"{folder}/{name}.txt")
+        assert content.startswith(main.RECORD_V2_HEADER)
+        assert main.parse_text_with_sessions(content)["roles"] == ROLES
+
+    record_format("text")
+    assert main.migrate_record_format(folder) == 3
+    assert main.storage.get(f"{folder}/a.txt")[0] == TEXT_RECORD
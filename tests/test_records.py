@@ -0,0 +1,46 @@
+import pytest
+
+import main
+from conftest import game, record_text, sessions_of
+
+
+def test_update_record_retries_after_conflict(license_record):
+    main.record_cache.get(license_record)
+    _, rev = main.storage.get(license_record)
+    main.storage.put(license_record, record_text({"a": game(5, 1, "x")}), rev)
+
+    calls = []
+
+    def mutate(d):
+        calls.append(dict(main.parse_sessions(d)))
+        main.add_session(d, "b", "s", "e", 10)
+        return True
+
+    main.update_record(license_record, mutate)
+
+    assert calls == [{}, {"a": game(5, 1, "x")}]
+    assert sessions_of(main.storage.get(license_record)[0]) == {
+        "a": game(5, 1, "x"),
+        "b": {"total_seconds": 10, "total_sessions": 1, "last_start": "s", "last_end": "e"},
+    }
+
+
+def test_update_record_gives_up_after_repeated_conflicts(license_record):
+    calls = []
+
+    def mutate(d):
+        calls.append(1)
+        _, rev = main.storage.get(license_record)
+        main.storage.put(license_record, record_text(password=f"other{len(calls)}"), rev)
+        d["password"] = "mine"
+        return True
+
+    with pytest.raises(main.StorageConflict):
+        main.update_record(license_record, mutate)
+    assert len(calls) == main.record_update_attempts
+
+
+def test_update_record_skips_write_when_unchanged(license_record):
+    _, rev = main.storage.get(license_record)
+    main.update_record(license_record, lambda d: False)
+    assert main.storage.get(license_record)[1] == rev
@@ -0,0 +1,76 @@
+import fcntl
+import json
+import os
+
+import main
+from conftest import sessions_of
+
+
+def event(username: str, seconds: int, game_name="g") -> dict:
+    return {
+        "kind": "license",
+        "username": username,
+        "game_name": game_name,
+        "start": "2026-01-01T10:00:00",
+        "end": "2026-01-01T11:00:00",
+        "seconds": seconds,
+    }
+
+
+def segments(directory) -> list:
+    return sorted(name for name in os.listdir(directory) if name.endswith(".log"))
+
+
+def test_recover_replays_a_dead_workers_segment(tmp_path, username, license_record):
+    lines = [json.dumps(event(username, 60)), json.dumps(event(username, 30)), "{truncated"]
+    (tmp_path / "sessions-999999-1.log").write_text("\n".join(lines))
+
+    journal = main.SessionJournal(str(tmp_path))
+    assert journal.recover() == 2
+    assert len(journal.pending_for("license", username)) == 2
+    assert segments(tmp_path) == [os.path.basename(journal.segment[0])]
+
+    assert journal.flush() == 2
+    g = sessions_of(main.storage.get(license_record)[0])["g"]
+    assert (g["total_seconds"], g["total_sessions"]) == (90, 2)
+
+
+def test_recover_skips_segments_of_live_workers(tmp_path, username):
+    live = tmp_path / "sessions-999999-1.log"
+    live.write_text(json.dumps(event(username, 60)) + "\n")
+    with open(live, "rb") as fh:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        journal = main.SessionJournal(str(tmp_path))
+        assert journal.recover() == 0
+    assert live.exists()
+    assert journal.pending_for("license", username) == []
+
+
+def test_flushed_segments_are_not_replayed(tmp_path, username, license_record):
+    journal = main.SessionJournal(str(tmp_path))
+    journal.append(event(username, 60))
+    assert journal.flush() == 1
+    assert segments(tmp_path) == [os.path.basename(journal.segment[0])]
+
+    journal.segment[1].close()
+    restarted = main.SessionJournal(str(tmp_path))
+    assert restarted.recover() == 0
+    assert sessions_of(main.storage.get(license_record)[0])["g"]["total_sessions"] == 1
+
+
+def test_failed_events_stay_journaled(tmp_path, username, license_record, monkeypatch):
+    journal = main.SessionJournal(str(tmp_path))
+    journal.append(event(username, 60))
+
+    def fail(kind, username, events):
+        raise main.UpstreamUnavailable("down")
+
+    monkeypatch.setattr(main, "apply_session_events", fail)
+    assert journal.flush() == 0
+    assert len(journal.pending_for("license", username)) == 1
+
+    monkeypatch.undo()
+    journal.segment[1].close()
+    recovered = main.SessionJournal(str(tmp_path))
+    assert recovered.recover() == 1
+    assert recovered.flush() == 1
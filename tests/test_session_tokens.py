@@ -0,0 +1,48 @@
+import time
+
+import main
+
+
+def test_issued_token_verifies_for_its_session_only():
+    tokens = main.SessionTokens("k1:secret")
+    token = tokens.issue("license", "Bob")["session_token"]
+
+    assert tokens.verify(token, "license", "bob")
+    assert not tokens.verify(token, "account", "bob")
+    assert not tokens.verify(token, "license", "alice")
+    assert not tokens.verify(token[:-2], "license", "bob")
+    assert not main.SessionTokens("k1:other").verify(token, "license", "bob")
+
+
+def test_token_expires_after_ttl(monkeypatch):
+    tokens = main.SessionTokens("k1:secret", ttl=60)
+    issued = tokens.issue("license", "bob")
+    assert issued["session_token_expires_at"] == int(time.time() + 60)
+
+    now = time.time()
+    monkeypatch.setattr(main.time, "time", lambda: now + 61)
+    assert not tokens.verify(issued["session_token"], "license", "bob")
+
+
+def test_token_never_outlives_not_after():
+    tokens = main.SessionTokens("k1:secret", ttl=3600)
+    issued = tokens.issue("license", "bob", not_after=time.time() - 1)
+    assert issued["session_token_expires_at"] < time.time()
+    assert not tokens.verify(issued["session_token"], "license", "bob")
+
+
+def test_rotated_keys_keep_verifying_old_tokens():
+    token = main.SessionTokens("k1:old").issue("account", "bob")["session_token"]
+
+    rotated = main.SessionTokens("k2:new,k1:old")
+    assert rotated.verify(token, "account", "bob")
+    assert rotated.issue("account", "bob")["session_token"].startswith("k2.")
+    assert not main.SessionTokens("k2:new").verify(token, "account", "bob")
+
+
+def test_disabled_tokens_never_verify():
+    tokens = main.SessionTokens("")
+    assert not tokens.enabled
+    assert tokens.issue("license", "bob") == {}
+    assert not tokens.verify("k1.e30.sig", "license", "bob")
+    assert not main.SessionTokens("k1:secret").verify("", "license", "bob")
@@ -0,0 +1,70 @@
+import threading
+import time
+
+import main
+
+
+def run_concurrently(flights, fn, callers: int):
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def leader_fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return fn()
+
+    def call():
+        try:
+            results.append(flights.do("test", "key", leader_fn))
+        except Exception as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=call)]
+    threads[0].start()
+    started.wait(5)
+    threads += [threading.Thread(target=call) for _ in range(callers - 1)]
+    for t in threads[1:]:
+        t.start()
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join(5)
+    return calls, results
+
+
+def test_concurrent_callers_share_one_call():
+    calls, results = run_concurrently(main.SingleFlight(), lambda: "value", 8)
+    assert len(calls) == 1
+    assert results == ["value"] * 8
+
+
+def test_errors_reach_every_waiting_caller():
+    def fail():
+        raise main.UpstreamUnavailable("down")
+
+    calls, results = run_concurrently(main.SingleFlight(), fail, 4)
+    assert len(calls) == 1
+    assert len(results) == 4
+    assert all(isinstance(r, main.UpstreamUnavailable) for r in results)
+
+
+def test_later_calls_run_again():
+    flights = main.SingleFlight()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        return len(calls)
+
+    assert flights.do("test", "key", fn) == 1
+    assert flights.do("test", "key", fn) == 2
+    assert flights.calls == {}
+
+
+def test_other_keys_do_not_wait():
+    flights = main.SingleFlight()
+    assert flights.do("test", "a", lambda: flights.do("test", "b", lambda: "b")) == "b"
+    assert flights.do("other", "a", lambda: flights.do("test", "a", lambda: "a")) == "a"
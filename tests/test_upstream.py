@@ -0,0 +1,105 @@
+import pytest
+import requests
+
+import main
+
+DOWNLOAD_URL = f"{main.DROPBOX_CONTENT_URL}/2/files/download"
+UPLOAD_URL = f"{main.DROPBOX_CONTENT_URL}/2/files/upload"
+
+
+def response(status: int, retry_after: str = None) -> requests.Response:
+    r = requests.Response()
+    r.status_code = status
+    if retry_after is not None:
+        r.headers["Retry-After"] = retry_after
+    return r
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(main.time, "sleep", sleeps.append)
+    policy = main.UpstreamPolicy(
+        max_attempts=3, base_delay=0, budget=60, breaker_threshold=5, breaker_cooldown=30
+    )
+    policy.sleeps = sleeps
+    monkeypatch.setattr(main, "upstream", policy)
+    return policy
+
+
+@pytest.fixture
+def client(monkeypatch):
+    client = main.DropboxClient()
+    client.outcomes = []
+    client.calls = 0
+
+    def post(url, **kwargs):
+        client.calls += 1
+        outcome = client.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(client.session, "post", post)
+    return client
+
+
+def test_retries_honour_retry_after(upstream, client):
+    client.outcomes = [response(503, "2"), response(429, "1.5"), response(200)]
+    assert client.post(DOWNLOAD_URL).status_code == 200
+    assert client.calls == 3
+    assert upstream.sleeps == [2.0, 1.5]
+    assert upstream.breaker("download").state() == "closed"
+
+
+def test_gives_up_after_max_attempts(upstream, client):
+    client.outcomes = [response(500)] * 3
+    with pytest.raises(main.UpstreamUnavailable, match="HTTP 500"):
+        client.post(DOWNLOAD_URL)
+    assert client.calls == 3
+
+
+def test_conditional_uploads_are_not_retried_after_ambiguous_failures(upstream, client):
+    client.outcomes = [requests.ReadTimeout()]
+    with pytest.raises(main.UpstreamUnavailable, match="ReadTimeout"):
+        client.post(UPLOAD_URL, idempotent=False)
+    assert client.calls == 1
+
+    client.outcomes = [response(503), response(200)]
+    assert client.post(UPLOAD_URL, idempotent=False).status_code == 200
+
+
+def test_breaker_opens_after_repeated_failures(upstream, client):
+    upstream.max_attempts = 1
+    upstream.breaker_threshold = 2
+    client.outcomes = [requests.ConnectionError(), requests.ConnectionError()]
+    for _ in range(2):
+        with pytest.raises(main.UpstreamUnavailable, match="ConnectionError"):
+            client.post(DOWNLOAD_URL)
+
+    with pytest.raises(main.UpstreamUnavailable, match="circuit open"):
+        client.post(DOWNLOAD_URL)
+    assert client.calls == 2
+    assert upstream.breaker("download").state() == "open"
+
+
+def test_breaker_recovers_after_a_failed_probe(upstream, client):
+    upstream.max_attempts = 1
+    upstream.breaker_threshold = 1
+    upstream.breaker_cooldown = 0
+    client.outcomes = [
+        requests.ConnectionError(),
+        requests.exceptions.ChunkedEncodingError(),
+        ValueError("unexpected"),
+        response(200),
+    ]
+    with pytest.raises(main.UpstreamUnavailable):
+        client.post(DOWNLOAD_URL)
+    with pytest.raises(main.UpstreamUnavailable, match="ChunkedEncodingError"):
+        client.post(DOWNLOAD_URL)
+    with pytest.raises(ValueError):
+        client.post(DOWNLOAD_URL)
+
+    assert client.post(DOWNLOAD_URL).status_code == 200
+    assert upstream.breaker("download").state() == "closed"
+    assert client.calls == 4
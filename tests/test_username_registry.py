@@ -0,0 +1,82 @@
+import json
+
+import main
+
+
+class RacingStorage(main.MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.race = None
+
+    def put(self, path: str, content: str, rev: str = None, create=False) -> str:
+        race, self.race = self.race, None
+        if race:
+            race()
+        return super().put(path, content, rev, create)
+
+
+def registry_over(storage, **kwargs) -> main.UsernameRegistry:
+    kwargs.setdefault("shard_count", 8)
+    return main.UsernameRegistry(storage, "/registry", **kwargs)
+
+
+def shard_of(storage, registry, username: str) -> dict:
+    return json.loads(storage.get(registry.shard_path(registry.shard_id(username)))[0])
+
+
+def test_names_land_in_their_hashed_shard():
+    storage = main.MemoryStorage()
+    registry = registry_over(storage)
+    names = [f"user{i}" for i in range(20)]
+    for name in names:
+        registry.add(name, {"created_at": name})
+
+    assert registry.shard_id("user1") == registry.shard_id("user1")
+    assert registry.shard_path(3) == "/registry/003.json"
+    assert len({registry.shard_id(name) for name in names}) > 1
+    for name in names:
+        assert shard_of(storage, registry, name)[name] == {"created_at": name}
+        assert registry.contains(name)
+    assert not registry.contains("nobody")
+
+    registry.remove("user1")
+    assert "user1" not in shard_of(storage, registry, "user1")
+    assert not registry_over(storage).contains("user1")
+
+
+def test_legacy_registry_is_migrated_once():
+    storage = main.MemoryStorage()
+    legacy = {f"old{i}": {"created_at": str(i)} for i in range(10)}
+    storage.put("/usernames.json", json.dumps(legacy))
+    registry = registry_over(storage, legacy_path="/usernames.json")
+
+    assert registry.get("old3") == {"created_at": "3"}
+    for name, entry in legacy.items():
+        assert shard_of(storage, registry, name)[name] == entry
+
+    registry.remove("old3")
+    assert not registry_over(storage, legacy_path="/usernames.json").contains("old3")
+
+
+def test_migration_keeps_names_added_to_the_shards_first():
+    storage = main.MemoryStorage()
+    storage.put("/usernames.json", json.dumps({"bob": {"created_at": "legacy"}}))
+    registry = registry_over(storage)
+    registry.add("bob", {"created_at": "new"})
+
+    migrating = registry_over(storage, legacy_path="/usernames.json")
+    migrating._migrate_legacy()
+    assert shard_of(storage, migrating, "bob")["bob"] == {"created_at": "new"}
+
+
+def test_concurrent_claims_retry_on_conflict():
+    storage = RacingStorage()
+    registry = registry_over(storage, shard_count=1)
+    other = registry_over(storage, shard_count=1)
+    registry.add("alice", {"created_at": "1"})
+
+    storage.race = lambda: other.add("bob", {"created_at": "2"})
+    registry.add("carol", {"created_at": "3"})
+
+    assert set(shard_of(storage, registry, "carol")) == {"alice", "bob", "carol"}
+    assert registry.contains("bob")